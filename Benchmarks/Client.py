@@ -0,0 +1,107 @@
+"""Minimal WebSocket client used to put load on the server. Frames are masked the
+way a browser masks them so that the server does all of its usual work."""
+
+import os
+import errno
+import socket
+import struct
+import base64
+import WebSockets
+
+HANDSHAKE_END = "\n\r\n" #the server ends the accept line with a bare newline before the blank line
+
+def maskedFrame(payload, opcode=WebSockets.OPCODE_TEXT):
+    """Builds a masked client->server frame around the payload"""
+    mask = os.urandom(4)
+    length = len(payload)
+    if length <= 0x7D:
+        header = struct.pack("!BB", 0x80 | opcode, 0x80 | length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", 0x80 | opcode, 0x80 | 0x7E, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 0x7F, length)
+    return bytearray(header + mask) + WebSockets.unmaskBytes(payload, mask)
+
+def handshakeRequest(path, host):
+    """Returns the upgrade request for the given path"""
+    return ("GET " + path + " HTTP/1.1\r\n"
+            "Host: " + host + "\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Key: " + base64.b64encode(os.urandom(16)) + "\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n")
+
+class Connection:
+    """A client socket which has finished its handshake. Frames from the server
+    are read with readFrames, which never blocks once the socket is made
+    non-blocking."""
+    def __init__(self, addr, path, sourceAddress=None):
+        """Connects and performs the handshake, raising IOError if it is refused.
+        sourceAddress is the (host, port) to connect from, if it matters."""
+        self.sock = socket.create_connection(addr, None, sourceAddress)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(handshakeRequest(path, addr[0]))
+        response = ""
+        while HANDSHAKE_END not in response:
+            data = self.sock.recv(4096)
+            if not data:
+                self.sock.close()
+                raise IOError("Connection closed during the handshake")
+            response += data
+        head, self._buffer = response.split(HANDSHAKE_END, 1)
+        if not head.startswith("HTTP/1.1 101"):
+            self.sock.close()
+            raise IOError("Handshake refused: " + head.split("\r\n")[0])
+        self._buffer = bytearray(self._buffer)
+    
+    def fileno(self):
+        """Returns the descriptor of the socket"""
+        return self.sock.fileno()
+    
+    def send(self, payload, opcode=WebSockets.OPCODE_TEXT):
+        """Sends a whole message as one masked frame"""
+        self.sock.sendall(maskedFrame(payload, opcode))
+    
+    def readFrames(self):
+        """Reads what is available and returns a list of complete (opcode, payload)
+        frames. Raises EOFError once the server has closed the connection."""
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise
+        if not data:
+            raise EOFError("Connection closed by the server")
+        self._buffer += data
+        return self._parse()
+    
+    def _parse(self):
+        """Takes every complete unmasked server frame out of the buffer"""
+        frames = []
+        offset = 0
+        available = len(self._buffer)
+        while available - offset >= 2:
+            opcode = self._buffer[offset] & 0x0F
+            length = self._buffer[offset + 1] & 0x7F
+            start = offset + 2
+            if length == 0x7E:
+                if available - start < 2:
+                    break
+                length = struct.unpack_from("!H", self._buffer, start)[0]
+                start += 2
+            elif length == 0x7F:
+                if available - start < 8:
+                    break
+                length = struct.unpack_from("!Q", self._buffer, start)[0]
+                start += 8
+            if available - start < length:
+                break #the rest of the payload hasn't arrived yet
+            frames.append((opcode, bytes(self._buffer[start:start + length])))
+            offset = start + length
+        del self._buffer[:offset]
+        return frames
+    
+    def close(self):
+        """Closes the socket without a closing handshake"""
+        self.sock.close()
@@ -0,0 +1,39 @@
+"""Compares the JSON output of two benchmark runs, usually from two commits:
+
+python -m Benchmarks.Compare before.json after.json
+
+Every numeric result found in both runs is printed with its relative change.
+Whether higher or lower is better depends on the result, so nothing is judged."""
+
+import sys
+import json
+
+def load(path):
+    """Reads a file of JSON lines and returns {(benchmark, row key, field) : value}"""
+    values = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith("{"):
+                continue #anything else printed along the way
+            run = json.loads(line)
+            for row in run["results"]:
+                key = row[run["key"]]
+                for field in row:
+                    if field != run["key"] and isinstance(row[field], (int, long, float)):
+                        values[(run["benchmark"], key, field)] = row[field]
+    return values
+
+def main():
+    if len(sys.argv) != 3:
+        print "Usage: python -m Benchmarks.Compare before.json after.json"
+        return
+    before = load(sys.argv[1])
+    after = load(sys.argv[2])
+    print "%-48s %14s %14s %9s" % ("result", "before", "after", "change")
+    for name in sorted(set(before) & set(after)):
+        change = (after[name] - before[name]) / float(before[name]) * 100.0 if before[name] else 0.0
+        print "%-48s %14.6g %14.6g %+8.1f%%" % ("/".join(str(part) for part in name), before[name], after[name], change)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Microbenchmark for WebSocketClient.WebSocketRecvState.receive. This compares
+the current decoder against the original byte at a time decoder for a few frame
+sizes, feeding the frame in the same sized chunks the WebSocketManager receives."""
+
+import os
+import time
+import collections
+import WebSockets
+from Benchmarks import Client
+from Benchmarks import Report
+
+FRAME_SIZES = [125, 64 * 1024, 16 * 1024 * 1024]
+RecvState = WebSockets.WebSocketClient.WebSocketRecvState
+
+def legacyReceive(state, receivedBytes):
+    """The original byte at a time decoder, kept here as a point of comparison"""
+    byteQueue = collections.deque(receivedBytes)
+    while len(byteQueue) > 0 and state.state != RecvState.STATE_DONE:
+        b = byteQueue.popleft()
+        if state.state == RecvState.STATE_TYPE:
+            state.typeByte = b
+            state.lenBytes = bytearray()
+            state.maskBytes = bytearray()
+            state.maskIndex = 0
+            state.state = RecvState.STATE_LEN
+        elif state.state == RecvState.STATE_LEN:
+            if len(state.lenBytes) == 0:
+                b = b & 0x7F
+                state.lenBytes.append(b)
+                if b <= 0x7D:
+                    state.computedLength = b
+                    state.state = RecvState.STATE_MASK
+            else:
+                state.lenBytes.append(b)
+                if len(state.lenBytes) == (3 if state.lenBytes[0] == 0x7E else 9):
+                    state.computedLength = 0
+                    for lenByte in state.lenBytes[1:]:
+                        state.computedLength = state.computedLength << 8 | lenByte
+                    state.state = RecvState.STATE_MASK
+        elif state.state == RecvState.STATE_MASK:
+            state.maskBytes.append(b)
+            if len(state.maskBytes) == 4:
+                state.state = RecvState.STATE_PAYLOAD
+        elif state.state == RecvState.STATE_PAYLOAD:
+            b = b ^ state.maskBytes[state.maskIndex]
+            state.maskIndex = (state.maskIndex + 1) % 4
+            state.messageBytes.append(b)
+            if len(state.messageBytes) == state.computedLength:
+                state.state = RecvState.STATE_DONE
+    return bytearray(byteQueue)
+
+def decodeFrame(frame, receive):
+    """Decodes a whole frame in BUFFER_SIZE chunks using the given receive function
+    and returns the time taken in seconds"""
+    state = RecvState()
+    start = time.time()
+    for offset in xrange(0, len(frame), WebSockets.BUFFER_SIZE):
+        remaining = receive(state, frame[offset:offset + WebSockets.BUFFER_SIZE])
+        while len(remaining) > 0:
+            remaining = receive(state, remaining)
+    elapsed = time.time() - start
+    assert state.state == RecvState.STATE_DONE
+    return elapsed
+
+def benchmark(size, repeat):
+    """Returns the best (current, legacy) decode times for a frame of the given payload size"""
+    frame = Client.maskedFrame(os.urandom(size))
+    current = min(decodeFrame(frame, RecvState.receive) for i in xrange(repeat))
+    legacy = min(decodeFrame(frame, legacyReceive) for i in xrange(repeat))
+    return current, legacy
+
+def main():
+    report = Report.Report("frame-decoder", [("payload", "payload", 12, "%d"),
+                                             ("current", "current (s)", 14, "%.6f"),
+                                             ("legacy", "legacy (s)", 14, "%.6f"),
+                                             ("speedup", "speedup", 10, "%.1fx")])
+    for size in FRAME_SIZES:
+        repeat = 1 if size > 1024 * 1024 else 200
+        current, legacy = benchmark(size, repeat)
+        report.add(payload=size, current=current, legacy=legacy, speedup=legacy / current)
+    report.write(Report.wantsJson())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Microbenchmark for WebSocketManager._stringToFrame, which frames every message
+sent to a socket. Text, unicode text, binary and compressed messages of a few
+sizes are framed repeatedly and the best time of several runs is reported."""
+
+import os
+import time
+import WebSockets
+from Benchmarks import Report
+
+MESSAGE_SIZES = [125, 4096, 64 * 1024, 1024 * 1024]
+REPEAT = 5 #number of runs of which the best is taken
+TARGET_BYTES = 64 * 1024 * 1024 #each run frames about this many bytes
+stringToFrame = WebSockets.WebSocketClient.WebSocketManager._stringToFrame
+
+def messages(size):
+    """Returns a list of (kind, data, binary, deflate) cases for the given size"""
+    text = ("The quick brown fox jumps over the lazy dog. " * (size // 45 + 1))[:size]
+    return [("text", text, False, None),
+            ("unicode", text.decode("ascii"), False, None),
+            ("binary", bytearray(os.urandom(size)), True, None),
+            ("deflate", text, False, WebSockets.PerMessageDeflate())]
+
+def frameMessages(data, binary, deflate, count):
+    """Frames the same message count times and returns the time taken in seconds"""
+    start = time.time()
+    for i in xrange(count):
+        stringToFrame(data, binary, deflate)
+    return time.time() - start
+
+def main():
+    report = Report.Report("frame-encoder", [("case", "case", 16, "%s"),
+                                             ("frames", "frames/s", 14, "%.0f"),
+                                             ("throughput", "MB/s", 10, "%.1f")])
+    for size in MESSAGE_SIZES:
+        count = max(TARGET_BYTES // size // 16, 1)
+        for kind, data, binary, deflate in messages(size):
+            elapsed = min(frameMessages(data, binary, deflate, count) for i in xrange(REPEAT))
+            report.add(case="%s-%d" % (kind, size), frames=count / elapsed,
+                       throughput=count * size / elapsed / (1024 * 1024))
+    report.write(Report.wantsJson())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Measures the memory the server uses for each idle connection. For each number
+of connections a WebSocketServer is started on the loopback interface with the
+echo service in Benchmarks/ServiceRoot, the connections are opened from several
+load generator processes and left idle, and the growth of the resident memory
+of the server process is divided by the number of connections. The memory of
+the service processes isn't counted since it depends on the service.
+
+Each load generator connects from its own loopback address so that the local
+ports don't run out, but the server needs one descriptor per connection, so the
+open file limit has to allow it (ulimit -n). Counts which don't fit are skipped.
+The resident memory is read from /proc, so this only runs on Linux.
+
+Run it from the root directory of the server, for example:
+python -m Benchmarks.IdleMemory --connections=10000,100000 --json"""
+
+import sys
+import time
+import socket
+import getopt
+import multiprocessing
+import Queue
+from Benchmarks import Client
+from Benchmarks import LoadTest
+from Benchmarks import Report
+
+CONNECTION_COUNTS = [10000, 100000]
+CONNECTIONS_PER_PROCESS = 10000 #connections opened by each load generator, which also uses one descriptor for each
+RESERVED_FILES = 64 #descriptors the server needs besides its connections
+SETTLE_TIME = 2.0 #seconds to wait after the last connection is open before measuring
+
+def residentBytes(pid):
+    """Returns the resident memory of a process in bytes"""
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("No resident memory reported for process " + str(pid))
+
+def holdConnections(index, addr, count, results, release):
+    """Load generator process. Opens count connections to the echo service from
+    its own loopback address, reports how many failed and keeps them open
+    without sending anything until release is set."""
+    sourceAddress = ("127.0.%d.%d" % (1 + index // 250, 1 + index % 250), 0)
+    connections = []
+    failures = 0
+    for i in xrange(count):
+        try:
+            connections.append(Client.Connection(addr, LoadTest.ECHO_PATH, sourceAddress))
+        except (IOError, socket.error):
+            failures += 1
+    results.put((index, failures))
+    release.wait()
+    for connection in connections:
+        connection.close()
+
+def measure(connections):
+    """Opens the given number of idle connections to a new server and returns
+    (resident bytes before, resident bytes after, failed connections)"""
+    server = LoadTest.BenchmarkServer(1)
+    server.start()
+    generators = []
+    release = multiprocessing.Event()
+    try:
+        time.sleep(SETTLE_TIME)
+        before = residentBytes(server.process.pid)
+        results = multiprocessing.Queue()
+        processes = (connections + CONNECTIONS_PER_PROCESS - 1) // CONNECTIONS_PER_PROCESS
+        shares = [connections // processes + (1 if i < connections % processes else 0) for i in xrange(processes)]
+        generators = [multiprocessing.Process(target=holdConnections, args=(i, server.addr, shares[i], results, release))
+                      for i in xrange(processes)]
+        for generator in generators:
+            generator.daemon = True
+            generator.start()
+        failures = 0
+        deadline = time.time() + LoadTest.RESULT_TIMEOUT + connections / 1000.0
+        for generator in generators:
+            try:
+                failures += results.get(True, max(deadline - time.time(), 0))[1]
+            except Queue.Empty:
+                raise RuntimeError("Load generators didn't open their connections in time")
+        time.sleep(SETTLE_TIME)
+        after = residentBytes(server.process.pid)
+    finally:
+        release.set()
+        for generator in generators:
+            generator.join(LoadTest.SERVER_STOP_TIMEOUT)
+            if generator.is_alive():
+                generator.terminate()
+        server.stop()
+    return before, after, failures
+
+def main():
+    shortArgs = "c:h"
+    longArgs = [ "connections=", "json", "help" ]
+    counts = CONNECTION_COUNTS
+    asJson = False
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], shortArgs, longArgs)
+        for opt, value in optlist:
+            if opt in ("-c", "--connections"):
+                counts = [int(count) for count in value.split(",")]
+            elif opt == "--json":
+                asJson = True
+            else:
+                raise getopt.GetoptError("help")
+        if not counts or min(counts) < 1:
+            raise ValueError
+    except (getopt.GetoptError, ValueError):
+        print "WebSocketServer idle connection memory"
+        print "Usage:"
+        print "\t-c --connections=\tComma separated numbers of connections (10000,100000)"
+        print "\t--json\t\t\tPrint the results as JSON"
+        print "\t-h --help\t\tShow this message"
+        return
+    limit = LoadTest.raiseFileLimit()
+    report = Report.Report("idle-memory", [("connections", "connections", 12, "%d"),
+                                           ("before", "RSS before (MB)", 16, "%.1f"),
+                                           ("after", "RSS after (MB)", 16, "%.1f"),
+                                           ("perConnection", "bytes/connection", 18, "%.0f"),
+                                           ("errors", "errors", 8, "%d")])
+    for connections in counts:
+        if connections + RESERVED_FILES > limit:
+            print >>sys.stderr, "Skipping", connections, "connections: the open file limit of", limit, "is too low"
+            continue
+        before, after, failures = measure(connections)
+        opened = max(connections - failures, 1)
+        report.add(connections=connections, before=before / 1048576.0, after=after / 1048576.0,
+                   perConnection=float(after - before) / opened, errors=failures)
+    report.write(asJson)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""Load test for the whole server. A WebSocketServer is started on the loopback
+interface with the echo and broadcast services in Benchmarks/ServiceRoot and is
+driven by several load generator processes, each of which opens its share of
+the client connections. The test runs in three phases:
+
+ - handshake: every connection is opened and upgraded to the echo service
+ - echo: each connection sends a message and sends the next as soon as the
+   echo comes back, giving the messages per second and round trip latency
+ - broadcast: every connection joins the broadcast service and one of them
+   sends messages at a fixed rate, giving the deliveries per second and the
+   latency from sending to each socket receiving it
+
+Run it from the root directory of the server, for example:
+python -m Benchmarks.LoadTest --connections=2000 --duration=10 --json"""
+
+import os
+import sys
+import time
+import socket
+import signal
+import getopt
+import shutil
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+import Queue
+import WebSockets
+from Benchmarks import Client
+from Benchmarks import Report
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(ROOT, "WebSocketServer.py")
+SERVICE_ROOT = os.path.join(ROOT, "Benchmarks", "ServiceRoot") + os.sep
+ECHO_PATH = "/echo"
+BROADCAST_PATH = "/broadcast"
+SERVER_START_TIMEOUT = 30.0 #seconds to wait for the server to start listening
+SERVER_STOP_TIMEOUT = 10.0 #seconds to wait for the server to shut down before killing it
+RESULT_TIMEOUT = 120.0 #seconds a load generator may take on top of the phase duration
+
+SERVER_CONFIG = """[server]
+host: 127.0.0.1
+port: %(port)d
+document-root: %(root)s
+workers: %(workers)d
+acceptors: 1
+backlog: 4096
+handshake-timeout: 60
+preload: yes
+deflate: no
+"""
+
+class BenchmarkServer:
+    """A WebSocketServer run in its own process group with a temporary configuration"""
+    def __init__(self, workers):
+        self.workers = workers
+        self.directory = None
+        self.process = None
+        self.addr = None
+    
+    def start(self):
+        """Starts the server and waits until it is listening"""
+        self.directory = tempfile.mkdtemp(prefix="wsbench")
+        self.addr = ("127.0.0.1", findFreePort())
+        with open(os.path.join(self.directory, "server.config"), "w") as f:
+            f.write(SERVER_CONFIG % { "port" : self.addr[1], "root" : SERVICE_ROOT, "workers" : self.workers })
+        log = open(self.logPath(), "w")
+        self.process = subprocess.Popen([sys.executable, "-u", SERVER_SCRIPT], cwd=self.directory,
+                                        stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        log.close()
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("The server exited while starting:\n" + self.readLog())
+            if "Listening for connections" in self.readLog():
+                return
+            time.sleep(0.1)
+        raise RuntimeError("The server didn't start listening in time:\n" + self.readLog())
+    
+    def logPath(self):
+        """Returns the path of the file which the server's output goes to"""
+        return os.path.join(self.directory, "server.log")
+    
+    def readLog(self):
+        """Returns everything the server has printed so far"""
+        with open(self.logPath()) as f:
+            return f.read()
+    
+    def stop(self):
+        """Shuts the server down like ctrl+c would, killing it and its services if
+        that takes too long, and removes the temporary configuration"""
+        if self.process is not None:
+            try:
+                os.kill(self.process.pid, signal.SIGINT)
+                deadline = time.time() + SERVER_STOP_TIMEOUT
+                while self.process.poll() is None and time.time() < deadline:
+                    time.sleep(0.1)
+                os.killpg(self.process.pid, signal.SIGKILL) #takes care of any service processes left behind
+            except OSError:
+                pass #already gone
+            self.process.wait()
+            self.process = None
+        if self.directory is not None:
+            shutil.rmtree(self.directory, True)
+            self.directory = None
+
+def findFreePort():
+    """Returns a loopback port number which isn't in use"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def raiseFileLimit():
+    """Raises the open file limit as far as allowed, since every connection uses a
+    descriptor in both the load generator and the server"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, resource.error):
+        return soft
+    return hard
+
+def makePayload(size, prefix=""):
+    """Returns a text payload of the given size starting with prefix"""
+    return prefix + "x" * max(size - len(prefix), 0)
+
+def openConnections(addr, path, count):
+    """Opens count connections to the service at path. Returns the connections,
+    the time each handshake took and the number which failed."""
+    connections = []
+    durations = []
+    failures = 0
+    for i in xrange(count):
+        start = time.time()
+        try:
+            connections.append(Client.Connection(addr, path))
+        except (IOError, socket.error):
+            failures += 1
+            continue
+        durations.append(time.time() - start)
+    return connections, durations, failures
+
+def registerConnections(connections):
+    """Returns an EventPoller watching the connections for reading and a map from
+    descriptor to connection"""
+    poller = WebSockets.EventPoller()
+    byFd = {}
+    for connection in connections:
+        poller.register(connection.fileno(), WebSockets.EventPoller.EVENT_READ)
+        byFd[connection.fileno()] = connection
+    return poller, byFd
+
+def echoLoad(connections, payload, duration):
+    """Keeps one message in flight on every connection for duration seconds.
+    Returns the round trip times and the number of connections lost."""
+    poller, byFd = registerConnections(connections)
+    sentAt = {}
+    for connection in connections:
+        sentAt[connection.fileno()] = time.time()
+        connection.send(payload)
+    roundTrips = []
+    lost = 0
+    deadline = time.time() + duration
+    while byFd:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        for fd, events in poller.poll(remaining):
+            connection = byFd[fd]
+            try:
+                frames = connection.readFrames()
+            except (EOFError, socket.error):
+                poller.unregister(fd)
+                del byFd[fd]
+                lost += 1
+                continue
+            if frames:
+                now = time.time()
+                roundTrips.extend(now - sentAt[fd] for frame in frames)
+                sentAt[fd] = now
+                connection.send(payload)
+    return roundTrips, lost
+
+def broadcastLoad(connections, size, duration, sender, rate):
+    """Receives broadcasts on every connection for duration seconds. If sender is
+    set the first connection also sends rate messages per second, each carrying
+    the time it was sent. Returns the delivery latencies and the number of
+    connections lost."""
+    poller, byFd = registerConnections(connections)
+    latencies = []
+    lost = 0
+    interval = 1.0 / rate
+    nextSend = time.time()
+    deadline = nextSend + duration
+    while byFd:
+        now = time.time()
+        if now >= deadline:
+            break
+        if sender and now >= nextSend:
+            connections[0].send(makePayload(size, "%.6f " % now))
+            nextSend += interval
+        timeout = deadline - now
+        if sender:
+            timeout = max(min(timeout, nextSend - now), 0)
+        for fd, events in poller.poll(timeout):
+            try:
+                frames = byFd[fd].readFrames()
+            except (EOFError, socket.error):
+                poller.unregister(fd)
+                del byFd[fd]
+                lost += 1
+                continue
+            now = time.time()
+            for opcode, data in frames:
+                latencies.append(now - float(data.split(" ", 1)[0]))
+    return latencies, lost
+
+def generateLoad(index, addr, count, size, duration, rate, phases, results):
+    """Load generator process. Runs each phase once its event is set and puts
+    (phase, index, values...) tuples into the results queue."""
+    phases[0].wait()
+    start = time.time()
+    connections, durations, failures = openConnections(addr, ECHO_PATH, count)
+    results.put(("handshake", index, start, time.time(), durations, failures))
+    phases[1].wait()
+    roundTrips, lost = echoLoad(connections, makePayload(size), duration)
+    results.put(("echo", index, roundTrips, lost))
+    for connection in connections:
+        connection.close()
+    connections, durations, failures = openConnections(addr, BROADCAST_PATH, count)
+    results.put(("connected", index, failures))
+    phases[2].wait()
+    latencies, lost = broadcastLoad(connections, size, duration, index == 0, rate)
+    results.put(("broadcast", index, latencies, lost))
+    for connection in connections:
+        connection.close()
+
+def collect(results, phase, count, timeout):
+    """Returns the results of a phase from every load generator"""
+    collected = []
+    deadline = time.time() + timeout
+    while len(collected) < count:
+        try:
+            result = results.get(True, max(deadline - time.time(), 0))
+        except Queue.Empty:
+            raise RuntimeError("Load generators didn't finish the " + phase + " phase in time")
+        if result[0] != phase:
+            raise RuntimeError("Expected the " + phase + " phase but got " + result[0])
+        collected.append(result)
+    return collected
+
+def addRow(report, phase, count, elapsed, samples, errors):
+    """Adds a phase to the report with latencies given in seconds"""
+    samples.sort()
+    report.add(phase=phase, count=count, rate=count / elapsed if elapsed > 0 else 0.0,
+               p50=percentile(samples, 0.5), p99=percentile(samples, 0.99), p999=percentile(samples, 0.999),
+               errors=errors)
+
+def percentile(samples, fraction):
+    """Returns a percentile of sorted latencies in milliseconds"""
+    return Report.percentile(samples, fraction) * 1000.0
+
+def runLoad(addr, connections, processes, size, duration, rate):
+    """Runs every phase against the server at addr and returns a Report"""
+    shares = [connections // processes + (1 if i < connections % processes else 0) for i in xrange(processes)]
+    shares = [share for share in shares if share > 0]
+    phases = [multiprocessing.Event() for i in xrange(3)]
+    results = multiprocessing.Queue()
+    generators = [multiprocessing.Process(target=generateLoad, args=(i, addr, shares[i], size, duration, rate, phases, results))
+                  for i in xrange(len(shares))]
+    for generator in generators:
+        generator.daemon = True
+        generator.start()
+    report = Report.Report("load", [("phase", "phase", 10, "%s"),
+                                    ("count", "count", 10, "%d"),
+                                    ("rate", "per second", 12, "%.0f"),
+                                    ("p50", "p50 (ms)", 10, "%.3f"),
+                                    ("p99", "p99 (ms)", 10, "%.3f"),
+                                    ("p999", "p999 (ms)", 10, "%.3f"),
+                                    ("errors", "errors", 8, "%d")])
+    try:
+        phases[0].set()
+        handshakes = collect(results, "handshake", len(generators), RESULT_TIMEOUT)
+        durations = sum((r[4] for r in handshakes), [])
+        elapsed = max(r[3] for r in handshakes) - min(r[2] for r in handshakes)
+        addRow(report, "handshake", len(durations), elapsed, durations, sum(r[5] for r in handshakes))
+
+        phases[1].set()
+        echoes = collect(results, "echo", len(generators), duration + RESULT_TIMEOUT)
+        roundTrips = sum((r[2] for r in echoes), [])
+        addRow(report, "echo", len(roundTrips), duration, roundTrips, sum(r[3] for r in echoes))
+
+        connected = collect(results, "connected", len(generators), RESULT_TIMEOUT)
+        phases[2].set()
+        broadcasts = collect(results, "broadcast", len(generators), duration + RESULT_TIMEOUT)
+        latencies = sum((r[2] for r in broadcasts), [])
+        addRow(report, "broadcast", len(latencies), duration, latencies,
+               sum(r[2] for r in connected) + sum(r[3] for r in broadcasts))
+    finally:
+        for generator in generators:
+            generator.join(1.0)
+            if generator.is_alive():
+                generator.terminate()
+    return report
+
+def main():
+    shortArgs = "c:p:s:t:w:r:h"
+    longArgs = [ "connections=", "processes=", "size=", "duration=", "workers=", "rate=", "json", "help" ]
+    connections = 1000
+    processes = multiprocessing.cpu_count()
+    size = 64
+    duration = 5.0
+    workers = 1
+    rate = 10.0
+    asJson = False
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], shortArgs, longArgs)
+        for opt, value in optlist:
+            if opt in ("-c", "--connections"):
+                connections = int(value)
+            elif opt in ("-p", "--processes"):
+                processes = int(value)
+            elif opt in ("-s", "--size"):
+                size = int(value)
+            elif opt in ("-t", "--duration"):
+                duration = float(value)
+            elif opt in ("-w", "--workers"):
+                workers = int(value)
+            elif opt in ("-r", "--rate"):
+                rate = float(value)
+            elif opt == "--json":
+                asJson = True
+            else:
+                raise getopt.GetoptError("help")
+        if connections < 1 or processes < 1 or duration <= 0 or rate <= 0:
+            raise ValueError
+    except (getopt.GetoptError, ValueError):
+        print "WebSocketServer load test"
+        print "Usage:"
+        print "\t-c --connections=\tNumber of client connections (1000)"
+        print "\t-p --processes=\t\tNumber of load generator processes (one per CPU)"
+        print "\t-s --size=\t\tMessage size in bytes (64)"
+        print "\t-t --duration=\t\tSeconds to run the echo and broadcast phases (5)"
+        print "\t-w --workers=\t\tNumber of socket workers in the server (1)"
+        print "\t-r --rate=\t\tBroadcasts sent per second (10)"
+        print "\t--json\t\t\tPrint the results as JSON"
+        print "\t-h --help\t\tShow this message"
+        return
+    limit = raiseFileLimit()
+    if connections + 64 > limit:
+        print >>sys.stderr, "Warning: the open file limit of", limit, "may be too low for", connections, "connections"
+    server = BenchmarkServer(workers)
+    server.start()
+    try:
+        report = runLoad(server.addr, connections, processes, size, duration, rate)
+    finally:
+        server.stop()
+    report.write(asJson)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Microbenchmark for sending an event to every subscriber. Services.Subscribable
+calls back every subscriber, which serializes the event and puts a transaction
+for itself, the way the chatroom demo used to. Services.PubSub serializes the
+event once and puts a single broadcast, which the switchboard fans out to the
+members of the topic's group. Transactions are encoded and decoded as they
+would be on their way from the service to the switchboard, and then routed by a
+WebSocketSwitchboard to stand-in sockets whose sendQueues count what they are
+given. Both the work done in the service process and the fan-out in the server
+are measured, but not writing the frames to the sockets."""
+
+import json
+import time
+import threading
+import Processes
+import Services
+from WebSockets import WebSocketTransaction, WebSocketClient, ConnectionRegistry
+from Benchmarks import Report
+
+SUBSCRIBER_COUNTS = [10, 100, 1000, 10000]
+REPEAT = 5 #number of runs of which the best is taken
+TARGET_DELIVERIES = 200000 #each run sends events to about this many subscribers in total
+EVENT = { "type" : "message", "name" : "bench", "message" : "hello" }
+
+class CountingSendQueue:
+    """Stands in for the sendQueue of a socket, counting what is put in it"""
+    def __init__(self):
+        self.dropped = 0
+        self.transactions = 0
+
+    def put(self, transaction):
+        self.transactions += 1
+        return False #never congested
+
+class NullManager:
+    """Stands in for the WebSocketManager of the sockets, which would write them"""
+    def _requestWrite(self, s):
+        pass
+
+    def _requestWrites(self, sockets):
+        pass
+
+class Socket:
+    """The parts of a WebSocketClient which the switchboard uses to deliver to it"""
+    def __init__(self, sendQueue, manager):
+        self.id = None
+        self.sendQueue = sendQueue
+        self.wsManager = manager
+        self.deflate = None
+
+class SwitchboardQueue:
+    """Stands in for the sendQueue of a service. Each transaction put in it is
+    encoded, decoded and routed to the subscriber sockets by a switchboard."""
+    def __init__(self, subscribers):
+        self.transactions = 0
+        self.sockets = ConnectionRegistry()
+        self.switchboard = WebSocketClient.WebSocketSwitchboard(threading.Event(), Processes.ProcessDirectory(), registry=self.sockets)
+        self.delivered = CountingSendQueue() #shared by every socket
+        manager = NullManager()
+        self.socketIds = [self.sockets.add(Socket(self.delivered, manager)) for i in xrange(subscribers)]
+
+    def put(self, obj):
+        self.switchboard._routeToSockets(WebSocketTransaction.decode(obj.encode()))
+        self.transactions += 1
+
+    def putMany(self, objs):
+        for obj in objs:
+            self.put(obj)
+
+    def reset(self):
+        """Zeroes the counts of transactions put and delivered"""
+        self.transactions = 0
+        self.delivered.transactions = 0
+
+class Subscriber:
+    """Subscriber which serializes each event for its own socket"""
+    def __init__(self, socketId, sendQueue):
+        self.socketId = socketId
+        self.sendQueue = sendQueue
+
+    def onEvent(self, event):
+        data = json.dumps({ "type" : "event", "event" : event.data })
+        self.sendQueue.put(WebSocketTransaction(WebSocketTransaction.TRANSACTION_DATA, self.socketId, data))
+
+def timeSubscribable(queue, events):
+    """Sends events through a Subscribable and returns (seconds, transactions put, deliveries)"""
+    subscribable = Services.Subscribable()
+    for socketId in queue.socketIds:
+        subscriber = Subscriber(socketId, queue)
+        subscribable.subscribe(subscriber, subscriber.onEvent)
+    queue.reset()
+    start = time.time()
+    for i in xrange(events):
+        subscribable.sendEvent(Services.Subscribable.SubscriptionEvent(0, EVENT))
+    return time.time() - start, queue.transactions, queue.delivered.transactions
+
+def timePubSub(queue, events):
+    """Publishes events through a PubSub and returns (seconds, transactions put, deliveries)"""
+    service = Services.Service(queue, None)
+    pubsub = Services.PubSub(service)
+    for socketId in queue.socketIds:
+        pubsub.subscribe(socketId, "topic")
+    queue.reset()
+    start = time.time()
+    for i in xrange(events):
+        pubsub.publish("topic", json.dumps({ "type" : "event", "event" : EVENT }))
+    return time.time() - start, queue.transactions, queue.delivered.transactions
+
+def main():
+    report = Report.Report("pubsub", [("case", "case", 18, "%s"),
+                                      ("events", "events/s", 12, "%.0f"),
+                                      ("deliveries", "deliveries/s", 14, "%.0f"),
+                                      ("transactions", "puts/event", 12, "%.0f")])
+    for subscribers in SUBSCRIBER_COUNTS:
+        events = max(TARGET_DELIVERIES // subscribers, 1)
+        queue = SwitchboardQueue(subscribers)
+        for name, function in [("subscribable", timeSubscribable), ("pubsub", timePubSub)]:
+            runs = [function(queue, events) for i in xrange(REPEAT)]
+            elapsed = min(run[0] for run in runs)
+            report.add(case="%s-%d" % (name, subscribers), events=events / elapsed,
+                       deliveries=runs[0][2] / elapsed, transactions=float(runs[0][1]) / events)
+    report.write(Report.wantsJson())
+
+if __name__ == "__main__":
+    main()
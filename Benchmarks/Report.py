@@ -0,0 +1,64 @@
+"""Output shared by the benchmarks. Results are printed as a table for people or,
+with --json, as a single line of JSON so that runs from different commits can be
+saved and compared with Benchmarks.Compare."""
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+
+def commitId():
+    """Returns the id of the commit checked out in the server's directory or None"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def percentile(values, fraction):
+    """Returns the value below which the given fraction of a sorted list falls"""
+    if not values:
+        return 0.0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def wantsJson(argv=None):
+    """Returns whether --json was passed on the command line"""
+    return "--json" in (sys.argv[1:] if argv is None else argv)
+
+class Report:
+    """Results of one benchmark. Each row is a dictionary of values and the first
+    column is the key which identifies the row when comparing two runs.
+    
+    columns is a list of (key, heading, width, format) tuples."""
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = columns
+        self.rows = []
+    
+    def add(self, **values):
+        """Adds a row of results"""
+        self.rows.append(values)
+    
+    def toDict(self):
+        """Returns the results in the form they are written as JSON"""
+        return { "benchmark" : self.name,
+                 "key" : self.columns[0][0],
+                 "commit" : commitId(),
+                 "python" : platform.python_version(),
+                 "time" : time.time(),
+                 "results" : self.rows }
+    
+    def write(self, asJson=False, out=None):
+        """Prints the results as a table or as one line of JSON"""
+        out = sys.stdout if out is None else out
+        if asJson:
+            out.write(json.dumps(self.toDict(), sort_keys=True) + "\n")
+            out.flush()
+            return
+        out.write(" ".join(heading.rjust(width) for key, heading, width, fmt in self.columns) + "\n")
+        for row in self.rows:
+            out.write(" ".join((fmt % row[key]).rjust(width) for key, heading, width, fmt in self.columns) + "\n")
+        out.flush()
@@ -0,0 +1,123 @@
+"""Benchmark for the channel between the server and a service process. A child
+process echoes transactions from one queue back through another, the same way
+a service answers its recvQueue through its sendQueue. This compares
+Processes.ServiceQueue against the multiprocessing.Manager queues it replaced,
+and moving transactions one at a time against moving them in batches with
+putMany and getMany. Batched round trips send a whole batch and wait for all of
+it to come back, so they count transactions rather than batches."""
+
+import multiprocessing
+import time
+import Processes
+import WebSockets
+from Benchmarks import Report
+
+MESSAGE_COUNT = 20000
+BATCH_SIZE = WebSockets.SERVICE_BATCH_SIZE
+PAYLOAD = '{"type": "event", "event": {"type": "message", "name": "bench", "message": "hello"}}'
+
+def echo(recvQueue, sendQueue, count):
+    """Child process which sends every transaction it gets straight back"""
+    for i in xrange(count):
+        sendQueue.put(recvQueue.get())
+
+def echoBatches(recvQueue, sendQueue, count):
+    """Child process which sends every batch it gets straight back"""
+    while count > 0:
+        transactions = recvQueue.getMany(BATCH_SIZE)
+        sendQueue.putMany(transactions)
+        count -= len(transactions)
+
+def transactions(start, count):
+    """Returns a list of count transactions"""
+    return [WebSockets.WebSocketTransaction(WebSockets.WebSocketTransaction.TRANSACTION_DATA, i, PAYLOAD) for i in xrange(start, start + count)]
+
+def roundTrips(recvQueue, sendQueue, count):
+    """Sends count transactions one at a time through the echo process and waits
+    for each to come back. Returns the number of round trips per second."""
+    child = multiprocessing.Process(target=echo, args=(recvQueue, sendQueue, count))
+    child.start()
+    start = time.time()
+    for i in xrange(count):
+        recvQueue.put(WebSockets.WebSocketTransaction(WebSockets.WebSocketTransaction.TRANSACTION_DATA, i, PAYLOAD))
+        sendQueue.get()
+    elapsed = time.time() - start
+    child.join()
+    return count / elapsed
+
+def streamed(recvQueue, sendQueue, count):
+    """Sends count transactions without waiting and then collects all the echoes.
+    Returns the number of transactions per second."""
+    child = multiprocessing.Process(target=echo, args=(recvQueue, sendQueue, count))
+    child.start()
+    start = time.time()
+    received = 0
+    for i in xrange(count):
+        recvQueue.put(WebSockets.WebSocketTransaction(WebSockets.WebSocketTransaction.TRANSACTION_DATA, i, PAYLOAD))
+        if isinstance(recvQueue, Processes.ServiceQueue):
+            recvQueue.flush()
+        while not sendQueue.empty():
+            sendQueue.get_nowait()
+            received += 1
+    while received < count:
+        if isinstance(recvQueue, Processes.ServiceQueue):
+            recvQueue.flush()
+        sendQueue.get()
+        received += 1
+    elapsed = time.time() - start
+    child.join()
+    return count / elapsed
+
+def batchedRoundTrips(recvQueue, sendQueue, count):
+    """Sends count transactions in batches through the echo process, waiting for
+    each batch to come back. Returns the number of transactions per second."""
+    child = multiprocessing.Process(target=echoBatches, args=(recvQueue, sendQueue, count))
+    child.start()
+    start = time.time()
+    for i in xrange(0, count, BATCH_SIZE):
+        batch = transactions(i, min(BATCH_SIZE, count - i))
+        recvQueue.putMany(batch)
+        recvQueue.flush()
+        received = 0
+        while received < len(batch):
+            received += len(sendQueue.getMany())
+    elapsed = time.time() - start
+    child.join()
+    return count / elapsed
+
+def batchedStream(recvQueue, sendQueue, count):
+    """Sends count transactions in batches without waiting and then collects all
+    the echoes. Returns the number of transactions per second."""
+    child = multiprocessing.Process(target=echoBatches, args=(recvQueue, sendQueue, count))
+    child.start()
+    start = time.time()
+    received = 0
+    for i in xrange(0, count, BATCH_SIZE):
+        recvQueue.putMany(transactions(i, min(BATCH_SIZE, count - i)))
+        recvQueue.flush()
+        received += len(sendQueue.getMany(None, False))
+    while received < count:
+        recvQueue.flush()
+        received += len(sendQueue.getMany())
+    elapsed = time.time() - start
+    child.join()
+    return count / elapsed
+
+def main():
+    manager = multiprocessing.Manager()
+    channels = [("manager queue", lambda: (manager.Queue(), manager.Queue())),
+                ("service queue", lambda: (Processes.ServiceQueue(bufferedWrites=True), Processes.ServiceQueue()))]
+    report = Report.Report("service-channel", [("channel", "channel", 16, "%s"),
+                                               ("roundTrips", "round trips/s", 18, "%.0f"),
+                                               ("streamed", "streamed msgs/s", 18, "%.0f")])
+    for name, create in channels:
+        rtt = roundTrips(*(create() + (MESSAGE_COUNT,)))
+        stream = streamed(*(create() + (MESSAGE_COUNT,)))
+        report.add(channel=name, roundTrips=rtt, streamed=stream)
+    create = channels[-1][1]
+    report.add(channel="service batches", roundTrips=batchedRoundTrips(*(create() + (MESSAGE_COUNT,))),
+               streamed=batchedStream(*(create() + (MESSAGE_COUNT,))))
+    report.write(Report.wantsJson())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+"""Benchmark service which sends every message to every socket connected to it"""
+
+import Services
+
+GROUP = "benchmark" #every socket joins this group
+
+class Service(Services.Service):
+    def onConnect(self, socketId, address):
+        self.joinGroup(socketId, GROUP)
+    
+    def onMessage(self, socketId, data):
+        self.broadcast(GROUP, data)
@@ -0,0 +1,7 @@
+"""Benchmark service which sends every message straight back to its socket"""
+
+import Services
+
+class Service(Services.Service):
+    def onMessage(self, socketId, data):
+        self.send(socketId, data)
@@ -0,0 +1,81 @@
+"""Microbenchmark for WebSocketTransaction, which is made for every message and
+written between the server and the service processes. Making transactions is
+compared with an old style class like the one it replaced, and encode()/decode()
+with pickling, for the kinds of transactions the server sends most. The best
+time of several runs is reported."""
+
+import sys
+import time
+import cPickle
+import WebSockets
+from Benchmarks import Report
+
+REPEAT = 5 #number of runs of which the best is taken
+COUNT = 100000 #transactions made or written in each run
+Transaction = WebSockets.WebSocketTransaction
+
+class LegacyTransaction:
+    """The transaction as it was before it had slots and its own encoding"""
+    def __init__(self, transactionType, socketId, data, final=True, binary=False, trace=None):
+        self.transactionType = transactionType
+        self.socketId = socketId
+        self.data = data
+        self.final = final
+        self.binary = binary
+        self.trace = trace
+
+def cases():
+    """Returns a list of (kind, transaction) cases"""
+    text = u"The quick brown fox jumps over the lazy dog. " * 2
+    return [("text", Transaction(Transaction.TRANSACTION_DATA, 12345, text)),
+            ("binary", Transaction(Transaction.TRANSACTION_DATA, 12345, "\x00\xff" * 512, binary=True)),
+            ("close", Transaction(Transaction.TRANSACTION_CLOSE, 12345, None)),
+            ("broadcast", Transaction(Transaction.TRANSACTION_BROADCAST, [1, 2, 3, 4], text))]
+
+def timeAllocation(cls):
+    """Makes COUNT transactions and returns the time taken in seconds"""
+    start = time.time()
+    for i in xrange(COUNT):
+        cls(Transaction.TRANSACTION_DATA, i, None)
+    return time.time() - start
+
+def timePickle(transaction):
+    """Pickles and unpickles a transaction COUNT times and returns the time taken"""
+    start = time.time()
+    for i in xrange(COUNT):
+        cPickle.loads(cPickle.dumps(transaction, cPickle.HIGHEST_PROTOCOL))
+    return time.time() - start
+
+def timeEncode(transaction):
+    """Encodes and decodes a transaction COUNT times and returns the time taken"""
+    start = time.time()
+    for i in xrange(COUNT):
+        Transaction.decode(transaction.encode())
+    return time.time() - start
+
+def asLegacy(transaction):
+    """Returns a LegacyTransaction holding the same values"""
+    return LegacyTransaction(transaction.transactionType, transaction.socketId, transaction.data,
+                             transaction.final, transaction.binary, transaction.trace)
+
+def main():
+    report = Report.Report("transaction-codec", [("case", "case", 16, "%s"),
+                                                  ("rate", "per second", 12, "%.0f"),
+                                                  ("size", "bytes", 8, "%d"),
+                                                  ("memory", "object bytes", 14, "%d")])
+    for name, cls in [("alloc-legacy", LegacyTransaction), ("alloc-slots", Transaction)]:
+        instance = cls(Transaction.TRANSACTION_DATA, 0, None)
+        memory = sys.getsizeof(instance) + (sys.getsizeof(instance.__dict__) if hasattr(instance, "__dict__") else 0)
+        elapsed = min(timeAllocation(cls) for i in xrange(REPEAT))
+        report.add(case=name, rate=COUNT / elapsed, size=0, memory=memory)
+    for kind, transaction in cases():
+        legacy = asLegacy(transaction)
+        elapsed = min(timePickle(legacy) for i in xrange(REPEAT))
+        report.add(case="pickle-" + kind, rate=COUNT / elapsed,
+                   size=len(cPickle.dumps(legacy, cPickle.HIGHEST_PROTOCOL)), memory=0)
+        elapsed = min(timeEncode(transaction) for i in xrange(REPEAT))
+        report.add(case="encode-" + kind, rate=COUNT / elapsed, size=len(transaction.encode()), memory=0)
+    report.write(Report.wantsJson())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+"""Benchmarks for the WebSocketServer. Each module can be run from the root
+directory of the server, for example: python -m Benchmarks.FrameDecoder
+
+python -m Benchmarks runs all of the microbenchmarks and python -m
+Benchmarks.LoadTest runs the whole server under load. Passing --json prints
+the results as JSON, which Benchmarks.Compare compares between two runs."""
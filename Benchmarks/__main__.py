@@ -0,0 +1,16 @@
+"""Runs every microbenchmark one after the other. With --json each prints one
+line of JSON, so the output of two commits can be saved and compared with
+Benchmarks.Compare:
+
+python -m Benchmarks --json > before.json"""
+
+from Benchmarks import FrameDecoder
+from Benchmarks import FrameEncoder
+from Benchmarks import ServiceChannel
+from Benchmarks import TransactionCodec
+from Benchmarks import PubSub
+
+MICROBENCHMARKS = [FrameDecoder, FrameEncoder, ServiceChannel, TransactionCodec, PubSub]
+
+for benchmark in MICROBENCHMARKS:
+    benchmark.main()
@@ -0,0 +1,266 @@
+"""Contains the metrics registry used to watch a running WebSocketServer"""
+
+import threading
+import bisect
+import collections
+import random
+import time
+import logging
+
+RATE_WINDOW = 10.0 #seconds over which the rate of a counter is measured
+SLOW_TRACES = 32 #number of the most recent slow traces which are kept
+HISTOGRAM_BOUNDS = [0.000001 * 2 ** i for i in xrange(28)] #upper bounds of the histogram buckets, from a microsecond to a little over two minutes
+
+class Counter:
+    """A number which only goes up, such as the number of frames received. The
+    rate is measured from the samples taken each time the registry ticks.
+    
+    Updating a counter is not locked, so each counter should only be updated by
+    one thread. Threads doing the same work register their own counters under
+    different labels."""
+    def __init__(self):
+        self.value = 0
+        self._samples = collections.deque() #(time, value) taken by sample()
+    
+    def inc(self, amount=1):
+        """Adds to the counter"""
+        self.value += amount
+    
+    def sample(self, now):
+        """Remembers the current value so that the rate can be measured"""
+        self._samples.append((now, self.value))
+        while len(self._samples) > 1 and self._samples[1][0] <= now - RATE_WINDOW:
+            self._samples.popleft()
+    
+    def rate(self):
+        """Returns the increase per second over about the last RATE_WINDOW seconds"""
+        if not self._samples:
+            return 0.0
+        then, value = self._samples[0]
+        elapsed = time.time() - then
+        return (self.value - value) / elapsed if elapsed > 0 else 0.0
+    
+    def snapshot(self):
+        """Returns the value and rate of the counter"""
+        return { "value" : self.value, "rate" : self.rate() }
+
+class Gauge:
+    """A value which goes up and down, such as the number of open sockets. Either
+    set() is called whenever it changes or a function is given which is called
+    to read the value when a snapshot is taken."""
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+    
+    def set(self, value):
+        """Sets the value of the gauge"""
+        self.value = value
+    
+    def snapshot(self):
+        """Returns the value of the gauge"""
+        return { "value" : self.function() if self.function is not None else self.value }
+
+class Histogram:
+    """Distribution of measurements, such as how long something took in seconds.
+    Measurements are counted in buckets whose bounds double from one to the next,
+    so recording one is cheap and the percentiles are accurate to within a
+    factor of two. Like counters, a histogram should only be updated by one thread."""
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1) #the last bucket holds anything over the largest bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def observe(self, value):
+        """Records a measurement"""
+        self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+    
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket holding the given fraction of the
+        measurements, or the largest measurement if that is smaller"""
+        if self.count == 0:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for i in xrange(len(HISTOGRAM_BOUNDS)):
+            seen += self.counts[i]
+            if seen >= wanted:
+                return min(HISTOGRAM_BOUNDS[i], self.max)
+        return self.max
+    
+    def snapshot(self):
+        """Returns the number of measurements, their sum, mean and maximum and
+        their 50th, 99th and 99.9th percentiles"""
+        return { "count" : self.count,
+                 "sum" : self.total,
+                 "mean" : self.total / self.count if self.count else 0.0,
+                 "max" : self.max,
+                 "p50" : self.percentile(0.5),
+                 "p99" : self.percentile(0.99),
+                 "p999" : self.percentile(0.999) }
+
+class Registry:
+    """Holds the metrics of a server by name and labels. Asking for a metric which
+    already exists returns the existing one, so a metric can be looked up again
+    instead of being passed around. The registry is safe for multithreading;
+    see Counter for the metrics themselves.
+    
+    snapshot() returns everything as a dictionary which can be turned into JSON.
+    tick() should be called about once a second so that counter rates can be
+    measured."""
+    TYPE_COUNTER = "counters"
+    TYPE_GAUGE = "gauges"
+    TYPE_HISTOGRAM = "histograms"
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = { Registry.TYPE_COUNTER : {}, Registry.TYPE_GAUGE : {}, Registry.TYPE_HISTOGRAM : {} } #type -> (name, labels) -> metric
+        self.started = time.time()
+    
+    @staticmethod
+    def _key(name, labels):
+        """Returns the key a metric is stored under"""
+        return name, tuple(sorted(labels.items()))
+    
+    def _get(self, metricType, factory, name, labels):
+        """Returns the metric of a type with the given name and labels, creating it
+        with factory if it doesn't exist yet"""
+        key = Registry._key(name, labels)
+        with self._lock:
+            metric = self._metrics[metricType].get(key)
+            if metric is None:
+                metric = factory()
+                self._metrics[metricType][key] = metric
+            return metric
+    
+    def counter(self, name, **labels):
+        """Returns the counter with the given name and labels"""
+        return self._get(Registry.TYPE_COUNTER, Counter, name, labels)
+    
+    def histogram(self, name, **labels):
+        """Returns the histogram with the given name and labels"""
+        return self._get(Registry.TYPE_HISTOGRAM, Histogram, name, labels)
+    
+    def gauge(self, name, function=None, **labels):
+        """Returns the gauge with the given name and labels. If a function is given
+        it replaces the function of an existing gauge."""
+        gauge = self._get(Registry.TYPE_GAUGE, Gauge, name, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+    
+    def remove(self, name, **labels):
+        """Forgets every metric with the given name and labels, such as those of a
+        service which is no longer running"""
+        key = Registry._key(name, labels)
+        with self._lock:
+            for metrics in self._metrics.values():
+                metrics.pop(key, None)
+    
+    def tick(self):
+        """Samples every counter so that its rate can be measured"""
+        now = time.time()
+        with self._lock:
+            counters = self._metrics[Registry.TYPE_COUNTER].values()
+        for counter in counters:
+            counter.sample(now)
+    
+    def snapshot(self):
+        """Returns the current value of every metric. Metrics are grouped by type
+        and name, with one entry for each set of labels. Counters also have a
+        total over all their labels."""
+        with self._lock:
+            metrics = dict((metricType, self._metrics[metricType].items()) for metricType in self._metrics)
+        ret = { "time" : time.time(), "uptime" : time.time() - self.started }
+        for metricType in metrics:
+            byName = {}
+            for (name, labels), metric in sorted(metrics[metricType], key=lambda item: item[0]):
+                entry = metric.snapshot()
+                entry["labels"] = dict(labels)
+                byName.setdefault(name, { "series" : [] })["series"].append(entry)
+            if metricType == Registry.TYPE_COUNTER:
+                for name in byName:
+                    series = byName[name]["series"]
+                    byName[name]["total"] = { "value" : sum(entry["value"] for entry in series),
+                                              "rate" : sum(entry["rate"] for entry in series) }
+            ret[metricType] = byName
+        return ret
+
+class Tracer:
+    """Samples messages received from sockets and follows them on their way
+    through the server, the service and back out to the socket. A sampled
+    transaction carries a trace, which is a list of (stage, time) tuples that is
+    added to at every stage and pickled along with the transaction when it goes
+    to the service process. Answers the service sends while handling a traced
+    transaction carry on the same trace.
+    
+    Once the answer is written to the socket the trace is finished: the time
+    between each pair of stages is recorded in the traceStage histogram of the
+    registry and the whole time in traceTotal. Traces which took longer than
+    slowThreshold seconds are kept (the last SLOW_TRACES of them) and logged.
+    hook, if set, is called with every finished trace.
+    
+    Messages which are never answered aren't finished, so they don't show up.
+    With a sampleRate of 0 nothing is traced and the only cost is checking it."""
+    def __init__(self, registry, sampleRate=0.0, slowThreshold=None, hook=None):
+        self.registry = registry
+        self.sampleRate = sampleRate #fraction of received messages which are traced
+        self.slowThreshold = slowThreshold
+        self.hook = hook
+        self._lock = threading.Lock() #traces are finished by every manager thread
+        self._slowTraces = collections.deque(maxlen=SLOW_TRACES)
+        self._total = registry.histogram("traceTotal")
+        registry.gauge("slowTraces", self.slowTraces)
+    
+    def sample(self):
+        """Returns whether the next message should be traced"""
+        return random.random() < self.sampleRate
+    
+    @staticmethod
+    def describe(trace):
+        """Returns a trace as a dictionary of its total time and the time each
+        stage was reached, relative to the first, in seconds"""
+        start = trace[0][1]
+        return { "total" : trace[-1][1] - start,
+                 "stages" : [(stage, when - start) for stage, when in trace] }
+    
+    def finish(self, trace):
+        """Records the times of a finished trace"""
+        total = trace[-1][1] - trace[0][1]
+        with self._lock:
+            for i in xrange(1, len(trace)):
+                self.registry.histogram("traceStage", stage=trace[i - 1][0] + "-" + trace[i][0]).observe(trace[i][1] - trace[i - 1][1])
+            self._total.observe(total)
+            if self.slowThreshold is not None and total >= self.slowThreshold:
+                self._slowTraces.append(Tracer.describe(trace))
+                logging.warning("Slow trace: " + repr(Tracer.describe(trace)))
+        if self.hook is not None:
+            self.hook(trace)
+    
+    def slowTraces(self):
+        """Returns the most recent slow traces, oldest first"""
+        with self._lock:
+            return list(self._slowTraces)
+
+def merge(snapshot, others, label):
+    """Adds the series of other snapshots, such as those of the socket worker
+    processes, to a snapshot taken by Registry.snapshot. others maps a value of
+    the given label to a snapshot, and each series taken from that snapshot is
+    labelled with it. The counter totals are added up again. Returns snapshot."""
+    for value in sorted(others):
+        for metricType in (Registry.TYPE_COUNTER, Registry.TYPE_GAUGE, Registry.TYPE_HISTOGRAM):
+            byName = snapshot.setdefault(metricType, {})
+            for name, metric in others[value].get(metricType, {}).items():
+                series = byName.setdefault(name, { "series" : [] })["series"]
+                for entry in metric["series"]:
+                    entry = dict(entry)
+                    entry["labels"] = dict(entry["labels"])
+                    entry["labels"][label] = str(value)
+                    series.append(entry)
+    for name, metric in snapshot.get(Registry.TYPE_COUNTER, {}).items():
+        metric["total"] = { "value" : sum(entry["value"] for entry in metric["series"]),
+                            "rate" : sum(entry["rate"] for entry in metric["series"]) }
+    return snapshot
@@ -1,6 +1,215 @@
 """Contains classes for dealing with process management for the WebSocketServer"""
 
 import threading
+import socket
+import select
+import struct
+import errno
+import collections
+import cPickle
+import Queue
+import time
+import WebSockets
+
+_MESSAGE_HEADER = struct.Struct("!IB") #length and kind at the start of every message written to a ServiceQueue
+_KIND_PICKLED = 0 #the message is a pickled object
+_KIND_TRANSACTION = 1 #the message is a WebSocketTransaction written by its encode()
+READ_SIZE = 65536 #number of bytes read from a ServiceQueue at a time
+
+def _waitReadable(sock, timeout):
+    """Waits up to timeout seconds, or forever if it is None, for a socket to be
+    readable and returns whether it is. poll is used where it is available since
+    select can't take descriptors above FD_SETSIZE, which a service forked while
+    the server holds many connections inherits."""
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock.fileno(), select.POLLIN)
+        return len(poller.poll(None if timeout is None else timeout * 1000)) > 0
+    r, w, x = select.select([sock], [], [], timeout)
+    return len(r) > 0
+
+class ServiceQueue:
+    """One way channel which carries WebSocketTransactions between the server and
+    a service process. It replaces a multiprocessing.Manager queue, which sends
+    every call through a proxy to a separate manager process, with a Unix socket
+    pair shared directly by the two processes. Each object is written with a
+    length prefix. WebSocketTransactions are written with their own compact
+    encoding and anything else is pickled.
+    
+    The queue is created before the service process is started so that both
+    processes hold it. Only one of them should ever put and only the other
+    should ever get. The reading end is selectable through fileno().
+    
+    Queues written by the server should be created with bufferedWrites set. put()
+    then never blocks: anything the socket won't take right away is kept until
+    flush() is called. Otherwise put() blocks until the object is written.
+    
+    putMany() and getMany() move a whole batch of objects with one write and
+    one lock instead of one for every object."""
+    def __init__(self, bufferedWrites=False):
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(0)
+        self._bufferedWrites = bufferedWrites
+        if bufferedWrites:
+            self._writer.setblocking(0)
+        self._readLock = threading.Lock()
+        self._writeLock = threading.Lock()
+        self._readBuffer = bytearray()
+        self._received = collections.deque() #objects read and decoded but not yet returned by get
+        self._writeBuffer = bytearray()
+    
+    def fileno(self):
+        """Returns the descriptor which is readable when there is something to get"""
+        return self._reader.fileno()
+    
+    def writerFileno(self):
+        """Returns the descriptor which objects are written to"""
+        return self._writer.fileno()
+    
+    @staticmethod
+    def _encode(obj):
+        """Returns an object as it is written to the socket, header included"""
+        if isinstance(obj, WebSockets.WebSocketTransaction):
+            data = obj.encode()
+            return _MESSAGE_HEADER.pack(len(data), _KIND_TRANSACTION) + data
+        data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+        return _MESSAGE_HEADER.pack(len(data), _KIND_PICKLED) + data
+    
+    def _write(self, data):
+        """Writes encoded objects, buffering them or blocking as the queue was created to"""
+        with self._writeLock:
+            if self._bufferedWrites:
+                self._writeBuffer += data
+                self._flush()
+            else:
+                self._writer.sendall(data)
+    
+    def put(self, obj, block=True, timeout=None):
+        """Puts an object into the queue. The block and timeout arguments are only
+        accepted for compatibility with Queue.Queue since the queue is never full."""
+        self._write(ServiceQueue._encode(obj))
+    
+    def put_nowait(self, obj):
+        """Puts an object into the queue"""
+        self.put(obj, False)
+    
+    def putMany(self, objs):
+        """Puts every object of a list into the queue in order with a single write"""
+        if objs:
+            self._write("".join([ServiceQueue._encode(obj) for obj in objs]))
+    
+    def hasPendingWrites(self):
+        """Returns whether some put objects are still waiting for flush()"""
+        return len(self._writeBuffer) > 0
+    
+    def pendingBytes(self):
+        """Returns the number of bytes of put objects still waiting for flush()"""
+        return len(self._writeBuffer)
+    
+    def flush(self):
+        """Writes as much of the buffered objects as the socket will take. Returns
+        whether everything has been written."""
+        with self._writeLock:
+            return self._flush()
+    
+    def _flush(self):
+        """Writes buffered data while holding the write lock"""
+        try:
+            while self._writeBuffer:
+                nSent = self._writer.send(self._writeBuffer)
+                del self._writeBuffer[:nSent]
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise
+        return not self._writeBuffer
+    
+    def _read(self):
+        """Reads whatever is available without blocking and decodes every complete
+        object. Returns whether anything was read."""
+        try:
+            data = self._reader.recv(READ_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return False
+            raise
+        if not data:
+            raise EOFError("The other end of the service queue was closed")
+        self._readBuffer += data
+        offset = 0
+        available = len(self._readBuffer)
+        while available - offset >= _MESSAGE_HEADER.size:
+            length, kind = _MESSAGE_HEADER.unpack_from(self._readBuffer, offset)
+            start = offset + _MESSAGE_HEADER.size
+            end = start + length
+            if end > available:
+                break #the rest of this one hasn't arrived yet
+            if kind == _KIND_TRANSACTION:
+                self._received.append(WebSockets.WebSocketTransaction.decode(self._readBuffer, start, end))
+            else:
+                self._received.append(cPickle.loads(str(buffer(self._readBuffer, start, length))))
+            offset = end
+        del self._readBuffer[:offset]
+        return True
+    
+    def _wait(self, block, timeout):
+        """Reads until something has been received while holding the read lock.
+        Returns whether anything is waiting to be returned."""
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._received:
+            if not self._read():
+                if not block:
+                    return False
+                remaining = None if deadline is None else max(deadline - time.time(), 0)
+                try:
+                    if not _waitReadable(self._reader, remaining):
+                        return False
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+        return True
+    
+    def get(self, block=True, timeout=None):
+        """Removes and returns an object from the queue. Raises Queue.Empty if
+        nothing is available before the timeout or right away when not blocking."""
+        with self._readLock:
+            if not self._wait(block, timeout):
+                raise Queue.Empty
+            return self._received.popleft()
+    
+    def get_nowait(self):
+        """Removes and returns an object from the queue or raises Queue.Empty"""
+        return self.get(False)
+    
+    def getMany(self, maxCount=None, block=True, timeout=None):
+        """Removes and returns a list of every object which has arrived, oldest
+        first and at most maxCount of them. Blocks like get() until there is at
+        least one, but returns an empty list rather than raising Queue.Empty."""
+        with self._readLock:
+            if not self._wait(block, timeout):
+                return []
+            while (maxCount is None or len(self._received) < maxCount) and self._read():
+                pass #take whatever else has already arrived
+            received = self._received
+            if maxCount is None or len(received) <= maxCount:
+                self._received = collections.deque()
+                return list(received)
+            return [received.popleft() for i in xrange(maxCount)]
+    
+    def empty(self):
+        """Returns whether there is nothing to get right now"""
+        with self._readLock:
+            if not self._received:
+                self._read()
+            return not self._received
+    
+    def task_done(self):
+        """Only here for compatibility with Queue.Queue. Nothing is tracked."""
+        pass
+    
+    def close(self):
+        """Closes both ends of the queue. Nothing can be put or got afterwards."""
+        self._reader.close()
+        self._writer.close()
 
 class ProcessDirectory:
     """Class which is used to store processes in a "directory" tree. When a process
@@ -9,31 +218,151 @@ class ProcessDirectory:
     server to re-start the process. The ProcessDirectory class is safe for multithreading
     but not for multiprocessing."""
     
-    class ProcessRecord:
-        """Holds data for a process"""
+    class WorkerRecord:
+        """Holds data for a single worker process of a service"""
         def __init__(self, process, sendQueue, recvQueue):
             self.process = process
             self.sendQueue = sendQueue
             self.recvQueue = recvQueue
         
         def is_alive(self):
-            """Returns whether or not the associated process is still alive"""
+            """Returns whether or not the worker process is still alive"""
             return self.process.is_alive()
+        
+        def close(self):
+            """Closes the queues of the worker once it has died"""
+            self.sendQueue.close()
+            self.recvQueue.close()
+    
+    class ProcessRecord:
+        """Holds data for a service, which is run by a pool of one or more worker
+        processes. Each socket is assigned to a worker by hashing its id so that
+        everything from one socket is handled by the same worker in order. The
+        process, sendQueue and recvQueue attributes are those of the first worker.
+        
+        factory is a method which starts a new worker and returns its (process,
+        sendQueue, recvQueue). Without one the pool can't grow or replace workers.
+        streaming is whether the service takes large messages in parts as they arrive.
+        name is the path of the service, which its metrics are labelled with."""
+        def __init__(self, process, sendQueue, recvQueue, factory=None, streaming=False, name=None):
+            self.id = process.pid #sockets refer to the service by this id, even after workers are replaced
+            self.name = name if name is not None else str(self.id)
+            self.factory = factory
+            self.streaming = streaming
+            self.restarts = 0 #number of workers which have been replaced
+            self.workers = []
+            self._replacing = set() #positions of dead workers whose replacement has been started but not swapped in
+            self._addWorker(ProcessDirectory.WorkerRecord(process, sendQueue, recvQueue))
+        
+        def _addWorker(self, worker):
+            """Adds a worker to the end of the pool"""
+            self.workers.append(worker)
+            self._updateFirstWorker()
+        
+        def _updateFirstWorker(self):
+            """Points the process, sendQueue and recvQueue attributes at the first worker"""
+            self.process = self.workers[0].process
+            self.sendQueue = self.workers[0].sendQueue
+            self.recvQueue = self.workers[0].recvQueue
+        
+        def addWorkers(self, count):
+            """Starts count more workers using the factory"""
+            for i in xrange(count):
+                self._addWorker(ProcessDirectory.WorkerRecord(*self.factory()))
+        
+        def getWorker(self, socketId):
+            """Returns the worker which handles the given socket"""
+            return self.workers[hash(socketId) % len(self.workers)]
+        
+        def is_alive(self):
+            """Returns whether or not any of the worker processes is still alive or
+            a replacement for one of them has been started"""
+            if self._replacing:
+                return True
+            for worker in self.workers:
+                if worker.is_alive():
+                    return True
+            return False
+        
+        def deadWorkers(self):
+            """Returns the positions in the pool of the workers which have died and
+            aren't being replaced yet. A service with no live workers left is not
+            restarted; the server removes it instead."""
+            if self.factory is None or not self.is_alive():
+                return []
+            return [i for i in xrange(len(self.workers)) if i not in self._replacing and not self.workers[i].is_alive()]
+        
+        def startReplacement(self, position):
+            """Starts a worker to take the place of the dead worker at the given
+            position and returns its WorkerRecord. The replacement only handles
+            sockets once replaceWorker swaps it in, and until then the position
+            isn't returned by deadWorkers again."""
+            self._replacing.add(position)
+            print "Notice: Worker", self.workers[position].process.pid, "of service", self.name, "died. Replacing it."
+            return ProcessDirectory.WorkerRecord(*self.factory())
+        
+        def replaceWorker(self, position, worker):
+            """Swaps a worker started by startReplacement into its place in the pool
+            so sockets keep going to the same position. Returns the dead worker."""
+            dead = self.workers[position]
+            self.workers[position] = worker
+            self._replacing.discard(position)
+            self.restarts += 1
+            self._updateFirstWorker()
+            return dead
+        
+        def close(self):
+            """Closes the queues of every worker once the service has been removed"""
+            for worker in self.workers:
+                worker.close()
     
-    def __init__(self):
-        """Creates a new process directory"""
+    def __init__(self, parent=None):
+        """Creates a new process directory. parent is the directory this one is inside of."""
         self._directoryLock = threading.Lock()
         self._directories = {} #additional directories after this one are stored here
         self._processes = {} #processes in this directory
+        self._parent = parent
+        self._generation = 0 #only used by the root directory. incremented whenever a process is added or removed
+        self._listeners = [] #only used by the root directory. called whenever a process is added or removed
+        self._listenerLock = threading.Lock()
+    
+    def _membershipChanged(self):
+        """Records that a process was added or removed somewhere in the directory
+        tree and informs the listeners of the root directory"""
+        if self._parent is not None:
+            self._parent._membershipChanged()
+            return
+        with self._listenerLock:
+            self._generation += 1
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+    
+    def getGeneration(self):
+        """Returns a number which changes whenever a process is added to or removed
+        from this directory or any directory inside it. Anything cached from
+        getAllProcesses is still valid as long as this number is the same."""
+        if self._parent is not None:
+            return self._parent.getGeneration()
+        return self._generation
+    
+    def addListener(self, callback):
+        """Adds a method which is called with no arguments whenever a process is
+        added to or removed from this directory or any directory inside it"""
+        if self._parent is not None:
+            self._parent.addListener(callback)
+            return
+        with self._listenerLock:
+            self._listeners.append(callback)
     
     def getAllProcesses(self):
         """Returns a dictionary containing all the processes in this directory mapped to their
-        process ids and the children processes"""
+        service ids and the children processes"""
         ret = {}
         with self._directoryLock:
             for name in self._processes:
                 #add our processes
-                ret[self._processes[name].process.pid] = self._processes[name]
+                ret[self._processes[name].id] = self._processes[name]
             for d in self._directories:
                 #add our children's processes
                 ret.update(self._directories[d].getAllProcesses())
@@ -45,13 +374,14 @@ class ProcessDirectory:
             return self._directories[name]
         else:
             #we want to create a new empty one just in case they are using this as a way to create a directory
-            self._directories[name] = ProcessDirectory()
+            self._directories[name] = ProcessDirectory(self)
             return self._directories[name]
     
     def findProcess(self, name):
         """Finds a named process. Returns None if no process is found under the
         given name"""
         ret = None
+        removed = False
         with self._directoryLock:
             if name in self._processes:
                 #check to make sure it is running
@@ -60,6 +390,9 @@ class ProcessDirectory:
                 else:
                     #it isn't running, so remove it from our list so it might be garbage collected later
                     self._processes.pop(name)
+                    removed = True
+        if removed:
+            self._membershipChanged()
         return ret
     
     def addProcess(self, name, processRecord):
@@ -72,6 +405,8 @@ class ProcessDirectory:
                 ret = False
             else:
                 self._processes[name] = processRecord
+        if ret:
+            self._membershipChanged()
         return ret
     
     def joinAll(self):
@@ -80,8 +415,10 @@ class ProcessDirectory:
         with self._directoryLock:
             for d in self._directories:
                 #tell our children to join
-                d.joinAll()
+                self._directories[d].joinAll()
             for proc in self._processes:
-                #wait for the process to join
-                self._processes[proc].process.shutdownFlag.set()
-                self._processes[proc].process.join()
+                #wait for the processes to join
+                for worker in self._processes[proc].workers:
+                    worker.process.shutdownFlag.set()
+                for worker in self._processes[proc].workers:
+                    worker.process.join()
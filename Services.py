@@ -1,19 +1,301 @@
 """Some basic classes for services to use for implementation"""
 
 import multiprocessing
+import os
+import time
+import heapq
+
+import WebSockets
+from WebSockets import WebSocketTransaction
 
 class Service(multiprocessing.Process):
     """Base class for all services.
     
-    Services should implement a run() method which is an extension of the Process
-    class. In this method there should be a main loop which exits when the shutdownflag
-    is set. The service should constantly watch the clientConnQueue since this is
-    where clients will enter the service from. The clients are of the class WebSocketClient"""
+    Services may implement their own run() method which is an extension of the
+    Process class. In this method there should be a main loop which exits when the
+    shutdownflag is set. The service should constantly watch the recvQueue since
+    this is where clients will enter the service from.
+    
+    Alternately, the default run() method dispatches everything received to the
+    onConnect, onMessage and onClose methods, which services override instead. It
+    blocks on the recvQueue while there is nothing to do and handles received
+    transactions in batches. Methods scheduled with callLater or callEvery are
+    called from the same loop, so no locking is needed between them and the
+    handlers. Whatever the handlers send is held and written to the sendQueue
+    in one batch once the received batch has been handled, or once SEND_BATCH
+    transactions are waiting. Setting SEND_FLUSH_DELAY holds them a little
+    longer so that more go in each write. Anything put directly in the sendQueue
+    is written right away, ahead of whatever is being held.
+    
+    A service can be run by a pool of worker processes by setting POOL_SIZE.
+    Each socket is always handled by the same worker, so the order of its
+    transactions is kept, but workers don't share any state with each other.
+    
+    A service which sets STREAMING is handed messages in parts as they arrive
+    instead of whole, so that very large messages never have to be held in
+    memory at once. The default run() method calls onMessagePart for these."""
+    POOL_SIZE = 1 #number of worker processes started for the service
+    STREAMING = False #whether received messages are handed over in parts
+    DISPATCH_TIMEOUT = 0.5 #maximum seconds to wait for a transaction before checking the shutdown flag
+    DISPATCH_BATCH = 256 #maximum number of transactions handled before checking the timers again
+    SEND_BATCH = 256 #maximum number of transactions the default run() method holds before writing them
+    SEND_FLUSH_DELAY = 0.0 #seconds the default run() method holds sent transactions to gather a larger batch
     def __init__(self, sendQueue, recvQueue):
         multiprocessing.Process.__init__(self)
         self.sendQueue = sendQueue
         self.recvQueue = recvQueue
         self.shutdownFlag = multiprocessing.Event()
+        self._timers = [] #heap of (due time, timer id, interval or None, callback, args)
+        self._scheduledTimers = set() #ids of the timers in the heap
+        self._cancelledTimers = set() #ids of scheduled timers which are not to be called
+        self._currentTimerId = 0
+        self._trace = None #trace of the transaction being dispatched if it is traced
+        self._outgoing = None #transactions held by the default run() method, or None while they are written right away
+        self._outgoingStarted = 0 #time the first held transaction was sent
+    
+    def _put(self, transaction):
+        """Writes a transaction to the sendQueue or holds it for the next batch"""
+        if self._outgoing is None:
+            self.sendQueue.put(transaction)
+            return
+        if not self._outgoing:
+            self._outgoingStarted = time.time()
+        self._outgoing.append(transaction)
+        if len(self._outgoing) >= self.SEND_BATCH:
+            self.flush()
+    
+    def flush(self):
+        """Writes every held transaction to the sendQueue"""
+        if self._outgoing:
+            outgoing = self._outgoing
+            self._outgoing = []
+            self.sendQueue.putMany(outgoing)
+    
+    def send(self, socketId, data, binary=False):
+        """Sends a string to a socket. If binary is true the string is sent as
+        raw bytes in a binary message."""
+        self._put(WebSocketTransaction(WebSocketTransaction.TRANSACTION_DATA, socketId, data, binary=binary, trace=self._answerTrace()))
+    
+    def broadcast(self, targets, data, binary=False):
+        """Sends a string to every socket in a list of socket ids or a named group"""
+        self._put(WebSocketTransaction(WebSocketTransaction.TRANSACTION_BROADCAST, targets, data, binary=binary, trace=self._answerTrace()))
+    
+    def joinGroup(self, socketId, name):
+        """Adds a socket to a named group which the server keeps for broadcasts"""
+        self._put(WebSocketTransaction(WebSocketTransaction.TRANSACTION_JOINGROUP, socketId, name))
+    
+    def leaveGroup(self, socketId, name):
+        """Removes a socket from a named group"""
+        self._put(WebSocketTransaction(WebSocketTransaction.TRANSACTION_LEAVEGROUP, socketId, name))
+    
+    def _answerTrace(self):
+        """Returns the trace for something sent while a traced transaction is being
+        dispatched, so that the answer is followed back to the socket, or None"""
+        if self._trace is None:
+            return None
+        return self._trace + [(WebSockets.TRACE_ANSWERED, time.time())]
+    
+    def close(self, socketId):
+        """Closes a socket"""
+        self._put(WebSocketTransaction(WebSocketTransaction.TRANSACTION_CLOSE, socketId, None))
+    
+    def callLater(self, delay, callback, *args):
+        """Schedules callback to be called with args after delay seconds. Returns
+        a timer id which can be passed to cancelTimer."""
+        return self._schedule(time.time() + delay, None, callback, args)
+    
+    def callEvery(self, interval, callback, *args):
+        """Schedules callback to be called with args every interval seconds until
+        it is cancelled. Returns a timer id which can be passed to cancelTimer."""
+        return self._schedule(time.time() + interval, interval, callback, args)
+    
+    def cancelTimer(self, timerId):
+        """Stops a timer from being called. Ids of timers which have already
+        fired or been cancelled are ignored."""
+        if timerId in self._scheduledTimers:
+            self._cancelledTimers.add(timerId)
+    
+    def _schedule(self, due, interval, callback, args):
+        """Adds a timer to the heap and returns its id"""
+        timerId = self._currentTimerId
+        self._currentTimerId += 1
+        heapq.heappush(self._timers, (due, timerId, interval, callback, args))
+        self._scheduledTimers.add(timerId)
+        return timerId
+    
+    def _runTimers(self):
+        """Calls every timer which is due and returns the seconds until the next one or None"""
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            due, timerId, interval, callback, args = heapq.heappop(self._timers)
+            if timerId in self._cancelledTimers:
+                self._cancelledTimers.discard(timerId)
+                self._scheduledTimers.discard(timerId)
+                continue
+            if interval is not None:
+                heapq.heappush(self._timers, (due + interval, timerId, interval, callback, args))
+            else:
+                self._scheduledTimers.discard(timerId)
+            callback(*args)
+        if self._timers:
+            return max(self._timers[0][0] - time.time(), 0)
+        return None
+    
+    def onConnect(self, socketId, address):
+        """Called by the default run() method when a new socket connects to the service"""
+        pass
+    
+    def onMessage(self, socketId, data):
+        """Called by the default run() method when a socket sends something. Text
+        messages arrive as unicode and binary messages as a str of raw bytes."""
+        pass
+    
+    def onMessagePart(self, socketId, data, final):
+        """Called by the default run() method of a STREAMING service for each part
+        of a message a socket sends. final is true for the last part."""
+        pass
+    
+    def onBackpressure(self, socketId, congested):
+        """Called by the default run() method when the data waiting to be sent to a
+        socket reaches its high water mark (congested is true) and again once it
+        drains below the low water mark (congested is false). A service can use
+        this to send less to slow sockets."""
+        pass
+    
+    def onClose(self, socketId):
+        """Called by the default run() method when a socket has been closed"""
+        pass
+    
+    def dispatch(self, transaction):
+        """Calls the handler for a received transaction. While a traced transaction
+        is handled, whatever send and broadcast send carries on its trace."""
+        self._trace = transaction.trace
+        if self._trace is not None:
+            self._trace.append((WebSockets.TRACE_DISPATCHED, time.time()))
+        if transaction.transactionType == WebSocketTransaction.TRANSACTION_DATA:
+            if self.STREAMING:
+                self.onMessagePart(transaction.socketId, transaction.data, transaction.final)
+            else:
+                self.onMessage(transaction.socketId, transaction.data)
+        elif transaction.transactionType == WebSocketTransaction.TRANSACTION_NEWSOCKET:
+            self.onConnect(transaction.socketId, transaction.data)
+        elif transaction.transactionType == WebSocketTransaction.TRANSACTION_CLOSE:
+            self.onClose(transaction.socketId)
+        elif transaction.transactionType == WebSocketTransaction.TRANSACTION_BACKPRESSURE:
+            self.onBackpressure(transaction.socketId, transaction.data)
+        self._trace = None
+    
+    def run(self):
+        """Default main loop which dispatches received transactions to the handlers
+        and calls timers until the shutdown flag is set"""
+        self._outgoing = []
+        try:
+            while self.shutdownFlag.is_set() == False:
+                untilTimer = self._runTimers()
+                timeout = self.DISPATCH_TIMEOUT if untilTimer is None else min(untilTimer, self.DISPATCH_TIMEOUT)
+                if self._outgoing:
+                    timeout = min(timeout, max(self._outgoingStarted + self.SEND_FLUSH_DELAY - time.time(), 0))
+                for transaction in self.recvQueue.getMany(self.DISPATCH_BATCH, True, timeout):
+                    self.dispatch(transaction)
+                if self._outgoing and time.time() >= self._outgoingStarted + self.SEND_FLUSH_DELAY:
+                    self.flush()
+            self.flush()
+        except KeyboardInterrupt:
+            pass
+        self._outgoing = None
+
+
+class PubSub:
+    """Topics which the sockets of a service subscribe to. Each topic is a group
+    kept by the server, so publishing to a topic puts a single broadcast in the
+    sendQueue: the data is serialized and framed once and no Python code runs
+    for each subscriber, however many there are.
+    
+    The subscribers of each topic are also tracked here so that they can be
+    counted and listed. subscribers() returns a snapshot which stays the same
+    while sockets subscribe and unsubscribe.
+    
+    Topics are local to the worker process using them. The names of their
+    groups start with the process id so that they can't collide with the
+    groups of other services."""
+    def __init__(self, service):
+        self.service = service
+        self._topics = {} #topic -> set of subscribed socket ids
+        self._socketTopics = {} #socket id -> set of topics it is subscribed to
+    
+    @staticmethod
+    def _group(topic):
+        """Returns the name of the server group of a topic"""
+        return "pubsub:%d:%s" % (os.getpid(), topic)
+    
+    def subscribe(self, socketId, topic):
+        """Subscribes a socket to a topic. Returns False if it already was."""
+        members = self._topics.setdefault(topic, set())
+        if socketId in members:
+            return False
+        members.add(socketId)
+        self._socketTopics.setdefault(socketId, set()).add(topic)
+        self.service.joinGroup(socketId, PubSub._group(topic))
+        return True
+    
+    def unsubscribe(self, socketId, topic):
+        """Unsubscribes a socket from a topic. Returns False if it wasn't subscribed."""
+        if not self._forget(socketId, topic):
+            return False
+        self.service.leaveGroup(socketId, PubSub._group(topic))
+        return True
+    
+    def _forget(self, socketId, topic):
+        """Removes a socket from a topic here only. Returns whether it was there."""
+        members = self._topics.get(topic)
+        if members is None or socketId not in members:
+            return False
+        members.discard(socketId)
+        if not members:
+            del self._topics[topic]
+        topics = self._socketTopics[socketId]
+        topics.discard(topic)
+        if not topics:
+            del self._socketTopics[socketId]
+        return True
+    
+    def unsubscribeAll(self, socketId):
+        """Unsubscribes a socket from every topic and returns those topics"""
+        topics = list(self._socketTopics.get(socketId, ()))
+        for topic in topics:
+            self.unsubscribe(socketId, topic)
+        return topics
+    
+    def forget(self, socketId):
+        """Forgets a socket which has been closed and returns the topics it was
+        subscribed to. The server has already taken it out of the groups."""
+        topics = list(self._socketTopics.get(socketId, ()))
+        for topic in topics:
+            self._forget(socketId, topic)
+        return topics
+    
+    def publish(self, topic, data, binary=False):
+        """Sends a string to every subscriber of a topic. Returns the number of
+        subscribers it was sent to."""
+        count = len(self._topics.get(topic, ()))
+        if count:
+            self.service.broadcast(PubSub._group(topic), data, binary)
+        return count
+    
+    def count(self, topic):
+        """Returns the number of subscribers of a topic"""
+        return len(self._topics.get(topic, ()))
+    
+    def subscribers(self, topic):
+        """Returns a frozenset of the socket ids subscribed to a topic"""
+        return frozenset(self._topics.get(topic, ()))
+    
+    def topics(self, socketId=None):
+        """Returns a list of the topics with subscribers, or of the topics a
+        socket is subscribed to"""
+        if socketId is None:
+            return self._topics.keys()
+        return list(self._socketTopics.get(socketId, ()))
 
 
 class Subscribable:
@@ -80,10 +362,9 @@ class Subscribable:
         return ret
     
     def sendEvent(self, event):
-        """Sends the passed events to all the subscribed objects"""
-        for o in self.subscribers:
-            self.subscribers[o].callback(event)
-        for o in self.silentSubscribers:
-            self.silentSubscribers[o].callback(event)
+        """Sends the passed events to all the subscribed objects. Subscribers may
+        subscribe and unsubscribe from their callbacks."""
+        for subscriber in self.subscribers.values() + self.silentSubscribers.values():
+            subscriber.callback(event)
 
 
@@ -8,34 +8,351 @@ import Processes
 import ConfigParser
 import imp
 import threading
-import multiprocessing
 import WebSockets
 import sys
 import getopt
+import time
+import errno
+import collections
+import os
+import json
+import Metrics
+import multiprocessing
 
 HTTP_METHOD = "GET"
 HTTP_VERSION = "HTTP/1.1"
+HTTP_OK = "200 OK\r\n"
 HTTP_BAD_REQUEST = "400 Bad Request\r\n"
 HTTP_NOT_FOUND = "404 Not Found\r\n"
 HTTP_METHOD_NOT_ALLOWED = "405 Method Not Allowed\r\n" 
 HTTP_SERVER_ERROR = "500 Internal Server Error\r\n"
 HTTP_NOT_IMPLEMENTED = "501 Not Implemented\r\n"
+HTTP_HEADERS_TOO_LARGE = "431 Request Header Fields Too Large\r\n"
 WEBSOCKET_VERSION = "13"
 WEBSOCKET_MAGIC_HANDSHAKE_STRING = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 SERVICE_INDEX_NAME = "ws_service.py"
+DEFAULT_BACKLOG = 128 #listen backlog when none is configured
+DEFAULT_HANDSHAKE_TIMEOUT = 10.0 #seconds a client has to finish its handshake when none is configured
+DEFAULT_MAX_HEADER_SIZE = 8192 #largest request header accepted when none is configured
+ACCEPT_BATCH = 64 #maximum number of clients accepted each time the listening socket is ready
+DEFAULT_NEGATIVE_CACHE_SIZE = 1024 #number of paths without a service which are remembered when none is configured
+DEFAULT_NEGATIVE_CACHE_TTL = 30.0 #seconds a path without a service is remembered when none is configured
+DEFAULT_DEFLATE_LEVEL = 6 #zlib compression level for permessage-deflate when none is configured
+DEFAULT_DEFLATE_MEM_LEVEL = 8 #zlib memory level (1-9) of each compressor when none is configured
+DEFAULT_DEFLATE_WINDOW_BITS = 15 #largest compression window (9-15 bits) when none is configured
+DEFAULT_STATS_PATH = "" #path which answers with the server statistics when none is configured. empty turns it off
+DEFAULT_TRACE_SAMPLE_RATE = 0.0 #fraction of received messages traced through the server when none is configured
+DEFAULT_TRACE_SLOW_THRESHOLD = 0.1 #seconds after which a trace is kept and logged as slow when none is configured
 
 class WebSocketServer:
     """Encapsulates a websocketserver"""
-    def __init__(self, overridePort=None, overrideHost=None, overrideDocRoot=None):
+    
+    class HandshakePipeline:
+        """Accepts clients on a listening socket and performs their handshakes
+        without ever blocking on a single client. Clients are accepted in batches
+        and their request headers are read as they arrive, so a slow or silent
+        client only holds up itself. Services which aren't running yet are
+        loaded and started by the ServiceStarter while the pipeline carries on
+        with other clients. Clients which don't finish their handshake in time
+        are disconnected. Finished upgrades are handed to the WebSocketManager.
+        In a socket worker process the server process is asked for the
+        services instead.
+        
+        A plain GET of the stats path from the local machine is answered with
+        the server statistics as JSON instead of a handshake."""
+        
+        class PendingHandshake:
+            """Holds data about a client whose handshake is in progress"""
+            def __init__(self, conn, addr, deadline):
+                self.connection = conn
+                self.address = addr
+                self.fileno = conn.fileno()
+                self.accepted = time.time()
+                self.deadline = deadline
+                self.request = bytearray()
+                self.response = None
+                self.close = False
+                self.serviceRecord = None
+                self.deflate = None #PerMessageDeflate if compression was negotiated
+                self.stats = False #whether this is a request for the statistics rather than a handshake
+                self.done = False
+        
+        def __init__(self, server, listener, timeout, maxHeaderSize, index=0):
+            """Initializes a pipeline for the given WebSocketServer and listening
+            socket. index labels the metrics of the pipeline."""
+            self.server = server
+            self.listener = listener
+            self.listener.setblocking(0)
+            self.timeout = timeout
+            self.maxHeaderSize = maxHeaderSize
+            self._poller = WebSockets.EventPoller()
+            self._poller.register(listener.fileno(), WebSockets.EventPoller.EVENT_READ)
+            self._pending = {} #file descriptor -> PendingHandshake
+            self._deadlines = collections.deque() #handshakes in the order they were accepted, which is also deadline order
+            self._completions = collections.deque() #(PendingHandshake, method, result) worked out for handshakes by other threads
+            self._waker = WebSockets.EventWaker()
+            self._poller.register(self._waker.fileno(), WebSockets.EventPoller.EVENT_READ)
+            label = str(index)
+            self.accepted = server.metrics.counter("connectionsAccepted", acceptor=label)
+            self.upgraded = server.metrics.counter("handshakesUpgraded", acceptor=label)
+            self.rejected = server.metrics.counter("handshakesRejected", acceptor=label)
+            self.timedOut = server.metrics.counter("handshakesTimedOut", acceptor=label)
+            self.handshakeTime = server.metrics.histogram("handshakeTime", acceptor=label) #seconds from accepting a client to handing it to the manager
+            server.metrics.gauge("pendingHandshakes", lambda: len(self._pending), acceptor=label)
+        
+        def run(self):
+            """Handles clients until the server is shut down"""
+            while self.server.shutdownEvent.is_set() == False:
+                for fd, events in self._poller.poll(WebSockets.POLL_TIMEOUT):
+                    if fd == self.listener.fileno():
+                        self._accept()
+                        continue
+                    if fd == self._waker.fileno():
+                        self._waker.drain()
+                        self._finishWaiting()
+                        continue
+                    handshake = self._pending.get(fd)
+                    if handshake is None:
+                        continue #finished earlier in this pass
+                    if events & WebSockets.EventPoller.EVENT_WRITE:
+                        self._write(handshake)
+                    elif events & (WebSockets.EventPoller.EVENT_READ | WebSockets.EventPoller.EVENT_ERROR):
+                        self._read(handshake)
+                self._expire()
+        
+        def _accept(self):
+            """Accepts every waiting client, up to ACCEPT_BATCH of them"""
+            for i in xrange(ACCEPT_BATCH):
+                try:
+                    conn, addr = self.listener.accept()
+                except socket.error as e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        print "Unable to accept a client:", e
+                    break
+                conn.setblocking(0)
+                self.accepted.inc()
+                print "Client connected from", addr
+                handshake = WebSocketServer.HandshakePipeline.PendingHandshake(conn, addr, time.time() + self.timeout)
+                self._pending[handshake.fileno] = handshake
+                self._deadlines.append(handshake)
+                self._poller.register(handshake.fileno, WebSockets.EventPoller.EVENT_READ)
+        
+        def _read(self, handshake):
+            """Reads more of a client's request and answers it once the headers are complete"""
+            try:
+                data = handshake.connection.recv(WebSockets.BUFFER_SIZE)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self._finish(handshake, False)
+                return
+            if not data:
+                #they gave up on us
+                self._finish(handshake, False)
+                return
+            handshake.request += data
+            end = handshake.request.find("\r\n\r\n")
+            if end < 0:
+                if len(handshake.request) > self.maxHeaderSize:
+                    handshake.response = HTTP_VERSION + " " + HTTP_HEADERS_TOO_LARGE + "\r\n"
+                    handshake.close = True
+                    self._respond(handshake)
+                return
+            request = str(handshake.request[:end + 4])
+            if self.server.isStatsRequest(request, handshake.address):
+                self.server.serviceStarter.stats(self._wait(handshake, self._answerStats))
+                return
+            handshake.response, location = self.server.parseRequest(request)
+            if handshake.response is not None:
+                handshake.close = True
+                self._respond(handshake)
+                return
+            found, service = self.server.findService(location)
+            if not found:
+                #loading or starting it could take a while, so it isn't done here
+                self.server.serviceStarter.resolve(location, self._wait(handshake, lambda handshake, service: self._upgrade(handshake, request, service)))
+                return
+            self._upgrade(handshake, request, service)
+        
+        def _upgrade(self, handshake, request, service):
+            """Answers a handshake now that its service has been looked up"""
+            handshake.response, handshake.close, handshake.serviceRecord, handshake.deflate = self.server.upgrade(request, service)
+            self._respond(handshake)
+        
+        def _answerStats(self, handshake, stats):
+            """Answers a request for the statistics"""
+            handshake.response = self.server.statsResponse(stats)
+            handshake.stats = True
+            handshake.close = True
+            self._respond(handshake)
+        
+        def _wait(self, handshake, method):
+            """Stops watching a client while something it needs is worked out by
+            another thread. Returns the callback which that thread calls with the
+            result, after which method is called with the handshake and the
+            result by the pipeline's own thread."""
+            self._poller.unregister(handshake.fileno)
+            def complete(result):
+                self._completions.append((handshake, method, result))
+                self._waker.wake()
+            return complete
+        
+        def _finishWaiting(self):
+            """Carries on with the handshakes whose results have been worked out,
+            unless they timed out in the meantime"""
+            while self._completions:
+                handshake, method, result = self._completions.popleft()
+                if handshake.done:
+                    continue
+                self._poller.register(handshake.fileno, WebSockets.EventPoller.EVENT_READ)
+                method(handshake, result)
+        
+        def _respond(self, handshake):
+            """Starts sending the response to a client"""
+            self._poller.modify(handshake.fileno, WebSockets.EventPoller.EVENT_WRITE)
+            self._write(handshake)
+        
+        def _write(self, handshake):
+            """Sends more of the response and finishes the handshake once it is all sent"""
+            try:
+                nSent = handshake.connection.send(handshake.response)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self._finish(handshake, False)
+                return
+            handshake.response = handshake.response[nSent:]
+            if handshake.response:
+                return #wait until the client can take the rest
+            if handshake.close and not handshake.stats:
+                print "Invalid request from", handshake.address
+                self.rejected.inc()
+            self._finish(handshake, not handshake.close)
+        
+        def _finish(self, handshake, upgraded):
+            """Stops handling a client. Upgraded clients are handed to the manager
+            and linked to their service, others are disconnected."""
+            self._poller.unregister(handshake.fileno)
+            self._pending.pop(handshake.fileno, None)
+            handshake.done = True
+            if upgraded:
+                #the manager will tell the service about it
+                self.upgraded.inc()
+                self.handshakeTime.observe(time.time() - handshake.accepted)
+                WebSockets.WebSocketClient(self.server.webSocketManager, handshake.connection, handshake.address, handshake.serviceRecord.id, handshake.serviceRecord.streaming, handshake.deflate)
+            else:
+                handshake.connection.close()
+        
+        def _expire(self):
+            """Disconnects clients whose handshake has taken too long"""
+            now = time.time()
+            while self._deadlines and (self._deadlines[0].done or self._deadlines[0].deadline <= now):
+                handshake = self._deadlines.popleft()
+                if not handshake.done:
+                    print "Handshake timed out for", handshake.address
+                    self.timedOut.inc()
+                    self._finish(handshake, False)
+    
+    class ServiceStarter(threading.Thread):
+        """Thread which loads and starts services and replaces their dead
+        workers, so that importing a service or forking a worker never holds up
+        a HandshakePipeline or the switchboard. Services which clients ask for
+        are looked up as soon as they are requested, and so are the statistics.
+        Every WORKER_CHECK_INTERVAL seconds it starts a replacement for each
+        dead worker and hands it to the switchboard, removes the services none
+        of whose workers are left and replaces dead socket worker processes."""
+        
+        def __init__(self, server):
+            threading.Thread.__init__(self)
+            self.daemon = True
+            self.server = server
+            self._requests = collections.deque() #(method, callback) to call back with what the method returns
+            self._waker = WebSockets.EventWaker()
+            self._poller = WebSockets.EventPoller()
+            self._poller.register(self._waker.fileno(), WebSockets.EventPoller.EVENT_READ)
+            self._nextCheck = time.time() + WebSockets.WORKER_CHECK_INTERVAL
+        
+        def resolve(self, location, callback):
+            """Looks up the service at the given location, loading and starting it
+            if it isn't running, and then calls callback with its ProcessRecord, or
+            None if there is no such service, from the ServiceStarter thread. A
+            service which is already running is handed over right away from the
+            calling thread instead, so that it doesn't wait for another service
+            to load. Safe to call from any thread."""
+            found, service = self.server.findService(location)
+            if found:
+                callback(service)
+                return
+            self._requests.append((lambda: self._getService(location), callback))
+            self._waker.wake()
+        
+        def stats(self, callback):
+            """Calls callback with the statistics of the server from the
+            ServiceStarter thread. Safe to call from any thread."""
+            self._requests.append((self.server.getStats, callback))
+            self._waker.wake()
+        
+        def _getService(self, location):
+            """Returns the service at the given location or None if it can't be loaded"""
+            try:
+                return self.server.getService(location)
+            except Exception as e:
+                print "Unable to load", '/'.join(location) + ":", e
+                return None
+        
+        def run(self):
+            """Looks up services and checks them until the server is shut down"""
+            while self.server.shutdownEvent.is_set() == False:
+                self._poller.poll(min(max(self._nextCheck - time.time(), 0), WebSockets.POLL_TIMEOUT))
+                self._waker.drain()
+                while self._requests:
+                    method, callback = self._requests.popleft()
+                    callback(method())
+                if time.time() >= self._nextCheck:
+                    self._nextCheck = time.time() + WebSockets.WORKER_CHECK_INTERVAL
+                    self.server.checkServices()
+    
+    class Shard(multiprocessing.Process):
+        """Socket worker process, which accepts and runs its share of the clients
+        when the server is configured with more than one worker. It has its own
+        listening sockets, HandshakePipelines and WebSocketManager and reaches
+        the services through the server process. See
+        WebSockets.WebSocketClient.WebSocketManagerPool."""
+        
+        def __init__(self, server, index, sendQueue, recvQueue):
+            multiprocessing.Process.__init__(self)
+            self.daemon = True #stopped along with the server process
+            self.server = server
+            self.index = index
+            self.sendQueue = sendQueue #written by the worker
+            self.recvQueue = recvQueue #written by the server process
+            self.shutdownFlag = multiprocessing.Event()
+        
+        def run(self):
+            """Runs the worker until it is shut down"""
+            #the server process has no process of its own to watch, hence None
+            hub = Processes.ProcessDirectory.WorkerRecord(None, self.recvQueue, self.sendQueue)
+            self.server.runShard(self.index, hub, self.shutdownFlag)
+    
+    def __init__(self, overridePort=None, overrideHost=None, overrideDocRoot=None, overrideWorkers=None):
         self.directory = Processes.ProcessDirectory()
         self.config = None
         self.shutdownEvent = threading.Event()
-        self.manager = multiprocessing.Manager()
-        self.webSocketManager = WebSockets.WebSocketClient.WebSocketManager([], self.shutdownEvent, self.directory)
-        self.webSocketManager.start()
+        self.webSocketManager = None #started once the configuration is loaded
+        self.serviceStarter = None #started along with the webSocketManager
+        self.workers = 1 #number of socket worker processes. with more than one, this process only runs the services
+        self.serviceLock = threading.Lock() #only one acceptor may load a service at a time
+        self.routes = {} #request path -> ProcessRecord of the running service
+        self.missingRoutes = collections.OrderedDict() #request path -> time until which it is known to have no service, oldest first
+        self.negativeCacheSize = DEFAULT_NEGATIVE_CACHE_SIZE
+        self.negativeCacheTTL = DEFAULT_NEGATIVE_CACHE_TTL
+        self.deflateOptions = None #keyword arguments for PerMessageDeflate.negotiate, or None if compression is turned off
+        self.statsPath = DEFAULT_STATS_PATH
+        self.metrics = Metrics.Registry()
+        self.metrics.gauge("services", lambda: len(self.routes))
+        self.tracer = Metrics.Tracer(self.metrics, DEFAULT_TRACE_SAMPLE_RATE, DEFAULT_TRACE_SLOW_THRESHOLD)
         self.overridePort = overridePort
         self.overrideHost = overrideHost
         self.overrideDocRoot = overrideDocRoot
+        self.overrideWorkers = overrideWorkers
         #logging.basicConfig(filename="server.log", level=logging.DEBUG)
         
     def runServer(self):
@@ -49,47 +366,250 @@ class WebSocketServer:
         HOST = self.overrideHost if self.overrideHost is not None else self.config.get('server', 'host')
         PORT = self.overridePort if self.overridePort is not None else self.config.getint('server', 'port')
         ADDR = (HOST, PORT)
+        self.workers = self.overrideWorkers if self.overrideWorkers is not None else self._getConfigInt('workers', 1)
+        ACCEPTORS = self._getConfigInt('acceptors', 1)
+        if (ACCEPTORS > 1 or self.workers > 1) and not hasattr(socket, "SO_REUSEPORT"):
+            print "SO_REUSEPORT is not supported on this platform. Using a single socket worker and acceptor."
+            ACCEPTORS = 1
+            self.workers = 1
+        if self.workers > 1 and self.workers >= multiprocessing.cpu_count():
+            print "Notice:", self.workers, "socket workers and the server process share", multiprocessing.cpu_count(), "cores, which is slower than fewer workers."
         
-        print "Attempting to start server on", ADDR
+        self.negativeCacheSize = self._getConfigInt('negative-cache-size', DEFAULT_NEGATIVE_CACHE_SIZE)
+        if self.config.has_option('server', 'negative-cache-ttl'):
+            self.negativeCacheTTL = self.config.getfloat('server', 'negative-cache-ttl')
+        if self.config.has_option('server', 'stats-path'):
+            self.statsPath = self.config.get('server', 'stats-path').strip()
+        if self.config.has_option('server', 'trace-sample-rate'):
+            self.tracer.sampleRate = self.config.getfloat('server', 'trace-sample-rate')
+        if self.config.has_option('server', 'trace-slow-threshold'):
+            self.tracer.slowThreshold = self.config.getfloat('server', 'trace-slow-threshold')
         
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
-        server.bind(ADDR)
-        server.listen(5)
+        if not self.config.has_option('server', 'deflate') or self.config.getboolean('server', 'deflate'):
+            self.deflateOptions = { "level" : self._getConfigInt('deflate-level', DEFAULT_DEFLATE_LEVEL),
+                                    "memLevel" : self._getConfigInt('deflate-mem-level', DEFAULT_DEFLATE_MEM_LEVEL),
+                                    "windowBits" : self._getConfigInt('deflate-window-bits', DEFAULT_DEFLATE_WINDOW_BITS),
+                                    "clientWindowBits" : self._getConfigInt('deflate-client-window-bits', DEFAULT_DEFLATE_WINDOW_BITS) }
+        
+        #the sockets are run by this process or spread over several worker processes
+        self.maxMessageSize = self._getConfigInt('max-message-size', WebSockets.DEFAULT_MAX_MESSAGE_SIZE)
+        defaults = WebSockets.WebSocketClient.SendLimits()
+        policy = self.config.get('server', 'slow-consumer-policy') if self.config.has_option('server', 'slow-consumer-policy') else defaults.policy
+        if policy not in WebSockets.WebSocketClient.SendLimits.POLICIES:
+            print "Unknown slow-consumer-policy", policy + ". Using", defaults.policy
+            policy = defaults.policy
+        self.sendLimits = WebSockets.WebSocketClient.SendLimits(self._getConfigInt('send-high-water-messages', defaults.highMessages),
+                                                                self._getConfigInt('send-low-water-messages', defaults.lowMessages),
+                                                                self._getConfigInt('send-high-water-bytes', defaults.highBytes),
+                                                                self._getConfigInt('send-low-water-bytes', defaults.lowBytes),
+                                                                policy)
+        self.keepalive = WebSockets.WebSocketClient.KeepaliveLimits()
+        for option, attribute in (('ping-interval', 'pingInterval'), ('pong-timeout', 'pongTimeout'), ('idle-timeout', 'idleTimeout')):
+            if self.config.has_option('server', option):
+                setattr(self.keepalive, attribute, self.config.getfloat('server', option))
+        self.batchSize = self._getConfigInt('service-batch-size', WebSockets.SERVICE_BATCH_SIZE)
+        self.flushDelay = self.config.getfloat('server', 'service-flush-delay') if self.config.has_option('server', 'service-flush-delay') else WebSockets.SERVICE_FLUSH_DELAY
+        self.address = ADDR
+        self.acceptors = ACCEPTORS
+        self.backlog = self._getConfigInt('backlog', DEFAULT_BACKLOG)
+        self.handshakeTimeout = self.config.getfloat('server', 'handshake-timeout') if self.config.has_option('server', 'handshake-timeout') else DEFAULT_HANDSHAKE_TIMEOUT
+        self.maxHeaderSize = self._getConfigInt('max-header-size', DEFAULT_MAX_HEADER_SIZE)
+        self.serviceStarter = WebSocketServer.ServiceStarter(self)
+        if self.workers > 1:
+            self.webSocketManager = WebSockets.WebSocketClient.WebSocketManagerPool(self.workers, self.shutdownEvent, self.directory, self._startShard, self.metrics, self.tracer, self.batchSize, self.flushDelay)
+            self.webSocketManager.switchboard.resolver = self.serviceStarter
+        else:
+            switchboard = WebSockets.WebSocketClient.WebSocketSwitchboard(self.shutdownEvent, self.directory, self.metrics, self.tracer, self.batchSize, self.flushDelay)
+            self.webSocketManager = WebSockets.WebSocketClient.WebSocketManager([], self.shutdownEvent, self.directory, switchboard, self.maxMessageSize, self.sendLimits, self.metrics, 0, self.tracer, self.keepalive)
+            switchboard.start()
+            self.webSocketManager.start()
+        self.serviceStarter.start()
         
-        print "Server started. Listening for connections..."
+        if self.config.has_option('server', 'preload') and self.config.getboolean('server', 'preload'):
+            self.preloadServices()
         
-        while self.shutdownEvent.is_set() == False:
+        print "Attempting to start server on", ADDR, "with", self.workers, "socket workers"
+        
+        if self.workers > 1:
+            self.webSocketManager.start() #the workers start out with the preloaded services
+            print "Server started. Starting the socket workers..."
             try:
-                #get a new client
-                conn, addr = server.accept()
-                print "Client connected from", addr
-                request = conn.recv(4096)
-                response, close, serviceRecord = self.handshake(request)
-                conn.send(response)
-                if close:
-                    print "Invalid request from", addr
-                    conn.close()
-                    continue
-                client = WebSockets.WebSocketClient(self.webSocketManager, conn, addr)
-                #link the client to the service record
-                client.serviceId = serviceRecord.process.pid
-                serviceRecord.recvQueue.put(WebSockets.WebSocketTransaction(WebSockets.WebSocketTransaction.TRANSACTION_NEWSOCKET, client.id, addr))
-                
+                while not self.shutdownEvent.wait(WebSockets.POLL_TIMEOUT):
+                    pass
             except KeyboardInterrupt:
                 self.shutdownEvent.set() #shut down gracefully
+        else:
+            self._serve("Server")
         
         print "Shutting down server..."
+        if self.workers > 1:
+            self.webSocketManager.join()
         self.directory.joinAll()
-        
-        server.shutdown(socket.SHUT_RDWR)
-        server.close()
+    
+    def _serve(self, name):
+        """Accepts clients until the server is shut down. Every acceptor has its
+        own listening socket and all but the first get their own thread. name
+        is what is said to have started once the sockets are listening."""
+        reusePort = self.acceptors > 1 or self.workers > 1
+        listeners = [self._listen(self.address, reusePort, self.backlog) for i in xrange(self.acceptors)]
+        print name, "started. Listening for connections..."
+        pipelines = [WebSocketServer.HandshakePipeline(self, listeners[i], self.handshakeTimeout, self.maxHeaderSize, i) for i in xrange(len(listeners))]
+        for pipeline in pipelines[1:]:
+            acceptor = threading.Thread(target=pipeline.run)
+            acceptor.daemon = True
+            acceptor.start()
+        try:
+            pipelines[0].run()
+        except KeyboardInterrupt:
+            self.shutdownEvent.set() #shut down gracefully
+        for listener in listeners:
+            listener.close()
+    
+    def _startShard(self, index):
+        """Starts the socket worker process with the given index and returns its
+        WorkerRecord. This is the factory of the WebSocketManagerPool."""
+        sendQueue = Processes.ServiceQueue(bufferedWrites=True) #written by the worker
+        recvQueue = Processes.ServiceQueue(bufferedWrites=True) #written by this process
+        shard = WebSocketServer.Shard(self, index, sendQueue, recvQueue)
+        shard.start()
+        return Processes.ProcessDirectory.WorkerRecord(shard, sendQueue, recvQueue)
+    
+    def runShard(self, index, hub, shutdownFlag):
+        """Runs the socket worker process with the given index, which reaches the
+        services through hub, until shutdownFlag is set. The worker process
+        starts out as a copy of the server process, so whatever belongs to the
+        server process is replaced first."""
+        WebSockets.WebSocketClient.registry = WebSockets.ConnectionRegistry(index)
+        self.shutdownEvent = shutdownFlag
+        self.metrics = Metrics.Registry()
+        self.tracer = Metrics.Tracer(self.metrics, self.tracer.sampleRate, self.tracer.slowThreshold)
+        directory = Processes.ProcessDirectory() #the services aren't run by this process
+        switchboard = WebSockets.WebSocketClient.WebSocketShardSwitchboard(shutdownFlag, directory, hub, self.metrics, self.tracer, self.batchSize, self.flushDelay)
+        self.routes = switchboard.routes
+        self.missingRoutes = collections.OrderedDict()
+        self.serviceStarter = switchboard #it asks the server process for services and statistics
+        self.webSocketManager = WebSockets.WebSocketClient.WebSocketManager([], shutdownFlag, directory, switchboard, self.maxMessageSize, self.sendLimits, self.metrics, 0, self.tracer, self.keepalive)
+        switchboard.start()
+        self.webSocketManager.start()
+        self._serve("Socket worker %d" % index)
+    
+    def _getConfigInt(self, option, default):
+        """Returns an integer option from the server section of the configuration or the default"""
+        if self.config.has_option('server', option):
+            return self.config.getint('server', option)
+        return default
+    
+    def _listen(self, addr, reusePort, backlog):
+        """Creates a listening socket for the given address. When reusePort is
+        set, several listening sockets can share the address and the kernel
+        spreads incoming connections across them."""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reusePort:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.bind(addr)
+        server.listen(backlog)
+        return server
+    
+    def _getDocumentRoot(self):
+        """Returns the configured document root"""
+        return self.overrideDocRoot if self.overrideDocRoot is not None else self.config.get('server', 'document-root')
+    
+    def preloadServices(self):
+        """Starts every service found under the document root so that the first
+        client of a service doesn't have to wait for it to start"""
+        root = self._getDocumentRoot()
+        for dirPath, dirNames, fileNames in os.walk(root):
+            relative = os.path.relpath(dirPath, root)
+            prefix = [] if relative == os.curdir else relative.split(os.sep)
+            for fileName in sorted(fileNames):
+                if fileName[-3:] != ".py":
+                    continue
+                location = prefix + [fileName]
+                try:
+                    if self.getService(location) is not None:
+                        print "Preloaded service", '/'.join(location)
+                except Exception as e:
+                    print "Unable to preload", '/'.join(location) + ":", e
     
     def getService(self, location):
         """Attempts to load a service based on the location relative to the document root.
         location is the full path ->list<- including the index script if it was appended.
-        Returns a Process.ProcessDirectory.ProcessRecord."""
+        Returns a Process.ProcessDirectory.ProcessRecord.
+        
+        Running services are found with a single lookup in the route table.
+        Paths which recently had no service are remembered in a bounded
+        negative cache so they don't hit the filesystem on every request."""
+        key = '/'.join(location)
+        with self.serviceLock:
+            process = self.routes.get(key)
+            if process is not None:
+                if process.is_alive():
+                    return process
+                #it died, so it is removed and started again below
+                self.routes.pop(key)
+                self._removeService(location, process)
+            expires = self.missingRoutes.get(key)
+            if expires is not None:
+                if expires > time.time():
+                    return None
+                self.missingRoutes.pop(key)
+            process = self._getService(location)
+            if process is not None:
+                self.routes[key] = process
+            elif self.negativeCacheSize > 0:
+                self.missingRoutes[key] = time.time() + self.negativeCacheTTL
+                while len(self.missingRoutes) > self.negativeCacheSize:
+                    self.missingRoutes.popitem(last=False) #forget the oldest
+            return process
+    
+    def findService(self, location):
+        """Looks up a service without loading or starting anything, so it never
+        holds up the caller. Returns whether the answer is known and the
+        ProcessRecord of the service. The answer is known when the service is
+        running or the path is remembered as having no service, otherwise
+        getService has to be called for it."""
+        key = '/'.join(location)
+        process = self.routes.get(key)
+        if process is not None:
+            if process.is_alive():
+                return True, process
+            return False, None
+        expires = self.missingRoutes.get(key)
+        if expires is not None and expires > time.time():
+            return True, None
+        return False, None
+    
+    def checkServices(self):
+        """Starts a replacement for every dead worker of a running service and
+        removes the services which have no workers left. Dead socket worker
+        processes are replaced too. This is called by the ServiceStarter."""
+        if self.workers > 1:
+            self.webSocketManager.checkShards()
+        with self.serviceLock:
+            routes = self.routes.items()
+        for key, process in routes:
+            if not process.is_alive():
+                with self.serviceLock:
+                    if self.routes.get(key) is process:
+                        self.routes.pop(key)
+                        self._removeService(key.split('/'), process)
+                continue
+            for position in process.deadWorkers():
+                self.webSocketManager.switchboard.replaceWorker(process, position, process.startReplacement(position))
+    
+    def _removeService(self, location, process):
+        """Removes a service none of whose workers are left from the process
+        directory and has the switchboard close its queues once it has stopped
+        using them. The service lock must be held."""
+        current = self.directory
+        for d in location[:-1]:
+            current = current.findDir(d)
+        current.findProcess(location[-1]) #drops it since it isn't alive
+        self.webSocketManager.switchboard.retireService(process)
+    
+    def _getService(self, location):
+        """Loads a service while holding the service lock"""
         current = self.directory
         process = None
         for d in location:
@@ -99,14 +619,19 @@ class WebSocketServer:
                 if process is None:
                     #attempt to load the service
                     incpath = "" #'.'.join(location)
-                    path = (self.overrideDocRoot if self.overrideDocRoot is not None else self.config.get('server', 'document-root')) + '/'.join(location)
+                    path = self._getDocumentRoot() + '/'.join(location)
                     try:
                         service = imp.load_source(incpath, path)
-                        sendQueue = self.manager.Queue()
-                        recvQueue = self.manager.Queue()
-                        s = service.Service(sendQueue, recvQueue)
-                        s.start()
-                        process = Processes.ProcessDirectory.ProcessRecord(s, sendQueue, recvQueue)
+                        serviceClass = service.Service #every service is loaded into the same module, so the next one replaces it
+                        def startWorker():
+                            """Starts one worker process of the service"""
+                            sendQueue = Processes.ServiceQueue()
+                            recvQueue = Processes.ServiceQueue(bufferedWrites=True)
+                            s = serviceClass(sendQueue, recvQueue)
+                            s.start()
+                            return s, sendQueue, recvQueue
+                        process = Processes.ProcessDirectory.ProcessRecord(*startWorker(), factory=startWorker, streaming=getattr(service.Service, "STREAMING", False), name='/'.join(location))
+                        process.addWorkers(getattr(service.Service, "POOL_SIZE", 1) - 1)
                         current.addProcess(location[-1], process)
                     except (ImportError, IOError):
                         #not found
@@ -117,32 +642,62 @@ class WebSocketServer:
         return process
         
     
+    def getStats(self):
+        """Returns a snapshot of the server metrics as a dictionary. See
+        Metrics.Registry.snapshot for its layout. The metrics of the socket
+        worker processes, as of their last snapshot, are labelled with the
+        index of their worker."""
+        stats = self.metrics.snapshot()
+        if self.workers > 1:
+            Metrics.merge(stats, dict(self.webSocketManager.switchboard.shardMetrics), "shard")
+        return stats
+    
+    def isStatsRequest(self, request, address):
+        """Returns whether a request is a GET of the stats path from the local machine"""
+        if not self.statsPath:
+            return False
+        heading = request.split("\r\n", 1)[0].split()
+        if len(heading) != 3 or heading[0] != HTTP_METHOD or heading[1].split("?", 1)[0] != self.statsPath:
+            return False
+        return address[0].startswith("127.") or address[0] == "::1" #only the local machine gets to see them
+    
+    def statsResponse(self, stats):
+        """Returns the HTTP response carrying the statistics as JSON"""
+        body = json.dumps(stats, sort_keys=True)
+        return (HTTP_VERSION + " " + HTTP_OK +
+                "Content-Type: application/json\r\n" +
+                "Content-Length: " + str(len(body)) + "\r\n" +
+                "Connection: close\r\n\r\n" + body)
+    
     def handshake(self, request):
-        """Process a request header and creates a handshake for it"""
-        service = None #service process to send this client to
-        close = False #whether or not the connection should be closed
+        """Process a request header and creates a handshake for it. Returns the
+        response, whether to close the connection, the service record and the
+        PerMessageDeflate for the connection if compression was negotiated.
+        This may load and start the service, so the HandshakePipeline uses
+        parseRequest, findService and upgrade instead."""
+        response, location = self.parseRequest(request)
+        if response is not None:
+            return response, True, None, None
+        return self.upgrade(request, self.getService(location))
+    
+    def parseRequest(self, request):
+        """Checks the request line of a handshake and works out the location of
+        the service it asks for. Returns the response to close the connection
+        with and None if the request is invalid, otherwise None and the location."""
         response = HTTP_VERSION + " " #the http response to send to the client
-        #process their initial HTTP request
-        lines = request.split("\r\n")
         #the first line should contain their request
-        heading = lines[0].split()
+        heading = request.split("\r\n", 1)[0].split()
         if len(heading) != 3:
-            close = True
-            response += HTTP_BAD_REQUEST + "\r\n"
+            return response + HTTP_BAD_REQUEST + "\r\n", None
         elif heading[0] != HTTP_METHOD:
             #they did something other than a get request
             print heading[0]
-            close = True
-            response += HTTP_METHOD_NOT_ALLOWED + "\r\n"
+            return response + HTTP_METHOD_NOT_ALLOWED + "\r\n", None
         elif heading[2] != HTTP_VERSION:
             #they didn't say HTTP/1.1
             print heading[2]
-            close = True
-            response += HTTP_BAD_REQUEST + "\r\n"
-        if close:
-            #we are done here
-            return response, close, service
-        #find out if the service they want to contact exists
+            return response + HTTP_BAD_REQUEST + "\r\n", None
+        #find out where the service they want to contact would be
         location = heading[1].split('/')
         if location[0] == "":
             location.pop(0) #remove the empty string
@@ -151,12 +706,21 @@ class WebSocketServer:
             location[-1] = SERVICE_INDEX_NAME
         if location[-1][-3:] != ".py":
             location[-1] += ".py"
-        service = self.getService(location)
+        return None, location
+    
+    def upgrade(self, request, service):
+        """Creates the response to a handshake whose request line parseRequest
+        accepted, for the given service record or None if there is no such
+        service. Returns the same as handshake."""
+        deflate = None #compression state if permessage-deflate was negotiated
+        close = False #whether or not the connection should be closed
+        response = HTTP_VERSION + " " #the http response to send to the client
         if service is None:
             #we are done
             close = True
             response += HTTP_NOT_FOUND + "\r\n"
-            return response, close, service
+            return response, close, service, deflate
+        lines = request.split("\r\n")
         #now go through their headers
         headers = {}
         for line in lines:
@@ -179,24 +743,29 @@ class WebSocketServer:
             response += HTTP_NOT_IMPLEMENTED + "\r\n"
         if close:
             #we are done here
-            return response, close, service
+            return response, close, service, deflate
         #process the web socket header and create the response
         response += "101 Switching Protocols\r\n"
         response += "Connection: Upgrade\r\n"
         response += "Upgrade: " + headers["Upgrade"] + "\r\n"
+        if self.deflateOptions is not None and "Sec-WebSocket-Extensions" in headers:
+            deflate, extension = WebSockets.PerMessageDeflate.negotiate(headers["Sec-WebSocket-Extensions"], **self.deflateOptions)
+            if deflate is not None:
+                response += "Sec-WebSocket-Extensions: " + extension + "\r\n"
         #base64 decode the key
         response += "Sec-WebSocket-Accept: " + base64.encodestring(hashlib.sha1(headers["Sec-WebSocket-Key"] + WEBSOCKET_MAGIC_HANDSHAKE_STRING).digest()) + "\r\n"
-        return response, close, service
+        return response, close, service, deflate
 
 
 
 def main():
-    shortArgs = "p:hd:o:"
-    longArgs = [ "port=", "help", "document-root=", "host="]
+    shortArgs = "p:hd:o:w:"
+    longArgs = [ "port=", "help", "document-root=", "host=", "workers="]
     showUsage = False
     overridePort = None
     overrideHost = None
     overrideDocRoot = None
+    overrideWorkers = None
     try:
         optlist, args = getopt.getopt(sys.argv[1:], shortArgs, longArgs)
         for opt in optlist:
@@ -216,6 +785,13 @@ def main():
             elif opt[0] == "--host" or opt[0] == "-o":
                 #override host
                 overrideHost = opt[1]
+            elif opt[0] == "--workers" or opt[0] == "-w":
+                #override the number of socket workers
+                try:
+                    overrideWorkers = int(opt[1])
+                except ValueError:
+                    print "Invalid number of workers:", opt[1]
+                    showUsage = True
     except getopt.GetoptError:
         #we get to print our usage message!
         showUsage = True
@@ -225,11 +801,12 @@ def main():
         print "\t-p --port=\t\tOverride configured port number"
         print "\t-o --host=\t\tOverride configured host"
         print "\t-d --document-root=\tOverride configured document root"
+        print "\t-w --workers=\t\tOverride configured number of socket workers"
         print "\t-h --help\t\tShow this message"
         print "No arguments will start the server as configured in server.config"
         return
     
-    server = WebSocketServer(overridePort, overrideHost, overrideDocRoot)
+    server = WebSocketServer(overridePort, overrideHost, overrideDocRoot, overrideWorkers)
     server.runServer()
 
 if __name__ == "__main__":
@@ -2,16 +2,36 @@
 import socket
 import select
 import threading
-import multiprocessing
 import Queue
-import time
+import os
+import errno
+import fcntl
+import struct
+import binascii
+import itertools
 import collections
-import sys
-import logging
+import codecs
+import zlib
+import time
+import cPickle
+import math
+import Metrics
 
 BUFFER_SIZE = 4096
 WEBSOCKET_VERSION = "13"
 WEBSOCKET_MAGIC_HANDSHAKE_STRING = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+POLL_TIMEOUT = 0.5 #seconds to wait for socket events before checking if we should stop
+WORKER_CHECK_INTERVAL = 1.0 #seconds between checks for dead service workers
+STATS_SOCKETS = 20 #number of sockets with the most queued data listed in the metrics of each manager
+SERVICE_BATCH_SIZE = 256 #maximum number of transactions moved to or from a service queue in one write or read
+SERVICE_FLUSH_DELAY = 0.0 #seconds transactions for a service are held to gather a larger batch. 0 writes them every time the switchboard wakes
+STATE_POOL_SIZE = 64 #idle receive and send states each manager keeps to hand to the next socket with data in flight
+TRACE_RECEIVED = "received" #a traced message was read from its socket
+TRACE_FORWARDED = "forwarded" #it was put in the recvQueue of its service
+TRACE_DISPATCHED = "dispatched" #the service took it out of its recvQueue
+TRACE_ANSWERED = "answered" #the service put an answer in its sendQueue
+TRACE_ROUTED = "routed" #the switchboard took the answer out of the sendQueue
+TRACE_WRITTEN = "written" #the answer was written to the socket
 
 class WebSocketInitializationException(Exception):
     """Raised when a web socket initialization fails due to bad handshakes or requests"""
@@ -22,329 +42,2257 @@ class WebSocketUnmaskedCommunicationException(Exception):
 class WebSocketInvalidDataException(Exception):
     """Raised when receiving data goes horribly wrong (namely...it got something unexpected)"""
     pass
+class WebSocketMessageTooBigException(WebSocketInvalidDataException):
+    """Raised when a client sends a message larger than the maximum message size"""
+    pass
+
+_HEADER_LENGTH_16 = struct.Struct("!H") #16 bit extended payload length
+_HEADER_LENGTH_64 = struct.Struct("!Q") #64 bit extended payload length
+_HEADER_SHORT = struct.Struct("!BB") #server->client header with a 7 bit length
+_HEADER_16 = struct.Struct("!BBH") #server->client header with a 16 bit length
+_HEADER_64 = struct.Struct("!BBQ") #server->client header with a 64 bit length
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg") #scatter-gather sends are only available on newer pythons
+MAX_IOVEC = 1024 #maximum number of buffers handed to a single sendmsg call
+SEND_COALESCE_LIMIT = 256 * 1024 #maximum number of bytes joined together for a single send call when sendmsg isn't available
+DEFAULT_MAX_MESSAGE_SIZE = 16 * 1024 * 1024 #largest message accepted from a client unless configured otherwise
+STREAM_CHUNK_SIZE = 64 * 1024 #size of the parts a message is handed to a streaming service in
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_MESSAGE_TOO_BIG = 1009
+_CLOSE_CODE = struct.Struct("!H") #status code at the start of a close frame payload
+_RESERVED_CLOSE_CODES = (1004, 1005, 1006) #codes defined by RFC 6455 which must never be sent in a close frame
+_DEFLATE_TAIL = "\x00\x00\xff\xff" #end of a sync flushed deflate block, left off of compressed messages
+DEFLATE_MIN_SIZE = 64 #messages smaller than this are sent uncompressed even when compression is negotiated
+WRITE_BUFFER_LIMIT = 64 * 1024 #bytes of encoded frames a connection holds for writing before leaving the rest in its sendQueue
+CLOSE_POLICY_VIOLATION = 1008
+TIMER_TICK = 0.5 #seconds between the ticks of the timer wheel of each manager, which is how late a keepalive timer may fire
+TIMER_WHEEL_SLOTS = 256 #number of slots in a timer wheel. timers further away than one turn of the wheel wait for more turns
+SOCKET_SLOT_BITS = 24 #low bits of a socket id holding its slot in the ConnectionRegistry
+SOCKET_SHARD_BITS = 8 #bits of a socket id above the slot holding the index of the socket worker process which owns it. the bits above hold the generation of the slot
+_SOCKET_SLOT_MASK = (1 << SOCKET_SLOT_BITS) - 1
+_SOCKET_SHARD_MASK = (1 << SOCKET_SHARD_BITS) - 1
+_SOCKET_GENERATION_MASK = (1 << (63 - SOCKET_SLOT_BITS - SOCKET_SHARD_BITS)) - 1 #generations wrap around before the id would overflow a transaction header
+SHARD_RESOLVE = 0 #control message from a socket worker process asking for the service at a location, and the answer to it
+SHARD_STATS = 1 #control message from a socket worker process asking for the server statistics, and the answer to it
+SHARD_METRICS = 2 #control message carrying a snapshot of the metrics of a socket worker process
+SHARD_RETIRED = 3 #control message telling a socket worker process that a service has been removed
+_TRANSACTION_HEADER = struct.Struct("!BBq") #type, flags and socket id at the start of an encoded transaction
+_MIN_SOCKET_ID = -2 ** 63 #socket ids outside of this range can't go in the header
+_MAX_SOCKET_ID = 2 ** 63 - 1
+
+def encodeFrameHeader(length, opcode=OPCODE_TEXT, compressed=False):
+    """Builds the 2 to 10 byte header of a final, unmasked server->client frame
+    carrying a payload of the given length. compressed sets the RSV1 bit used by
+    permessage-deflate."""
+    typeByte = 0xC0 | opcode if compressed else 0x80 | opcode
+    if length <= 0x7D:
+        return _HEADER_SHORT.pack(typeByte, length)
+    elif length <= 0xFFFF:
+        return _HEADER_16.pack(typeByte, 0x7E, length)
+    return _HEADER_64.pack(typeByte, 0x7F, length)
+
+def validCloseCode(code):
+    """Returns whether a status code received in a close frame is allowed: one
+    of the codes defined by RFC 6455 other than the reserved ones, or one of the
+    codes left to libraries and applications (3000-4999)"""
+    return (CLOSE_NORMAL <= code <= 1011 and code not in _RESERVED_CLOSE_CODES) or 3000 <= code <= 4999
+
+def unmaskBytes(payload, mask, offset=0):
+    """Unmasks a span of payload bytes with the 4 byte mask. offset is the position
+    of the first byte of the span within the whole payload so that a payload split
+    across several receives can be unmasked piece by piece. Returns a bytearray.
+    
+    Rather than XORing byte by byte, the span and the repeated mask are each
+    converted to one big integer and XORed in a single operation."""
+    length = len(payload)
+    if length == 0:
+        return bytearray()
+    shift = offset % 4
+    mask = mask[shift:] + mask[:shift] #rotate the mask so it lines up with the start of this span
+    repeatedMask = (mask * (length // 4 + 1))[:length]
+    unmasked = int(binascii.hexlify(payload), 16) ^ int(binascii.hexlify(repeatedMask), 16)
+    return bytearray(binascii.unhexlify("%0*x" % (length * 2, unmasked)))
 
-class WebSocketTransaction:
+class PerMessageDeflate:
+    """permessage-deflate (RFC 7692) state of a single connection. Messages sent
+    to the client share one compressor and messages from the client share one
+    decompressor, so each message can refer back to the ones before it (context
+    takeover) unless that was turned off during the handshake. The compressor is
+    only created once something is compressed so idle connections don't hold
+    one."""
+    EXTENSION_NAME = "permessage-deflate"
+    def __init__(self, level=6, memLevel=8, serverWindowBits=15, clientWindowBits=15, serverNoContextTakeover=False):
+        """Creates the state for a connection using the negotiated parameters.
+        level and memLevel are passed on to zlib and trade speed and memory for
+        smaller messages."""
+        self.level = level
+        self.memLevel = memLevel
+        self.serverWindowBits = serverWindowBits
+        self.clientWindowBits = clientWindowBits
+        self.serverNoContextTakeover = serverNoContextTakeover
+        self._compressor = None
+        self._decompressor = zlib.decompressobj(-clientWindowBits)
+        self._unconsumed = "" #compressed input held back because the part being decompressed was full
+    
+    @staticmethod
+    def negotiate(header, level=6, memLevel=8, windowBits=15, clientWindowBits=15):
+        """Accepts the first permessage-deflate offer in a Sec-WebSocket-Extensions
+        request header which can be accepted. windowBits and clientWindowBits
+        are the largest windows the server is willing to use for compressing
+        and decompressing. Returns a (PerMessageDeflate, response header value)
+        tuple, or (None, None) if no offer was accepted."""
+        for offer in header.split(","):
+            params = [param.strip() for param in offer.split(";")]
+            if params[0] != PerMessageDeflate.EXTENSION_NAME:
+                continue
+            values = {}
+            for param in params[1:]:
+                name, sep, value = param.partition("=")
+                name = name.strip()
+                if name in values:
+                    values = None #repeated parameters make the offer invalid
+                    break
+                values[name] = value.strip().strip('"') if sep else None
+            if values is None or not set(values).issubset(("server_no_context_takeover", "client_no_context_takeover", "server_max_window_bits", "client_max_window_bits")):
+                continue
+            response = [PerMessageDeflate.EXTENSION_NAME]
+            serverBits = windowBits
+            clientBits = 15 #the client can't be limited unless it says it can be
+            try:
+                if values.get("server_max_window_bits", "") is None:
+                    continue
+                if "server_max_window_bits" in values:
+                    requested = int(values["server_max_window_bits"])
+                    if requested < 9 or requested > 15:
+                        continue #zlib can't compress with a window smaller than 9 bits
+                    serverBits = min(serverBits, requested)
+                    response.append("server_max_window_bits=%d" % serverBits)
+                if "client_max_window_bits" in values:
+                    offered = int(values["client_max_window_bits"] or 15)
+                    if offered < 8 or offered > 15:
+                        continue
+                    clientBits = min(clientWindowBits, offered)
+                    if clientBits < 15:
+                        response.append("client_max_window_bits=%d" % clientBits)
+            except ValueError:
+                continue
+            serverNoContextTakeover = "server_no_context_takeover" in values
+            if serverNoContextTakeover:
+                response.append("server_no_context_takeover")
+            return PerMessageDeflate(level, memLevel, serverBits, clientBits, serverNoContextTakeover), "; ".join(response)
+        return None, None
+    
+    def _newCompressor(self):
+        """Creates a compressor using the parameters of this connection"""
+        return zlib.compressobj(self.level, zlib.DEFLATED, -self.serverWindowBits, self.memLevel)
+    
+    def compress(self, data):
+        """Compresses a whole message using the context of this connection"""
+        if self._compressor is None:
+            self._compressor = self._newCompressor()
+        compressed = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.serverNoContextTakeover:
+            self._compressor = None
+        return compressed[:-4] if compressed.endswith(_DEFLATE_TAIL) else compressed
+    
+    def compressShared(self, data):
+        """Compresses a whole message without using the context of this
+        connection so that the result can be sent to any connection which
+        negotiated the same window size"""
+        compressor = self._newCompressor()
+        compressed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return compressed[:-4] if compressed.endswith(_DEFLATE_TAIL) else compressed
+    
+    def forgetContext(self):
+        """Starts the next compressed message from scratch. This has to be called
+        whenever a message compressed by compressShared is sent, since the client
+        then has data in its window that our compressor doesn't know about."""
+        self._compressor = None
+    
+    def decompress(self, data, final, maxLength=None, partSize=None):
+        """Decompresses some or all of a message from the client. final is true
+        for the end of the message. Raises WebSocketMessageTooBigException if
+        the data decompresses to more than maxLength bytes (None for no limit).
+        
+        When partSize is given no more than that is returned and the input which
+        wasn't needed for it is held back. A part which comes out full may have
+        more behind it, which is returned by further calls with no data and
+        final false."""
+        data = self._unconsumed + data if self._unconsumed else data
+        if final:
+            data += _DEFLATE_TAIL
+        limit = 0 #no limit
+        if maxLength is not None:
+            limit = maxLength + 1
+        if partSize is not None:
+            limit = min(limit, partSize) if limit else partSize
+        try:
+            decompressed = self._decompressor.decompress(data, limit)
+        except zlib.error:
+            raise WebSocketInvalidDataException()
+        self._unconsumed = self._decompressor.unconsumed_tail
+        if maxLength is not None and len(decompressed) > maxLength:
+            raise WebSocketMessageTooBigException()
+        return decompressed
+
+class EventPoller:
+    """Readiness notification wrapper. File descriptors are registered once and
+    all of them are waited on in a single call. This uses epoll where it is
+    available, falling back to poll and then select on other platforms.
+    
+    The poller is not meant to be modified from a thread other than the one
+    calling poll()."""
+    EVENT_READ = 1
+    EVENT_WRITE = 2
+    EVENT_ERROR = 4
+    def __init__(self):
+        """Creates a new poller with nothing registered"""
+        self._registered = {} #fd -> EVENT_ mask
+        if hasattr(select, "epoll"):
+            self._impl = select.epoll()
+            self._timeoutScale = 1 #epoll takes seconds
+            self._nativeRead = select.EPOLLIN
+            self._nativeWrite = select.EPOLLOUT
+            self._nativeError = select.EPOLLERR | select.EPOLLHUP
+        elif hasattr(select, "poll"):
+            self._impl = select.poll()
+            self._timeoutScale = 1000 #poll takes milliseconds
+            self._nativeRead = select.POLLIN
+            self._nativeWrite = select.POLLOUT
+            self._nativeError = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        else:
+            self._impl = None #plain select
+    
+    def _toNative(self, events):
+        """Converts an EVENT_ mask into the native mask for the poller"""
+        native = 0
+        if events & EventPoller.EVENT_READ:
+            native |= self._nativeRead
+        if events & EventPoller.EVENT_WRITE:
+            native |= self._nativeWrite
+        return native
+    
+    def _fromNative(self, native):
+        """Converts a native event mask into an EVENT_ mask"""
+        events = 0
+        if native & self._nativeRead:
+            events |= EventPoller.EVENT_READ
+        if native & self._nativeWrite:
+            events |= EventPoller.EVENT_WRITE
+        if native & self._nativeError:
+            events |= EventPoller.EVENT_ERROR
+        return events
+    
+    def register(self, fd, events):
+        """Starts watching the given file descriptor for the EVENT_ mask"""
+        self._registered[fd] = events
+        if self._impl is not None:
+            self._impl.register(fd, self._toNative(events))
+    
+    def modify(self, fd, events):
+        """Changes the events watched for on an already registered file descriptor"""
+        if self._registered.get(fd) == events:
+            return #nothing to change, so save ourselves the system call
+        self._registered[fd] = events
+        if self._impl is not None:
+            self._impl.modify(fd, self._toNative(events))
+    
+    def unregister(self, fd):
+        """Stops watching the given file descriptor. This must be called before
+        the descriptor is closed so that a reused descriptor number is not confused
+        with the old one."""
+        if self._registered.pop(fd, None) is None:
+            return
+        if self._impl is not None:
+            try:
+                self._impl.unregister(fd)
+            except (IOError, OSError, KeyError, ValueError):
+                pass #it was already gone
+    
+    def poll(self, timeout):
+        """Waits up to timeout seconds for events. Returns a list of (fd, EVENT_ mask) tuples."""
+        try:
+            if self._impl is None:
+                rList = [fd for fd in self._registered if self._registered[fd] & EventPoller.EVENT_READ]
+                wList = [fd for fd in self._registered if self._registered[fd] & EventPoller.EVENT_WRITE]
+                r, w, x = select.select(rList, wList, self._registered.keys(), timeout)
+                ret = {}
+                for fd in r:
+                    ret[fd] = EventPoller.EVENT_READ
+                for fd in w:
+                    ret[fd] = ret.get(fd, 0) | EventPoller.EVENT_WRITE
+                for fd in x:
+                    ret[fd] = ret.get(fd, 0) | EventPoller.EVENT_ERROR
+                return ret.items()
+            return [(fd, self._fromNative(ev)) for fd, ev in self._impl.poll(timeout * self._timeoutScale)]
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return [] #interrupted by a signal, the caller will just loop around
+            raise
+
+class EventWaker:
+    """Pipe which can be registered with an EventPoller so that another thread
+    can interrupt a thread blocked in EventPoller.poll"""
+    def __init__(self):
+        self._readFd, self._writeFd = os.pipe()
+        for fd in (self._readFd, self._writeFd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    
+    def fileno(self):
+        """Returns the descriptor which becomes readable after wake() is called"""
+        return self._readFd
+    
+    def wake(self):
+        """Wakes up the thread waiting on this waker. Safe to call from any thread."""
+        try:
+            os.write(self._writeFd, "\0")
+        except OSError:
+            pass #the pipe is full, so the waiting thread will wake up anyway
+    
+    def drain(self):
+        """Clears any pending wake ups. Called by the waiting thread."""
+        try:
+            while os.read(self._readFd, 4096):
+                pass
+        except OSError:
+            pass
+
+class TimerWheel:
+    """Hashed timer wheel which tells when items such as sockets are due. Each
+    slot holds the items due at one tick, so scheduling and cancelling take
+    constant time and a tick only looks at the items in its own slot rather
+    than at every item. Items due further away than one turn of the wheel sit
+    in their slot for as many more turns as needed.
+    
+    An item has at most one timer. Items are returned at most one tick after
+    they are due and never before. The wheel is not safe for multithreading."""
+    def __init__(self, tick=TIMER_TICK, slots=TIMER_WHEEL_SLOTS):
+        self.tick = tick
+        self._slots = [{} for i in xrange(slots)] #each slot maps item -> turns of the wheel left
+        self._where = {} #item -> index of its slot
+        self._current = 0 #index of the slot which is due next
+        self._nextTick = time.time() + tick #time the current slot is due
+    
+    def __len__(self):
+        """Returns the number of scheduled items"""
+        return len(self._where)
+    
+    def schedule(self, item, when):
+        """Makes an item due at the time when, replacing its earlier timer if any"""
+        self.cancel(item)
+        ticks = max(int(math.ceil((when - self._nextTick) / self.tick)), 0)
+        index = (self._current + ticks) % len(self._slots)
+        self._slots[index][item] = ticks // len(self._slots)
+        self._where[item] = index
+    
+    def cancel(self, item):
+        """Forgets the timer of an item if it has one"""
+        index = self._where.pop(item, None)
+        if index is not None:
+            del self._slots[index][item]
+    
+    def untilNextTick(self, now):
+        """Returns the seconds until the next tick"""
+        return max(self._nextTick - now, 0)
+    
+    def advance(self, now):
+        """Moves the wheel up to now and returns a list of the items which are due.
+        They no longer have a timer."""
+        due = []
+        while self._nextTick <= now:
+            slot = self._slots[self._current]
+            if slot:
+                for item, turns in slot.items():
+                    if turns == 0:
+                        due.append(item)
+                        del slot[item]
+                        del self._where[item]
+                    else:
+                        slot[item] = turns - 1
+            self._current = (self._current + 1) % len(self._slots)
+            self._nextTick += self.tick
+        return due
+
+class ConnectionRegistry:
+    """Every open connection by its socket id. Connections are kept in a dense
+    list of slots which are reused once their connection is removed, and the
+    socket id of a connection is the index of its slot tagged with the
+    generation of the slot. Each time a slot is reused its generation goes up,
+    so an id which outlived its connection (such as one still held by a service)
+    is recognized as stale instead of reaching the connection which took over
+    the slot. Freed slots are reused oldest first. When the sockets are run by
+    several worker processes, each has its own registry and its ids also carry
+    the index of the worker, so that no two workers hand out the same id.
+    
+    Looking up a connection is a single list index without locking, so the
+    manager and switchboard threads don't contend on it. Only add, remove and
+    connections() take the lock. The open connections are also kept in a dense
+    list which a removed connection leaves by swapping the last one into its
+    place, so connections() copies only the open connections rather than going
+    through every slot."""
+    def __init__(self, shard=0):
+        """Creates an empty registry. shard is the index of the socket worker
+        process whose connections it holds."""
+        self._lock = threading.Lock()
+        self._shard = (shard & _SOCKET_SHARD_MASK) << SOCKET_SLOT_BITS #the bits of every id holding the index of the worker
+        self._slots = [] #slot -> connection or None
+        self._generations = [] #slot -> generation of the slot
+        self._free = collections.deque() #slots which can be reused, oldest first
+        self._active = [] #open connections in no particular order
+        self._positions = [] #slot -> index of its connection in _active
+    
+    def __len__(self):
+        """Returns the number of open connections"""
+        return len(self._active)
+    
+    def __contains__(self, socketId):
+        """Returns whether a socket id belongs to an open connection"""
+        return self.get(socketId) is not None
+    
+    def capacity(self):
+        """Returns the number of slots, which is the most connections there have
+        been open at once"""
+        return len(self._slots)
+    
+    def add(self, connection):
+        """Gives a connection a slot and sets its id, which is returned"""
+        with self._lock:
+            if self._free:
+                slot = self._free.popleft()
+            else:
+                slot = len(self._slots)
+                if slot > _SOCKET_SLOT_MASK:
+                    raise OverflowError("There are no free connection slots")
+                self._slots.append(None)
+                self._generations.append(0)
+                self._positions.append(0)
+            connection.id = (self._generations[slot] << (SOCKET_SLOT_BITS + SOCKET_SHARD_BITS)) | self._shard | slot
+            self._positions[slot] = len(self._active)
+            self._active.append(connection)
+            self._slots[slot] = connection
+        return connection.id
+    
+    def remove(self, connection):
+        """Frees the slot of a connection. Its id is stale from now on."""
+        slot = connection.id & _SOCKET_SLOT_MASK
+        with self._lock:
+            if slot >= len(self._slots) or self._slots[slot] is not connection:
+                return #already removed
+            self._slots[slot] = None
+            self._generations[slot] = (self._generations[slot] + 1) & _SOCKET_GENERATION_MASK
+            position = self._positions[slot]
+            last = self._active.pop()
+            if last is not connection:
+                #fill the hole with the last connection so the list stays dense
+                self._active[position] = last
+                self._positions[last.id & _SOCKET_SLOT_MASK] = position
+            self._free.append(slot)
+    
+    def get(self, socketId):
+        """Returns the open connection with the given id, or None if there is none
+        or the id is stale"""
+        try:
+            connection = self._slots[socketId & _SOCKET_SLOT_MASK]
+        except (IndexError, TypeError):
+            return None #the id is out of range or isn't a socket id at all
+        if connection is not None and connection.id == socketId:
+            return connection
+        return None
+    
+    def connections(self):
+        """Returns a list of the open connections"""
+        with self._lock:
+            return list(self._active)
+
+class RemoteRegistry:
+    """Every open connection of the socket worker processes by its socket id, as
+    the WebSocketHubSwitchboard of the server process sees them. The workers
+    give out the ids, so connections are kept by the id they already have
+    rather than given a slot. Only the switchboard thread adds and removes
+    connections."""
+    def __init__(self):
+        self._connections = {} #socket id -> connection
+    
+    def __len__(self):
+        """Returns the number of open connections"""
+        return len(self._connections)
+    
+    def __contains__(self, socketId):
+        """Returns whether a socket id belongs to an open connection"""
+        return socketId in self._connections
+    
+    def capacity(self):
+        """Returns the number of open connections, since there are no slots"""
+        return len(self._connections)
+    
+    def add(self, connection):
+        """Adds a connection under the id it already has, which is returned"""
+        self._connections[connection.id] = connection
+        return connection.id
+    
+    def remove(self, connection):
+        """Forgets a connection"""
+        if self._connections.get(connection.id) is connection:
+            del self._connections[connection.id]
+    
+    def get(self, socketId):
+        """Returns the open connection with the given id, or None if there is none"""
+        try:
+            return self._connections.get(socketId)
+        except TypeError:
+            return None #it isn't a socket id at all
+    
+    def connections(self):
+        """Returns a list of the open connections"""
+        return self._connections.values()
+
+class WebSocketTransaction(object):
         """Contains transaction data which is passed through the queues when sending
-        or receiving data to or from a socket."""
+        or receiving data to or from a socket.
+        
+        Transactions have fixed slots rather than an instance dictionary since one
+        is made for every message. Between processes they are written with
+        encode() and read with decode() rather than being pickled: a fixed header
+        of the type, the flags and the socket id followed by the data. Text is
+        written as UTF-8 and strings as they are. Anything which doesn't fit the
+        header, such as the list of sockets of a broadcast, a group name as the
+        socket id, the address of a new socket or a trace, is pickled after it."""
+        __slots__ = ("transactionType", "socketId", "data", "final", "binary", "trace")
         TRANSACTION_NEWSOCKET = 0 #used on the socket notification queue to inform a service it has a new socket with the given id
         TRANSACTION_DATA = 1 #used on send/recv queues to send/receive data to/from a socket
         TRANSACTION_CLOSE = 2 #used on send/recv queues to close the socket or inform the service the socket has been closed
-        def __init__(self, transactionType, socketId, data):
+        TRANSACTION_BROADCAST = 3 #used on send queues to send the same data to many sockets. socketId is a list of socket ids or a group name
+        TRANSACTION_JOINGROUP = 4 #used on send queues to add the socket to the group named by data
+        TRANSACTION_LEAVEGROUP = 5 #used on send queues to remove the socket from the group named by data
+        TRANSACTION_BACKPRESSURE = 6 #used on recv queues to tell the service data is true when the socket's outgoing data reached its high water mark and false once it drains below the low water mark
+        def __init__(self, transactionType, socketId, data, final=True, binary=False, trace=None):
             self.transactionType = transactionType
             self.socketId = socketId
             self.data = data
+            self.final = final #false for every part but the last of a message which is streamed to the service
+            self.binary = binary #data is raw bytes sent or received as a binary message rather than text
+            self.trace = trace #list of (TRACE_ stage, time) if this transaction is being traced by a Metrics.Tracer
+        
+        FLAG_FINAL = 0x01
+        FLAG_BINARY = 0x02
+        DATA_MASK = 0xF0 #the flags bits telling what kind of data follows the header
+        DATA_NONE = 0x00
+        DATA_BYTES = 0x10 #a str
+        DATA_TEXT = 0x20 #unicode written as UTF-8
+        DATA_FALSE = 0x30
+        DATA_TRUE = 0x40
+        DATA_PICKLED = 0x70 #a pickled (socketId, data, trace) tuple. the socket id in the header is not used
+        def encode(self):
+            """Returns the transaction as a str which decode() turns back into it"""
+            flags = (WebSocketTransaction.FLAG_FINAL if self.final else 0) | (WebSocketTransaction.FLAG_BINARY if self.binary else 0)
+            data = self.data
+            socketId = self.socketId
+            if self.trace is None and type(socketId) in (int, long) and _MIN_SOCKET_ID <= socketId <= _MAX_SOCKET_ID:
+                if data is None:
+                    return _TRANSACTION_HEADER.pack(self.transactionType, flags, socketId)
+                elif data is True or data is False:
+                    flags |= WebSocketTransaction.DATA_TRUE if data else WebSocketTransaction.DATA_FALSE
+                    return _TRANSACTION_HEADER.pack(self.transactionType, flags, socketId)
+                elif isinstance(data, str):
+                    return _TRANSACTION_HEADER.pack(self.transactionType, flags | WebSocketTransaction.DATA_BYTES, socketId) + data
+                elif isinstance(data, unicode):
+                    return _TRANSACTION_HEADER.pack(self.transactionType, flags | WebSocketTransaction.DATA_TEXT, socketId) + data.encode("utf-8")
+                elif self.binary and isinstance(data, (bytearray, buffer)):
+                    return _TRANSACTION_HEADER.pack(self.transactionType, flags | WebSocketTransaction.DATA_BYTES, socketId) + str(data)
+            return _TRANSACTION_HEADER.pack(self.transactionType, flags | WebSocketTransaction.DATA_PICKLED, 0) + cPickle.dumps((socketId, data, self.trace), cPickle.HIGHEST_PROTOCOL)
+        
+        @staticmethod
+        def decode(data, start=0, end=None):
+            """Returns the transaction encoded in data[start:end], where data is a
+            str or bytearray. Binary data which was sent as a bytearray or buffer
+            comes back as a str."""
+            end = len(data) if end is None else end
+            transactionType, flags, socketId = _TRANSACTION_HEADER.unpack_from(data, start)
+            start += _TRANSACTION_HEADER.size
+            kind = flags & WebSocketTransaction.DATA_MASK
+            trace = None
+            if kind == WebSocketTransaction.DATA_NONE:
+                value = None
+            elif kind == WebSocketTransaction.DATA_BYTES:
+                value = str(buffer(data, start, end - start))
+            elif kind == WebSocketTransaction.DATA_TEXT:
+                value = data[start:end].decode("utf-8")
+            elif kind == WebSocketTransaction.DATA_TRUE:
+                value = True
+            elif kind == WebSocketTransaction.DATA_FALSE:
+                value = False
+            else:
+                socketId, value, trace = cPickle.loads(str(buffer(data, start, end - start)))
+            return WebSocketTransaction(transactionType, socketId, value, flags & WebSocketTransaction.FLAG_FINAL != 0, flags & WebSocketTransaction.FLAG_BINARY != 0, trace)
+        
+        def __reduce__(self):
+            """Lets transactions still be pickled, such as by a multiprocessing queue"""
+            return (WebSocketTransaction, (self.transactionType, self.socketId, self.data, self.final, self.binary, self.trace))
 
-class WebSocketClient:
-    """Contains socket information about a client which is connected to the server."""
+class WebSocketClient(object):
+    """Contains socket information about a client which is connected to the server.
+    
+    A server may hold a great many connections which are idle nearly all of the
+    time, so a client is kept small: it has slots rather than a dictionary and
+    its receive and send states are only held while data is in flight. They are
+    taken from a pool kept by its WebSocketManager and given back once they are
+    empty. Its sendQueue is shared by every client until something is queued."""
+    __slots__ = ("id", "serviceId", "wsManager", "connection", "fileno", "address", "open", "lastReceived",
+                 "lastMessage", "pingSent", "lastPing", "sendQueue", "lock", "deflate", "streaming", "_readProgress", "_writeProgress")
     
     class WebSocketRecvState:
-            """Representation of the state of an in progress receiving operation"""
+            """Representation of the state of an in progress receiving operation.
+            
+            A receive state parses one frame at a time and collects the data frames
+            of a message, which may be fragmented, in messageBytes. Control frames
+            may arrive between the fragments and are collected separately in
+            controlBytes. Once it is idle between messages it can be handed to
+            another connection.
+            
+            When streamChunkSize is set, a message is handed over in parts of that
+            size as it arrives rather than being collected whole, so the memory used
+            stays bounded no matter how large the message is.
+            
+            When deflate is set, messages with the RSV1 bit set on their first frame
+            are decompressed as they are handed over."""
             STATE_TYPE = 0 #this state is used when the type byte is the next thing to receive
             STATE_LEN = 1 #this state is used when the length bytes still have some bytes which should be received next
             STATE_MASK = 2 #this state is used when the masks still ahve some bytes which should be received next
             STATE_PAYLOAD = 3 #this state is used when the payload still has some bytes which should be received next
-            STATE_DONE = 4 #this state is used when the web socket is done receiving
-            def __init__(self):
-                """Initializes an initial receive state to nothing recieved yet"""
+            STATE_DONE = 4 #this state is used when a frame is done being received
+            def __init__(self, maxMessageSize=0, streamChunkSize=None, deflate=None):
+                """Initializes an initial receive state to nothing recieved yet.
+                maxMessageSize is the largest message accepted, or 0 for no limit.
+                streamChunkSize is the size of the parts a message is handed over
+                in, or None to only hand over whole messages. deflate is the
+                PerMessageDeflate of the connection if compression was negotiated."""
+                self.maxMessageSize = maxMessageSize
+                self.streamChunkSize = streamChunkSize
+                self.deflate = deflate
+                self.messageCompressed = False #whether the message in progress is compressed
+                self.messageHandedOver = 0 #number of decompressed bytes of the message in progress handed over so far
+                self.messageOpcode = None #opcode of the message in progress or None between messages
+                self.messageLength = 0 #number of bytes of the message in progress announced so far
+                self.messageBytes = bytearray() #unmasked bytes of the message in progress which haven't been handed over
+                self.inflating = False #whether the last part decompressed was full, so more of it may be waiting
+                self._decoder = None #incremental UTF-8 decoder for text messages which are handed over in parts
+                self.nextFrame()
+            
+            def nextFrame(self):
+                """Gets ready to receive the next frame once a frame is done"""
                 self.typeByte = None
-                self.lenBytes = bytearray()
+                self.fin = False
+                self.opcode = None
+                self.headerBytes = bytearray() #type, length and mask bytes received so far
                 self.computedLength = 0
-                self.maskBytes = bytearray()
-                self.maskIndex = 0
-                self.unmaskedPayloadBytes = bytearray()
+                self.maskBytes = None
+                self.payloadReceived = 0 #number of payload bytes of this frame received so far
+                self.controlBytes = bytearray() #unmasked payload of a control frame
                 self.state = WebSocketClient.WebSocketRecvState.STATE_TYPE
             
+            def isControlFrame(self):
+                """Returns whether the frame being received is a control frame"""
+                return self.opcode >= OPCODE_CLOSE
+            
+            def isIdle(self):
+                """Returns whether nothing of a frame or a message has been received,
+                so that the state can be given to another connection"""
+                return self.state == WebSocketClient.WebSocketRecvState.STATE_TYPE and not self.headerBytes and self.messageOpcode is None
+            
+            def chunkReady(self):
+                """Returns whether a part of a streamed message is ready to be handed over"""
+                return self.streamChunkSize is not None and len(self.messageBytes) >= self.streamChunkSize
+            
+            def takeMessage(self, final):
+                """Returns the part of the message in progress which hasn't been
+                handed over yet. Text is decoded as UTF-8 and raises UnicodeDecodeError
+                if it isn't valid. Binary messages are returned as a str of the raw
+                bytes. When final is true the message is finished.
+                
+                A compressed message which is streamed is decompressed no more than
+                streamChunkSize bytes at a time. While inflating is true afterwards
+                there may be more of it, which has to be taken before anything else
+                is received, and the message isn't finished yet."""
+                data = self.messageBytes
+                self.messageBytes = bytearray()
+                if self.messageCompressed:
+                    limit = self.maxMessageSize - self.messageHandedOver if self.maxMessageSize > 0 else None
+                    data = self.deflate.decompress(bytes(data), final and not self.inflating, limit, self.streamChunkSize)
+                    self.messageHandedOver += len(data)
+                    self.inflating = self.streamChunkSize is not None and len(data) >= self.streamChunkSize
+                    final = final and not self.inflating
+                if self.messageOpcode == OPCODE_TEXT:
+                    if self._decoder is not None:
+                        data = self._decoder.decode(bytes(data), final)
+                    else:
+                        data = data.decode("utf-8")
+                else:
+                    data = bytes(data)
+                if final:
+                    self.messageOpcode = None
+                    self.messageLength = 0
+                    self.messageCompressed = False
+                    self.messageHandedOver = 0
+                    self._decoder = None
+                return data
+            
+            def _checkTypeByte(self, typeByte):
+                """Validates the first byte of a frame against the message in progress"""
+                self.fin = (typeByte & 0x80) != 0
+                self.opcode = typeByte & 0x0F
+                if typeByte & 0x70:
+                    #only RSV1 has a meaning, and only on the first frame of a message when compression was negotiated
+                    if typeByte & 0x70 != 0x40 or self.deflate is None or self.opcode not in (OPCODE_TEXT, OPCODE_BINARY):
+                        raise WebSocketInvalidDataException()
+                if self.opcode >= OPCODE_CLOSE:
+                    if self.opcode not in (OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG) or not self.fin:
+                        #control frames can't be fragmented
+                        raise WebSocketInvalidDataException()
+                elif self.opcode == OPCODE_CONTINUATION:
+                    if self.messageOpcode is None:
+                        #there is no message to continue
+                        raise WebSocketInvalidDataException()
+                elif self.opcode not in (OPCODE_TEXT, OPCODE_BINARY) or self.messageOpcode is not None:
+                    #a new message can't start before the last one is finished
+                    raise WebSocketInvalidDataException()
+                self.typeByte = typeByte
+            
+            def _headerLength(self):
+                """Returns the full length of the header being received, or None
+                if not enough of it has been received to tell yet"""
+                if len(self.headerBytes) < 2:
+                    return None
+                lengthCode = self.headerBytes[1] & 0x7F
+                if lengthCode == 0x7E:
+                    return 2 + 2 + 4
+                elif lengthCode == 0x7F:
+                    return 2 + 8 + 4
+                return 2 + 4
+            
+            def _parseHeader(self):
+                """Parses the completely received header into the length and mask"""
+                header = self.headerBytes
+                lengthCode = header[1] & 0x7F
+                if lengthCode == 0x7E:
+                    self.computedLength = _HEADER_LENGTH_16.unpack_from(header, 2)[0]
+                elif lengthCode == 0x7F:
+                    self.computedLength = _HEADER_LENGTH_64.unpack_from(header, 2)[0]
+                else:
+                    self.computedLength = lengthCode
+                if self.isControlFrame():
+                    if self.computedLength > 0x7D:
+                        #control frames can only have a short payload
+                        raise WebSocketInvalidDataException()
+                else:
+                    if self.maxMessageSize > 0 and self.messageLength + self.computedLength > self.maxMessageSize:
+                        #refuse it before any of the payload is buffered
+                        raise WebSocketMessageTooBigException()
+                    if self.opcode != OPCODE_CONTINUATION:
+                        self.messageOpcode = self.opcode
+                        self.messageCompressed = (self.typeByte & 0x40) != 0
+                        if self.opcode == OPCODE_TEXT and self.streamChunkSize is not None:
+                            self._decoder = codecs.getincrementaldecoder("utf-8")()
+                    self.messageLength += self.computedLength
+                self.maskBytes = bytes(header[-4:])
+                self.state = WebSocketClient.WebSocketRecvState.STATE_PAYLOAD
+                if self.computedLength == 0:
+                    self.state = WebSocketClient.WebSocketRecvState.STATE_DONE
+            
             def receive(self, receivedBytes):
                 """Processes some bytes into this object. Returns the unprocessed bytes.
                 
-                This operates as a state machine on the bytes as though they are an array. It
-                processes each byte individually and changes the state depending on the value
-                of the byte. In the case where there aren't enough bytes to complete a receive
-                sequence (going from STATE_TYPE to STATE_DONE), it should pick up where it left
-                off on the next receive."""
-                byteQueue = collections.deque(receivedBytes)
-                while len(byteQueue) > 0 and self.state != WebSocketClient.WebSocketRecvState.STATE_DONE:
-                    b = byteQueue.popleft() #pop from the beginning like a queue
-                    if self.state == WebSocketClient.WebSocketRecvState.STATE_TYPE:
-                        #process this byte as the initial type declarer
-                        if b != 0x81:
-                            #this shouldn't be anything but 0x81
-                            raise WebSocketInvalidDataException()
-                        self.typeByte = b
-                        self.state = WebSocketClient.WebSocketRecvState.STATE_LEN
-                    elif self.state == WebSocketClient.WebSocketRecvState.STATE_LEN:
-                        #process this byte as part of the length
-                        if len(self.lenBytes) == 0:
-                            #this is the first byte
-                            if b < 0x80:
+                The header is collected until it is complete and then parsed in one
+                go. Payload bytes are unmasked a whole span at a time. This stops
+                when a frame is done (STATE_DONE) or a part of a streamed message is
+                ready, so that the caller can handle it before passing in the rest.
+                In the case where there aren't enough bytes to complete a frame, it
+                should pick up where it left off on the next receive."""
+                offset = 0
+                available = len(receivedBytes)
+                while offset < available and self.state != WebSocketClient.WebSocketRecvState.STATE_DONE and not self.chunkReady():
+                    if self.state != WebSocketClient.WebSocketRecvState.STATE_PAYLOAD:
+                        #still receiving the header
+                        needed = self._headerLength()
+                        if needed is None:
+                            needed = 2
+                        take = min(needed - len(self.headerBytes), available - offset)
+                        self.headerBytes += receivedBytes[offset:offset + take]
+                        offset += take
+                        if len(self.headerBytes) >= 1 and self.typeByte is None:
+                            self._checkTypeByte(self.headerBytes[0])
+                            self.state = WebSocketClient.WebSocketRecvState.STATE_LEN
+                        if len(self.headerBytes) >= 2:
+                            if self.headerBytes[1] < 0x80:
                                 #it should have its 8th bit set since we need masked communication
                                 raise WebSocketInvalidDataException()
-                            b = b & 0x7F #unmask it
-                            self.lenBytes.append(b)
-                            #figure out what to do next
-                            if b <= 0x7D:
-                                #this is the only length byte we need. time to move on to masks
-                                self.computedLength = b
-                                self.state = WebSocketClient.WebSocketRecvState.STATE_MASK
-                            #if we haven't changed the state by now, it needs some more information
-                        elif self.lenBytes[0] == 0x7E:
-                            #two bytes length (16 bits)
-                            self.lenBytes.append(b)
-                            if len(self.lenBytes) == 3:
-                                #this was the last one
-                                self.computedLength = ((self.lenBytes[1] & 0xFF) << 8 | (self.lenBytes[2] & 0xFF))
-                                self.state = WebSocketClient.WebSocketRecvState.STATE_MASK
-                        elif self.lenBytes[0] == 0x7F:
-                            #eight bytes length (64 bits)
-                            self.lenBytes.append(b)
-                            if len(self.lenBytes) == 9:
-                                #this was the last one
-                                self.computedLength = (self.lenBytes[1] & 0xFF) << 56
-                                self.computedLength |= (self.lenBytes[2] & 0xFF) << 48
-                                self.computedLength |= (self.lenBytes[3] & 0xFF) << 40
-                                self.computedLength |= (self.lenBytes[4] & 0xFF) << 32
-                                self.computedLength |= (self.lenBytes[5] & 0xFF) << 24
-                                self.computedLength |= (self.lenBytes[6] & 0xFF) << 16
-                                self.computedLength |= (self.lenBytes[7] & 0xFF) << 8
-                                self.computedLength |= self.lenBytes[8] & 0xFF
-                                self.state = WebSocketClient.WebSocketRecvState.STATE_MASK
-                    elif self.state == WebSocketClient.WebSocketRecvState.STATE_MASK:
-                        #process this byte as part of the masks
-                        self.maskBytes.append(b)
-                        if len(self.maskBytes) == 4:
-                            #all masks received
-                            self.state = WebSocketClient.WebSocketRecvState.STATE_PAYLOAD
-                    elif self.state == WebSocketClient.WebSocketRecvState.STATE_PAYLOAD:
-                        #process this byte as part of the payload
-                        b = b ^ self.maskBytes[self.maskIndex]
-                        self.maskIndex = (self.maskIndex + 1) % 4
-                        self.unmaskedPayloadBytes.append(b)
-                        if len(self.unmaskedPayloadBytes) == self.computedLength:
-                            #we are done receiving
+                            self.state = WebSocketClient.WebSocketRecvState.STATE_MASK
+                            if len(self.headerBytes) == self._headerLength():
+                                self._parseHeader()
+                    else:
+                        #process a span of bytes as the payload
+                        take = min(self.computedLength - self.payloadReceived, available - offset)
+                        if self.isControlFrame():
+                            self.controlBytes += unmaskBytes(receivedBytes[offset:offset + take], self.maskBytes, self.payloadReceived)
+                        else:
+                            if self.streamChunkSize is not None:
+                                take = min(take, self.streamChunkSize - len(self.messageBytes))
+                            self.messageBytes += unmaskBytes(receivedBytes[offset:offset + take], self.maskBytes, self.payloadReceived)
+                        offset += take
+                        self.payloadReceived += take
+                        if self.payloadReceived == self.computedLength:
+                            #we are done receiving this frame
                             self.state = WebSocketClient.WebSocketRecvState.STATE_DONE
-                #process the remaining bytes into a bytearray and return it
-                return bytearray(byteQueue)
+                #return the remaining bytes
+                return receivedBytes[offset:]
+    
+    class WebSocketSendState:
+            """Representation of the frames which are waiting to be written to a socket.
+            
+            Frames are kept as separate header and payload buffers which are never
+            copied into a single frame. Partially written buffers are tracked as
+            memoryview slices of the original buffer."""
+            def __init__(self):
+                """Initializes a send state with nothing to send"""
+                self.buffers = collections.deque() #memoryviews of everything left to send, in order
+                self.pendingBytes = 0
+            
+            def queueFrame(self, header, payload):
+                """Adds an encoded frame to the end of the data to be sent"""
+                self.buffers.append(memoryview(header))
+                if len(payload) > 0:
+                    self.buffers.append(memoryview(payload))
+                self.pendingBytes += len(header) + len(payload)
+            
+            def isEmpty(self):
+                """Returns whether everything has been sent"""
+                return self.pendingBytes == 0
+            
+            def send(self, sock):
+                """Sends as much of the pending data as the socket will take in
+                a single call. Several queued frames are sent together. Returns
+                the number of bytes sent."""
+                if _HAS_SENDMSG:
+                    nSent = sock.sendmsg(list(itertools.islice(self.buffers, 0, MAX_IOVEC)))
+                elif len(self.buffers) == 1 or len(self.buffers[0]) >= SEND_COALESCE_LIMIT:
+                    nSent = sock.send(self.buffers[0])
+                else:
+                    #without writev the buffers have to be joined, so only copy as much as one send is likely to take
+                    joined = bytearray()
+                    for buf in itertools.islice(self.buffers, 0, MAX_IOVEC):
+                        joined += buf[:SEND_COALESCE_LIMIT - len(joined)]
+                        if len(joined) >= SEND_COALESCE_LIMIT:
+                            break
+                    nSent = sock.send(joined)
+                self._consume(nSent)
+                return nSent
+            
+            def _consume(self, nSent):
+                """Drops the given number of sent bytes from the front of the buffers"""
+                self.pendingBytes -= nSent
+                while nSent > 0:
+                    buf = self.buffers[0]
+                    if nSent < len(buf):
+                        #only part of this one was sent, so keep a view of the rest
+                        self.buffers[0] = buf[nSent:]
+                        return
+                    nSent -= len(buf)
+                    self.buffers.popleft()
+    
     
     
+    class SendLimits:
+            """Water marks and slow consumer policy for the outgoing data of each
+            connection. A limit of 0 means there is no limit."""
+            POLICY_DROP_OLDEST = "drop-oldest" #the oldest queued messages are dropped to make room
+            POLICY_DROP_NEWEST = "drop-newest" #new messages are dropped until the queue drains below the low water mark
+            POLICY_CONFLATE = "conflate" #every queued message is replaced by the newest one
+            POLICY_DISCONNECT = "disconnect" #the connection is closed
+            POLICIES = (POLICY_DROP_OLDEST, POLICY_DROP_NEWEST, POLICY_CONFLATE, POLICY_DISCONNECT)
+            def __init__(self, highMessages=4096, lowMessages=1024, highBytes=8 * 1024 * 1024, lowBytes=2 * 1024 * 1024, policy=POLICY_DISCONNECT):
+                if policy not in WebSocketClient.SendLimits.POLICIES:
+                    raise ValueError("Unknown slow consumer policy: " + str(policy))
+                self.highMessages = highMessages
+                self.lowMessages = lowMessages
+                self.highBytes = highBytes
+                self.lowBytes = lowBytes
+                self.policy = policy
+    
+    class KeepaliveLimits:
+            """Keepalive and idle timeouts of each connection, in seconds. A value of
+            0 turns that timeout off.
+            
+            A connection which hasn't sent anything for pingInterval is sent a
+            ping, and is pinged again every pingInterval for as long as it stays
+            quiet. If nothing at all arrives from it within pongTimeout after the
+            first of those pings, its peer is taken to be gone (such as a phone
+            which lost its network without closing the TCP connection) and the
+            socket is removed. With a pongTimeout of 0 it is never removed for
+            not answering.
+            A connection which hasn't sent a message for idleTimeout is closed, even
+            if it answers pings."""
+            def __init__(self, pingInterval=30.0, pongTimeout=10.0, idleTimeout=0.0):
+                self.pingInterval = pingInterval
+                self.pongTimeout = pongTimeout
+                self.idleTimeout = idleTimeout
+    
+    class WebSocketSendQueue:
+            """Transactions waiting to be written to a connection. This is used in
+            place of a Queue.Queue so that the amount of data waiting for a slow
+            client is bounded. Once the high water mark of the SendLimits would be
+            exceeded the slow consumer policy is applied, and the connection stays
+            congested until it drains below the low water mark.
+            
+            Close transactions are never dropped or counted."""
+            def __init__(self, limits):
+                self.limits = limits
+                self._items = collections.deque()
+                self._lock = threading.Lock()
+                self.queuedBytes = 0 #bytes of data in the queued transactions
+                self.congested = False
+                self.dropped = 0 #number of messages dropped by the policy
+                self.disconnectRequested = False #set by the disconnect policy
+                self._relieved = False
+            
+            @staticmethod
+            def _size(transaction):
+                """Returns the number of bytes counted for a transaction"""
+                if transaction.transactionType == WebSocketTransaction.TRANSACTION_BROADCAST:
+                    return len(transaction.data[0]) + len(transaction.data[1])
+                elif transaction.transactionType == WebSocketTransaction.TRANSACTION_DATA:
+                    return len(transaction.data)
+                return 0
+            
+            def _isHigh(self, messages, nBytes):
+                """Returns whether the given amounts are over the high water mark"""
+                limits = self.limits
+                return (limits.highMessages > 0 and messages > limits.highMessages) or (limits.highBytes > 0 and nBytes > limits.highBytes)
+            
+            def _isLow(self):
+                """Returns whether the queue is at or below the low water mark"""
+                limits = self.limits
+                return (limits.highMessages <= 0 or len(self._items) <= limits.lowMessages) and (limits.highBytes <= 0 or self.queuedBytes <= limits.lowBytes)
+            
+            def _drop(self, keep):
+                """Drops queued messages from the oldest until keep returns true"""
+                kept = collections.deque()
+                while self._items and not keep():
+                    transaction = self._items.popleft()
+                    if transaction.transactionType == WebSocketTransaction.TRANSACTION_CLOSE:
+                        kept.append(transaction)
+                        continue
+                    self.queuedBytes -= WebSocketClient.WebSocketSendQueue._size(transaction)
+                    self.dropped += 1
+                kept.extend(self._items)
+                self._items = kept
+            
+            def put(self, transaction):
+                """Adds a transaction to the end of the queue, applying the policy
+                if this would go over the high water mark. Returns true if this made
+                the connection congested."""
+                size = WebSocketClient.WebSocketSendQueue._size(transaction)
+                with self._lock:
+                    wasCongested = self.congested
+                    if transaction.transactionType != WebSocketTransaction.TRANSACTION_CLOSE and self._items and (self.congested or self._isHigh(len(self._items) + 1, self.queuedBytes + size)):
+                        policy = self.limits.policy
+                        if policy == WebSocketClient.SendLimits.POLICY_DISCONNECT:
+                            self.disconnectRequested = True
+                            self.congested = True
+                            return not wasCongested
+                        elif policy == WebSocketClient.SendLimits.POLICY_DROP_NEWEST:
+                            self.dropped += 1
+                            self.congested = True
+                            return not wasCongested
+                        elif policy == WebSocketClient.SendLimits.POLICY_DROP_OLDEST:
+                            if self._isHigh(len(self._items) + 1, self.queuedBytes + size):
+                                self._drop(self._isLow)
+                                self.congested = True
+                        else:
+                            self._drop(lambda: False)
+                            self.congested = True
+                    self._items.append(transaction)
+                    self.queuedBytes += size
+                    self._relieved = False
+                    return self.congested and not wasCongested
+            
+            def get_nowait(self):
+                """Removes and returns the oldest transaction. Raises Queue.Empty if
+                there is nothing queued."""
+                with self._lock:
+                    if not self._items:
+                        raise Queue.Empty()
+                    transaction = self._items.popleft()
+                    self.queuedBytes -= WebSocketClient.WebSocketSendQueue._size(transaction)
+                    if self.congested and self._isLow():
+                        self.congested = False
+                        self._relieved = True
+                    return transaction
+            
+            def relieved(self):
+                """Returns true once after the connection stopped being congested"""
+                with self._lock:
+                    relieved = self._relieved
+                    self._relieved = False
+                    return relieved
+            
+            def empty(self):
+                """Returns whether nothing is queued"""
+                return not self._items
+            
+            def qsize(self):
+                """Returns the number of queued transactions"""
+                return len(self._items)
     
+    class WebSocketSwitchboard(threading.Thread):
+        """Thread which operates the "switchboard" between the service send/recv
+        queues and the individual socket queues. One switchboard can be shared by
+        several WebSocketManagers, in which case it hands transactions for a socket
+        to the manager which owns that socket.
+        
+        Transactions are moved to and from the service queues in batches of up to
+        batchSize with a single write or read. Transactions for a service are
+        held for up to flushDelay seconds so that more of them go in each write,
+        which trades a little latency for throughput when there are many small
+        messages."""
+        
+        def __init__(self, stopEvent, processDirectory, metrics=None, tracer=None, batchSize=SERVICE_BATCH_SIZE, flushDelay=SERVICE_FLUSH_DELAY, registry=None):
+            """Initializes a new switchboard with a multiprocessing.Event (stopEvent)
+            to stop the thread gracefully and the process directory which will
+            contain all the processes. metrics is the Metrics.Registry and tracer
+            the Metrics.Tracer shared with the managers. registry is the
+            ConnectionRegistry the sockets are found in, WebSocketClient.registry
+            unless another is given."""
+            threading.Thread.__init__(self)
+            self.sockets = registry if registry is not None else WebSocketClient.registry #sockets of every manager by their ids
+            self.stopEvent = stopEvent
+            self.processDirectory = processDirectory
+            self._inbound = collections.deque() #(socket, transaction) waiting to be passed to the socket's service, in order
+            self._switchPoller = EventPoller()
+            self._switchWaker = EventWaker()
+            self._switchPoller.register(self._switchWaker.fileno(), EventPoller.EVENT_READ)
+            self._routes = {} #process id -> ProcessRecord, rebuilt only when the process directory changes
+            self._routeGeneration = None
+            self._serviceReaders = {} #sendQueue file descriptor -> WorkerRecord
+            self._serviceWriters = {} #recvQueue file descriptor -> WorkerRecord for queues with unflushed data
+            self.batchSize = max(batchSize, 1)
+            self.flushDelay = flushDelay
+            self._batches = {} #WorkerRecord -> list of transactions not yet put in its recvQueue
+            self._batchStarted = {} #WorkerRecord -> time the first transaction of its batch was added
+            self._nextTick = time.time() + WORKER_CHECK_INTERVAL
+            self._replacements = collections.deque() #(ProcessRecord, position, WorkerRecord) to swap in, or (ProcessRecord, None, None) for a removed service
+            self._replayed = set() #ids of sockets whose TRANSACTION_NEWSOCKET was repeated for a replacement worker
+            processDirectory.addListener(self._switchWaker.wake)
+            self.groups = {} #group name -> set of socket ids
+            self._socketGroups = {} #socket id -> set of group names it belongs to
+            self.metrics = metrics if metrics is not None else Metrics.Registry()
+            self.tracer = tracer if tracer is not None else Metrics.Tracer(self.metrics)
+            self._serviceNames = set() #names of the services which have metrics
+            self._messagesIn = {} #service id -> Counter of transactions passed to the service
+            self._messagesOut = {} #sendQueue file descriptor -> Counter of transactions from the service
+            self._broadcasts = self.metrics.counter("broadcasts")
+            self._broadcastDeliveries = self.metrics.counter("broadcastDeliveries")
+            self._droppedMessages = self.metrics.counter("droppedMessages")
+            self.metrics.gauge("socketSlots", self.sockets.capacity)
+            self._loopTime = self.metrics.histogram("loopTime", thread="switchboard")
+        
+        def addWebSocket(self, s):
+            """Starts routing transactions to and from a socket. If the socket
+            already belongs to a service, the service is informed of the new socket.
+            The socket was put in the registry when it was created."""
+            if s.serviceId is not None:
+                #this goes through the same queue as the socket's data so that it always reaches the service first
+                self.queueToService(s, WebSocketTransaction(WebSocketTransaction.TRANSACTION_NEWSOCKET, s.id, s.address))
+        
+        def queueToService(self, s, transaction):
+            """Queues a transaction from a socket and wakes the switchboard so that
+            it is passed on to the socket's service. Transactions from every socket
+            share one queue, so an idle socket doesn't need a queue of its own."""
+            self._inbound.append((s, transaction))
+            self._switchWaker.wake()
+        
+        def _routeToSockets(self, transaction):
+            """Delivers a transaction from a service to the socket or sockets it is meant for"""
+            transactionType = transaction.transactionType
+            if transaction.trace is not None:
+                transaction.trace.append((TRACE_ROUTED, time.time()))
+            if transactionType == WebSocketTransaction.TRANSACTION_BROADCAST:
+                self._broadcast(transaction)
+            elif transactionType == WebSocketTransaction.TRANSACTION_JOINGROUP:
+                if transaction.socketId in self.sockets:
+                    self.groups.setdefault(transaction.data, set()).add(transaction.socketId)
+                    self._socketGroups.setdefault(transaction.socketId, set()).add(transaction.data)
+            elif transactionType == WebSocketTransaction.TRANSACTION_LEAVEGROUP:
+                self._leaveGroup(transaction.socketId, transaction.data)
+                self._socketGroups.get(transaction.socketId, set()).discard(transaction.data)
+            else:
+                s = self.sockets.get(transaction.socketId)
+                if s is not None:
+                    self._queueToSocket(s, transaction)
+                    s.wsManager._requestWrite(s)
+        
+        def _queueToSocket(self, s, transaction):
+            """Puts a transaction in a socket's sendQueue and lets the service know
+            if the socket became congested"""
+            sendQueue = s.sendQueue
+            if sendQueue is WebSocketClient.idleSendQueue:
+                #only the switchboard puts anything in a sendQueue, so it is the one to give the socket its own
+                sendQueue = s.sendQueue = WebSocketClient.WebSocketSendQueue(s.wsManager.sendLimits)
+            dropped = sendQueue.dropped
+            if sendQueue.put(transaction):
+                self.queueToService(s, WebSocketTransaction(WebSocketTransaction.TRANSACTION_BACKPRESSURE, s.id, True))
+            if sendQueue.dropped != dropped:
+                self._droppedMessages.inc(sendQueue.dropped - dropped)
+        
+        def _leaveGroup(self, socketId, name):
+            """Removes a socket from a group, forgetting the group once it is empty"""
+            members = self.groups.get(name)
+            if members is not None:
+                members.discard(socketId)
+                if not members:
+                    self.groups.pop(name)
+        
+        def _broadcast(self, transaction):
+            """Sends the data of a broadcast transaction to every socket it names.
+            The frame is encoded once and the same buffers are queued on every
+            target socket. Sockets which negotiated compression get a frame which
+            is compressed once for every socket using the same window size."""
+            targets = transaction.socketId
+            if isinstance(targets, basestring):
+                targets = self.groups.get(targets, ())
+            header, payload = WebSocketClient.WebSocketManager._stringToFrame(transaction.data, transaction.binary)
+            plain = WebSocketTransaction(WebSocketTransaction.TRANSACTION_BROADCAST, None, (header, payload, False))
+            compressed = {} #window bits -> broadcast transaction compressed for that window size
+            opcode = OPCODE_BINARY if transaction.binary else OPCODE_TEXT
+            get = self.sockets.get
+            recipients = [s for s in [get(sockId) for sockId in targets] if s is not None]
+            byManager = {}
+            for s in recipients:
+                encoded = plain
+                if s.deflate is not None and len(payload) >= DEFLATE_MIN_SIZE:
+                    encoded = compressed.get(s.deflate.serverWindowBits)
+                    if encoded is None:
+                        data = s.deflate.compressShared(payload)
+                        encoded = WebSocketTransaction(WebSocketTransaction.TRANSACTION_BROADCAST, None, (encodeFrameHeader(len(data), opcode, True), data, True))
+                        compressed[s.deflate.serverWindowBits] = encoded
+                self._queueToSocket(s, encoded)
+                byManager.setdefault(s.wsManager, []).append(s)
+            for manager in byManager:
+                manager._requestWrites(byManager[manager])
+            if transaction.trace is not None:
+                #the frames are shared by every recipient, so a traced broadcast ends here
+                self.tracer.finish(transaction.trace)
+            self._broadcasts.inc()
+            self._broadcastDeliveries.inc(len(recipients))
+        
+        def _refreshRoutes(self):
+            """Rebuilds the service id -> ProcessRecord routing table and starts
+            watching the sendQueues of any new workers"""
+            self._routeGeneration = self.processDirectory.getGeneration()
+            routes = self.processDirectory.getAllProcesses()
+            readers = {}
+            self._messagesIn = {}
+            self._messagesOut = {}
+            names = set()
+            for record in routes.values():
+                names.add(record.name)
+                self._messagesIn[record.id] = self.metrics.counter("serviceMessagesIn", service=record.name)
+                messagesOut = self.metrics.counter("serviceMessagesOut", service=record.name)
+                self.metrics.gauge("serviceQueuedBytes", lambda record=record: sum(worker.recvQueue.pendingBytes() for worker in record.workers), service=record.name)
+                self.metrics.gauge("serviceWorkers", lambda record=record: sum(1 for worker in record.workers if worker.is_alive()), service=record.name)
+                self.metrics.gauge("serviceRestarts", lambda record=record: record.restarts, service=record.name)
+                for worker in record.workers:
+                    readers[worker.sendQueue.fileno()] = worker
+                    self._messagesOut[worker.sendQueue.fileno()] = messagesOut
+            for name in self._serviceNames - names:
+                #the service is gone, so its queues are too. the message counts are kept.
+                for gauge in ("serviceQueuedBytes", "serviceWorkers", "serviceRestarts"):
+                    self.metrics.remove(gauge, service=name)
+            self._serviceNames = names
+            for fd in self._serviceReaders:
+                if readers.get(fd) is not self._serviceReaders[fd]:
+                    worker = self._serviceReaders[fd]
+                    self._switchPoller.unregister(fd)
+                    if self._serviceWriters.pop(worker.recvQueue.writerFileno(), None) is not None:
+                        self._switchPoller.unregister(worker.recvQueue.writerFileno())
+            for fd in readers:
+                if self._serviceReaders.get(fd) is not readers[fd]:
+                    self._switchPoller.register(fd, EventPoller.EVENT_READ)
+            self._serviceReaders = readers
+            self._routes = routes
+        
+        def replaceWorker(self, record, position, worker):
+            """Hands over a worker started in place of the dead worker at the given
+            position of a service's pool. It is swapped in by the switchboard
+            thread, so no transaction can reach it before it has been told about
+            the sockets it takes over."""
+            self._replacements.append((record, position, worker))
+            self._switchWaker.wake()
+        
+        def retireService(self, record):
+            """Hands over a service which has been removed from the process directory
+            so that the switchboard stops using the queues of its workers and
+            closes them"""
+            self._replacements.append((record, None, None))
+            self._switchWaker.wake()
+        
+        def _swapWorkers(self):
+            """Swaps in the replacement workers and retires the dead workers and
+            removed services handed over by replaceWorker and retireService"""
+            while self._replacements:
+                record, position, worker = self._replacements.popleft()
+                if position is None:
+                    for dead in record.workers:
+                        self._retireWorker(record, dead)
+                else:
+                    self._retireWorker(record, record.replaceWorker(position, worker))
+                    self._announceSockets(record, worker)
+            self._refreshRoutes()
+        
+        def _retireWorker(self, record, worker):
+            """Stops watching the queues of a dead worker and closes them. Whatever
+            was still waiting to be written to the worker is lost."""
+            fd = worker.sendQueue.fileno()
+            if self._serviceReaders.get(fd) is worker:
+                self._switchPoller.unregister(fd)
+                del self._serviceReaders[fd]
+            fd = worker.recvQueue.writerFileno()
+            if self._serviceWriters.pop(fd, None) is not None:
+                self._switchPoller.unregister(fd)
+            batch = self._batches.pop(worker, [])
+            if batch:
+                self._batchStarted.pop(worker)
+            if batch or worker.recvQueue.hasPendingWrites():
+                print "Notice: Worker", worker.process.pid, "of service", record.name, "died with", len(batch), "transactions from", len(set(transaction.socketId for transaction in batch)), "sockets and", worker.recvQueue.pendingBytes(), "bytes still to be written to it. They are lost."
+            worker.close()
+        
+        def _announceSockets(self, record, worker):
+            """Sends a TRANSACTION_NEWSOCKET to a replacement worker for every open
+            socket it takes over from the dead worker, which is the only one which
+            was told about them. Sockets whose own TRANSACTION_NEWSOCKET hasn't been
+            passed on yet get that one instead, and if it is still to be queued it
+            is dropped when it arrives."""
+            sockets = self.sockets.connections()
+            waiting = set(s.id for s, transaction in list(self._inbound) if transaction.transactionType == WebSocketTransaction.TRANSACTION_NEWSOCKET)
+            announcements = []
+            for s in sockets:
+                if s.serviceId == record.id and s.id not in waiting and record.getWorker(s.id) is worker:
+                    announcements.append(WebSocketTransaction(WebSocketTransaction.TRANSACTION_NEWSOCKET, s.id, s.address))
+                    self._replayed.add(s.id)
+            if announcements:
+                worker.recvQueue.putMany(announcements)
+                self._flushToService(worker)
+        
+        def _flushToService(self, worker):
+            """Writes whatever is buffered in a worker's recvQueue, watching the queue
+            for writability only while something is left over"""
+            fd = worker.recvQueue.writerFileno()
+            if worker.recvQueue.flush():
+                if self._serviceWriters.pop(fd, None) is not None:
+                    self._switchPoller.unregister(fd)
+            elif fd not in self._serviceWriters:
+                self._serviceWriters[fd] = worker
+                self._switchPoller.register(fd, EventPoller.EVENT_WRITE)
+        
+        def _workerFor(self, s):
+            """Returns the worker of its service which the transactions of a socket
+            are passed to, counting the transaction for the service, or None if
+            the service isn't running"""
+            record = self._routes.get(s.serviceId)
+            if record is None:
+                return None
+            self._messagesIn[s.serviceId].inc()
+            return record.getWorker(s.id)
+        
+        def _addToBatch(self, worker, transaction):
+            """Adds a transaction to the batch gathered for a worker, which is
+            written once it is full"""
+            batch = self._batches.get(worker)
+            if batch is None:
+                batch = self._batches[worker] = []
+                self._batchStarted[worker] = time.time()
+            batch.append(transaction)
+            if len(batch) >= self.batchSize:
+                self._sendBatch(worker)
+        
+        def _sendBatch(self, worker):
+            """Puts the batch of transactions gathered for a worker in its recvQueue"""
+            worker.recvQueue.putMany(self._batches.pop(worker))
+            self._batchStarted.pop(worker)
+            self._flushToService(worker)
+        
+        def _untilBatchDue(self, now):
+            """Returns the seconds until the oldest batch has to be written or None
+            if there are no batches"""
+            if not self._batchStarted:
+                return None
+            return max(min(self._batchStarted.values()) + self.flushDelay - now, 0)
+        
+        def _forwardToServices(self):
+            """Passes the transactions queued by the sockets on to their services.
+            Batches are written once they are full or have waited for flushDelay."""
+            inbound = self._inbound
+            for i in xrange(len(inbound)):
+                #only take what was there to begin with so that busy sockets can't keep the switchboard here
+                s, transaction = inbound.popleft()
+                if self.sockets.get(s.id) is not s:
+                    self._replayed.discard(s.id)
+                    continue #it was closed, so anything after its close transaction is dropped
+                if self._replayed and s.id in self._replayed:
+                    if transaction.transactionType == WebSocketTransaction.TRANSACTION_NEWSOCKET:
+                        self._replayed.discard(s.id)
+                        continue #the replacement worker was already told about it
+                    if transaction.transactionType == WebSocketTransaction.TRANSACTION_CLOSE:
+                        self._replayed.discard(s.id)
+                worker = self._workerFor(s)
+                if worker is not None:
+                    if transaction.trace is not None:
+                        transaction.trace.append((TRACE_FORWARDED, time.time()))
+                    self._addToBatch(worker, transaction)
+                #if this was a close transaction, we need to remove it from our list
+                if transaction.transactionType == WebSocketTransaction.TRANSACTION_CLOSE:
+                    self.sockets.remove(s) #its id is stale from now on
+                    for name in self._socketGroups.pop(s.id, ()):
+                        self._leaveGroup(s.id, name)
+            now = time.time()
+            for worker in self._batchStarted.keys():
+                if self._batchStarted[worker] + self.flushDelay <= now:
+                    self._sendBatch(worker)
+        
+        def run(self):
+            """Thread method to operate the "switchboard" between server queues and the individual socket queues.
+            
+            This only wakes up when a service has sent something, a socket has
+            received something, or a service's recvQueue can take more data.
+            The routing table is only rebuilt when the process directory changes
+            or workers are replaced. Every WORKER_CHECK_INTERVAL seconds the
+            metrics are ticked."""
+            while self.stopEvent.is_set() == False:
+                untilBatch = self._untilBatchDue(time.time())
+                ready = self._switchPoller.poll(POLL_TIMEOUT if untilBatch is None else min(untilBatch, POLL_TIMEOUT))
+                started = time.time()
+                if started >= self._nextTick:
+                    self._nextTick = started + WORKER_CHECK_INTERVAL
+                    self._tick()
+                if self._replacements:
+                    self._swapWorkers()
+                if self._routeGeneration != self.processDirectory.getGeneration():
+                    self._refreshRoutes()
+                for fd, events in ready:
+                    if fd == self._switchWaker.fileno():
+                        self._switchWaker.drain()
+                    elif fd in self._serviceReaders:
+                        #read through the sendQueue of this worker and send it to the appropriate sockets
+                        worker = self._serviceReaders[fd]
+                        messagesOut = self._messagesOut[fd]
+                        while True:
+                            transactions = worker.sendQueue.getMany(self.batchSize, False)
+                            if not transactions:
+                                break
+                            messagesOut.inc(len(transactions))
+                            for transaction in transactions:
+                                self._routeToSockets(transaction)
+                    elif fd in self._serviceWriters:
+                        self._flushToService(self._serviceWriters[fd])
+                    else:
+                        self._handleEvent(fd, events)
+                self._forwardToServices()
+                self._loopTime.observe(time.time() - started)
+        
+        def _tick(self):
+            """Called every WORKER_CHECK_INTERVAL seconds by the switchboard thread"""
+            self.metrics.tick()
+        
+        def _handleEvent(self, fd, events):
+            """Handles an event of a descriptor which isn't a service queue. The
+            switchboards of the socket worker processes watch more of them."""
+            pass
+        
+    class WebSocketHubSwitchboard(WebSocketSwitchboard):
+        """Switchboard of the server process when the sockets are run by several
+        worker processes (see WebSocketManagerPool). It passes transactions
+        between the services and the workers, which talk to it over a pair of
+        ServiceQueues each just like the worker of a service does. Each socket
+        of a worker is stood in for by a RemoteSocket, so routing to services,
+        groups and replacing dead service workers work the same as for sockets
+        of the server process. A broadcast is sent to each worker once, naming
+        those of its sockets which should get it, and the worker frames and
+        compresses it.
+        
+        Besides transactions, the workers send control messages: pickled
+        (SHARD_ kind, request number, data) tuples asking for the service at a
+        location or for the statistics, which the resolver (the ServiceStarter
+        of the server) answers from its own thread. Every WORKER_CHECK_INTERVAL
+        seconds each worker also sends a snapshot of its metrics, which is kept
+        in shardMetrics."""
+        
+        class RemoteSocket(object):
+            """Stands in for a socket of a worker process"""
+            __slots__ = ("id", "serviceId", "address", "shard")
+            def __init__(self, socketId, serviceId, address, shard):
+                self.id = socketId
+                self.serviceId = serviceId
+                self.address = address
+                self.shard = shard #WorkerRecord of the worker process which owns the socket
+        
+        def __init__(self, stopEvent, processDirectory, metrics=None, tracer=None, batchSize=SERVICE_BATCH_SIZE, flushDelay=SERVICE_FLUSH_DELAY):
+            """Initializes a switchboard with no worker processes. They are added
+            with addShard. See WebSocketSwitchboard for the arguments."""
+            WebSocketClient.WebSocketSwitchboard.__init__(self, stopEvent, processDirectory, metrics, tracer, batchSize, flushDelay, RemoteRegistry())
+            self.resolver = None #answers the workers when they ask for a service or the statistics
+            self.shardMetrics = {} #index of a worker process -> latest snapshot of its metrics
+            self._shards = {} #WorkerRecord of a worker process -> its index
+            self._shardReaders = {} #sendQueue file descriptor -> WorkerRecord of a worker process
+            self._shardChanges = collections.deque() #(index, WorkerRecord, whether it is added rather than retired)
+            self._replies = collections.deque() #(WorkerRecord, control message) to send to worker processes
+        
+        def addShard(self, index, shard):
+            """Starts passing transactions to and from a worker process. shard is a
+            WorkerRecord whose sendQueue the worker writes and whose recvQueue it
+            reads. Safe to call from any thread."""
+            self._shardChanges.append((index, shard, True))
+            self._switchWaker.wake()
+        
+        def retireShard(self, index, shard):
+            """Stops using a worker process which has died and closes its queues. As
+            far as their services are concerned, its sockets are closed. Safe to
+            call from any thread."""
+            self._shardChanges.append((index, shard, False))
+            self._switchWaker.wake()
+        
+        def reply(self, shard, message):
+            """Sends a control message to a worker process. Safe to call from any thread."""
+            self._replies.append((shard, message))
+            self._switchWaker.wake()
+        
+        def retireService(self, record):
+            """Closes the queues of a removed service and tells every worker process
+            to forget about it"""
+            WebSocketClient.WebSocketSwitchboard.retireService(self, record)
+            for shard in self._shards.keys():
+                self.reply(shard, (SHARD_RETIRED, None, record.id))
+        
+        def _changeShards(self):
+            """Starts watching the worker processes handed over by addShard and
+            retires those handed over by retireShard"""
+            while self._shardChanges:
+                index, shard, added = self._shardChanges.popleft()
+                fd = shard.sendQueue.fileno()
+                if added:
+                    self._shards[shard] = index
+                    self._shardReaders[fd] = shard
+                    self._switchPoller.register(fd, EventPoller.EVENT_READ)
+                    continue
+                self._shards.pop(shard, None)
+                if self._shardReaders.pop(fd, None) is not None:
+                    self._switchPoller.unregister(fd)
+                fd = shard.recvQueue.writerFileno()
+                if self._serviceWriters.pop(fd, None) is not None:
+                    self._switchPoller.unregister(fd)
+                if self._batches.pop(shard, None) is not None:
+                    self._batchStarted.pop(shard)
+                self.shardMetrics.pop(index, None)
+                closed = 0
+                for s in self.sockets.connections():
+                    if s.shard is shard:
+                        self._inbound.append((s, WebSocketTransaction(WebSocketTransaction.TRANSACTION_CLOSE, s.id, None)))
+                        closed += 1
+                print "Notice: Socket worker", index, "died with", closed, "sockets, which are closed."
+                shard.close()
+        
+        def _handleEvent(self, fd, events):
+            """Takes whatever a worker process has sent"""
+            shard = self._shardReaders.get(fd)
+            if shard is None:
+                return
+            while True:
+                messages = shard.sendQueue.getMany(self.batchSize, False)
+                if not messages:
+                    break
+                for message in messages:
+                    if isinstance(message, WebSocketTransaction):
+                        self._fromShard(shard, message)
+                    else:
+                        self._control(shard, message)
+        
+        def _fromShard(self, shard, transaction):
+            """Queues a transaction from a socket of a worker process to be passed
+            on to the socket's service. The TRANSACTION_NEWSOCKET of a socket
+            carries its address and service id, and adds its RemoteSocket."""
+            if transaction.transactionType == WebSocketTransaction.TRANSACTION_NEWSOCKET:
+                address, serviceId = transaction.data
+                s = WebSocketClient.WebSocketHubSwitchboard.RemoteSocket(transaction.socketId, serviceId, address, shard)
+                self.sockets.add(s)
+                transaction.data = address
+            else:
+                s = self.sockets.get(transaction.socketId)
+                if s is None:
+                    return #it was closed already
+            self._inbound.append((s, transaction))
+        
+        def _control(self, shard, message):
+            """Handles a control message from a worker process"""
+            kind, number, data = message
+            if kind == SHARD_METRICS:
+                self.shardMetrics[self._shards[shard]] = data
+            elif kind == SHARD_RESOLVE:
+                self.resolver.resolve(data, lambda service: self.reply(shard, (SHARD_RESOLVE, number, (service.id, service.streaming) if service is not None else None)))
+            elif kind == SHARD_STATS:
+                self.resolver.stats(lambda stats: self.reply(shard, (SHARD_STATS, number, stats)))
+        
+        def _routeToSockets(self, transaction):
+            """Passes a transaction from a service on to the worker process which
+            owns the socket it is meant for. Groups are kept here since their
+            sockets can belong to any of the workers."""
+            transactionType = transaction.transactionType
+            if transactionType == WebSocketTransaction.TRANSACTION_DATA or transactionType == WebSocketTransaction.TRANSACTION_CLOSE:
+                s = self.sockets.get(transaction.socketId)
+                if s is not None:
+                    if transaction.trace is not None:
+                        transaction.trace.append((TRACE_ROUTED, time.time()))
+                    self._addToBatch(s.shard, transaction)
+            else:
+                WebSocketClient.WebSocketSwitchboard._routeToSockets(self, transaction)
+        
+        def _broadcast(self, transaction):
+            """Sends a broadcast to each worker process which owns some of the
+            sockets it names, along with the ids of those sockets. The workers
+            count the broadcasts they deliver."""
+            targets = transaction.socketId
+            if isinstance(targets, basestring):
+                targets = self.groups.get(targets, ())
+            byShard = {}
+            get = self.sockets.get
+            for socketId in targets:
+                s = get(socketId)
+                if s is not None:
+                    byShard.setdefault(s.shard, []).append(socketId)
+            for shard in byShard:
+                self._addToBatch(shard, WebSocketTransaction(WebSocketTransaction.TRANSACTION_BROADCAST, byShard[shard], transaction.data, binary=transaction.binary, trace=transaction.trace))
+        
+        def _forwardToServices(self):
+            """Applies the changes to the worker processes and queues the replies
+            to them before passing the transactions of the sockets on to their
+            services"""
+            if self._shardChanges:
+                self._changeShards()
+            while self._replies:
+                shard, message = self._replies.popleft()
+                if shard in self._shards:
+                    self._addToBatch(shard, message)
+            WebSocketClient.WebSocketSwitchboard._forwardToServices(self)
+        
+    class WebSocketShardSwitchboard(WebSocketSwitchboard):
+        """Switchboard of a socket worker process (see WebSocketManagerPool).
+        Rather than to the services themselves, it passes the transactions of
+        its sockets to the WebSocketHubSwitchboard of the server process, which
+        plays the part of every service, and delivers what comes back to its
+        sockets. Broadcasts are framed and compressed here.
+        
+        It also stands in for the ServiceStarter of the server in the worker
+        process: services and the statistics are asked for from the server
+        process. The services found are kept in routes until the server process
+        says they have been removed. Every WORKER_CHECK_INTERVAL seconds a
+        snapshot of the metrics of the worker is sent to the server process, and
+        if the server process has gone away the worker is stopped."""
+        
+        class ServiceReference:
+            """Stands in for the ProcessRecord of a service of the server process"""
+            def __init__(self, serviceId, streaming):
+                self.id = serviceId
+                self.streaming = streaming
+                self.alive = True
+            
+            def is_alive(self):
+                """Returns whether the service hasn't been removed"""
+                return self.alive
+        
+        def __init__(self, stopEvent, processDirectory, hub, metrics=None, tracer=None, batchSize=SERVICE_BATCH_SIZE, flushDelay=SERVICE_FLUSH_DELAY):
+            """Initializes a switchboard which reaches the services through hub, a
+            WorkerRecord whose sendQueue the server process writes and whose
+            recvQueue it reads. See WebSocketSwitchboard for the other arguments."""
+            WebSocketClient.WebSocketSwitchboard.__init__(self, stopEvent, processDirectory, metrics, tracer, batchSize, flushDelay)
+            self.hub = hub
+            self.routes = {} #request path -> ServiceReference of the services found so far
+            self._requests = {} #request number -> (request path or None, callback) of the requests waiting for an answer
+            self._requestNumbers = itertools.count()
+            self._outgoing = collections.deque() #control messages waiting to be sent to the server process
+            self._serverPid = os.getppid()
+            self._switchPoller.register(hub.sendQueue.fileno(), EventPoller.EVENT_READ)
+        
+        def resolve(self, location, callback):
+            """Asks the server process for the service at the given location and
+            calls callback with its ServiceReference, or None if there is no such
+            service, from the switchboard thread. Safe to call from any thread."""
+            self._request(SHARD_RESOLVE, '/'.join(location), location, callback)
+        
+        def stats(self, callback):
+            """Asks the server process for the statistics and calls callback with
+            them from the switchboard thread. Safe to call from any thread."""
+            self._request(SHARD_STATS, None, None, callback)
+        
+        def _request(self, kind, key, data, callback):
+            """Queues a control message for the server process and remembers the
+            callback which is called with the answer"""
+            number = next(self._requestNumbers)
+            self._requests[number] = (key, callback)
+            self._outgoing.append((kind, number, data))
+            self._switchWaker.wake()
+        
+        def addWebSocket(self, s):
+            """Starts routing transactions to and from a socket. Its
+            TRANSACTION_NEWSOCKET also carries the service id for the server process."""
+            if s.serviceId is not None:
+                self.queueToService(s, WebSocketTransaction(WebSocketTransaction.TRANSACTION_NEWSOCKET, s.id, (s.address, s.serviceId)))
+        
+        def _workerFor(self, s):
+            """Everything goes to the server process"""
+            return self.hub
+        
+        def _handleEvent(self, fd, events):
+            """Delivers whatever the server process has sent"""
+            if fd != self.hub.sendQueue.fileno():
+                return
+            while True:
+                messages = self.hub.sendQueue.getMany(self.batchSize, False)
+                if not messages:
+                    break
+                for message in messages:
+                    if isinstance(message, WebSocketTransaction):
+                        self._routeToSockets(message)
+                    else:
+                        self._answer(message)
+        
+        def _answer(self, message):
+            """Handles a control message from the server process"""
+            kind, number, data = message
+            if kind == SHARD_RETIRED:
+                for key, service in self.routes.items():
+                    if service.id == data:
+                        service.alive = False
+                        del self.routes[key]
+                return
+            key, callback = self._requests.pop(number)
+            if kind == SHARD_RESOLVE and data is not None:
+                service = self.routes.get(key)
+                if service is None or service.id != data[0]:
+                    service = self.routes[key] = WebSocketClient.WebSocketShardSwitchboard.ServiceReference(*data)
+                data = service
+            callback(data)
+        
+        def _tick(self):
+            """Sends a snapshot of the metrics to the server process, or stops the
+            worker if the server process has gone away"""
+            WebSocketClient.WebSocketSwitchboard._tick(self)
+            if os.getppid() != self._serverPid:
+                print "The server process has gone away. Stopping socket worker", os.getpid()
+                self.stopEvent.set()
+                return
+            self._outgoing.append((SHARD_METRICS, None, self.metrics.snapshot()))
+        
+        def _forwardToServices(self):
+            """Queues the control messages for the server process before passing
+            the transactions of the sockets on to it"""
+            while self._outgoing:
+                self._addToBatch(self.hub, self._outgoing.popleft())
+            WebSocketClient.WebSocketSwitchboard._forwardToServices(self)
+        
     class WebSocketManager(threading.Thread):
         """Thread which manages communication between WebSockets and their clients.
         
-        This asyncronously sends/receives data to/from sockets while at the same time
-        handling the service send/recv queues in a "switchboard" like fashion."""
+        This asyncronously sends/receives data to/from sockets. Transactions are
+        passed between the sockets and the service send/recv queues by a
+        WebSocketSwitchboard, which is either shared with other managers or
+        owned by this manager."""
         
-        def __init__(self, socketList, stopEvent, processDirectory):
+        def __init__(self, socketList, stopEvent, processDirectory, switchboard=None, maxMessageSize=DEFAULT_MAX_MESSAGE_SIZE, sendLimits=None, metrics=None, index=0, tracer=None, keepalive=None):
             """Initializes a new WebSocketSendRecvThread with the given sockets,
             a multiprocessing.Event (stopEvent) to stop the thread gracefully, and
-            the process directory which will contain all the processes"""
+            the process directory which will contain all the processes. If no
+            switchboard is given, the manager starts its own. maxMessageSize is
+            the largest message accepted from a client, or 0 for no limit.
+            sendLimits is the SendLimits and keepalive the KeepaliveLimits of new
+            connections. The manager's metrics are kept in the Metrics.Registry
+            metrics, labelled with its index, and messages are traced by the
+            Metrics.Tracer tracer."""
             threading.Thread.__init__(self)
-            self.sockets = {} #sockets are stored sorted by their unique ids
-            for sock in socketList:
-                self.sockets[sock.id] = sock
-            self.socketListLock = threading.Lock()
             self.stopEvent = stopEvent
+            self.maxMessageSize = maxMessageSize
+            self.sendLimits = sendLimits if sendLimits is not None else WebSocketClient.SendLimits()
+            self.keepalive = keepalive if keepalive is not None else WebSocketClient.KeepaliveLimits()
             self.processDirectory = processDirectory
+            self.metrics = metrics if metrics is not None else Metrics.Registry()
+            self.tracer = tracer if tracer is not None else Metrics.Tracer(self.metrics)
+            self._ownsSwitchboard = switchboard is None
+            if switchboard is None:
+                switchboard = WebSocketClient.WebSocketSwitchboard(stopEvent, processDirectory, self.metrics, self.tracer)
+            self.switchboard = switchboard
+            self._poller = EventPoller()
+            self._waker = EventWaker()
+            self._poller.register(self._waker.fileno(), EventPoller.EVENT_READ)
+            self._connections = {} #file descriptor -> WebSocketClient for the sockets registered with the poller
+            self._pendingAdds = [] #sockets waiting to be registered with the poller by the manager thread
+            self._writeRequests = set() #sockets which had something put in their sendQueue
+            self._requestLock = threading.Lock() #protects _pendingAdds and _writeRequests
+            self._timers = TimerWheel() #sockets by the time their keepalive or idle timeout has to be checked
+            self._recvBuffer = bytearray(BUFFER_SIZE) #every socket is read into this before its bytes are parsed
+            self._recvStates = [] #idle WebSocketRecvStates waiting for a socket with something to receive
+            self._sendStates = [] #empty WebSocketSendStates waiting for a socket with something to write
+            label = str(index)
+            self.sendCalls = self.metrics.counter("sendCalls", manager=label) #number of send system calls made
+            self.sentBytes = self.metrics.counter("bytesSent", manager=label) #number of bytes written by those calls
+            self.sentFrames = self.metrics.counter("framesSent", manager=label) #number of frames queued to be written
+            self.receivedBytes = self.metrics.counter("bytesReceived", manager=label)
+            self.receivedFrames = self.metrics.counter("framesReceived", manager=label)
+            self.receivedMessages = self.metrics.counter("messagesReceived", manager=label) #messages, or parts of streamed messages, passed to services
+            self.openedSockets = self.metrics.counter("socketsOpened", manager=label)
+            self.closedSockets = self.metrics.counter("socketsClosed", manager=label)
+            self.slowConsumers = self.metrics.counter("slowConsumerDisconnects", manager=label)
+            self.protocolErrors = self.metrics.counter("protocolErrors", manager=label) #sockets closed for sending something invalid
+            self.pingsSent = self.metrics.counter("pingsSent", manager=label)
+            self.pongTimeouts = self.metrics.counter("pongTimeouts", manager=label) #sockets removed for not answering a ping
+            self.idleTimeouts = self.metrics.counter("idleTimeouts", manager=label) #sockets closed for not sending a message
+            self.loopTime = self.metrics.histogram("loopTime", thread="manager" + label) #seconds spent handling the events of each pass
+            self.metrics.gauge("sockets", lambda: len(self._connections), manager=label)
+            self.metrics.gauge("queuedBytes", lambda: sum(s.getQueuedBytes() for s in list(self._connections.values())), manager=label)
+            self.metrics.gauge("largestSocketQueues", lambda: self.getQueueStats(STATS_SOCKETS), manager=label)
+            for sock in socketList:
+                self.switchboard.addWebSocket(sock)
+                self._pendingAdds.append(sock)
         
         def addWebSocket(self, s):
-            """Adds a socket to the list to be asyncronously managed. Returns if it was successful"""
+            """Adds a socket to the list to be asyncronously managed. If the socket
+            already belongs to a service, the service is informed of the new socket.
+            Returns if it was successful"""
             if self.isAlive() == False:
                 #create a new one
                 return False
             else:
-                #add to the existing one
-                with self.socketListLock:
-                    self.sockets[s.id] = s
+                #add to the existing one before the service hears about it so that its answer can't arrive first
+                with self._requestLock:
+                    self._pendingAdds.append(s)
+                self._waker.wake()
+                self.switchboard.addWebSocket(s)
                 return True
         
-        def _stringToFrame(self, data):
-            """Turns a string into a WebSocket data frame. Returns a bytes(). 'data' is a string"""
-            #determine the size of the data we were told to send
-            rawData = data#bytearray(data, 'ascii')
-            dataLength = len(rawData)
-            outputBytes = bytearray()
-            outputBytes.append(0x81) #0x81 = text data type
-            if dataLength < 0x7D:
-                #a nice short length
-                outputBytes.append(len(rawData))
-            elif dataLength >= 0x7E and len(rawData) < 0xFFFF:
-                #two additional bytes of length needed
-                outputBytes.append(0x7E)
-                outputBytes.append(dataLength >> 8 & 0xFF)
-                outputBytes.append(dataLength & 0xFF)
-            else:
-                #eight additional bytes of length needed
-                outputBytes.append(0x7F)
-                outputBytes.append(dataLength >> 56 & 0xFF)
-                outputBytes.append(dataLength >> 48 & 0xFF)
-                outputBytes.append(dataLength >> 40 & 0xFF)
-                outputBytes.append(dataLength >> 32 & 0xFF)
-                outputBytes.append(dataLength >> 24 & 0xFF)
-                outputBytes.append(dataLength >> 16 & 0xFF)
-                outputBytes.append(dataLength >> 8 & 0xFF)
-                outputBytes.append(dataLength & 0xFF)
-            #tack on the raw data now
-            for byte in rawData:
-                outputBytes.append(ord(byte))
-            return bytes(outputBytes)
-        
-        def _sendToSocket(self, data, sock):
-            """Sends some bytes to a socket and returns the remaining bytes or none if it was all sent"""
-            nSent = sock.send(data)
-            if nSent == len(data):
-                return None
-            else:
-                return data[nSent:] #if we didn't send the whole thing, return from the last index sent to the end
+        def _requestWrite(self, s):
+            """Informs the manager thread that a socket has something new in its
+            sendQueue so that it starts waiting for the socket to be writable"""
+            with self._requestLock:
+                self._writeRequests.add(s)
+            self._waker.wake()
         
-        def __queueHelper(self):
-            """Thread method to operate the "switchboard" between server queues and the individual socket queues"""
-            while self.stopEvent.is_set() == False:
-                processes = self.processDirectory.getAllProcesses()
-                for pid in processes:
-                    #read through the sendQueue in this process and send it to the appropriate sockets
-                    process = processes[pid]
-                    while process.sendQueue.empty() == False:
+        def _requestWrites(self, sockets):
+            """Same as _requestWrite for many sockets at once"""
+            with self._requestLock:
+                self._writeRequests.update(sockets)
+            self._waker.wake()
+        
+        @staticmethod
+        def _stringToFrame(data, binary=False, deflate=None):
+            """Turns a string into a WebSocket data frame. 'data' is a string which is
+            encoded as UTF-8 if it is unicode. Binary data may be any buffer (such as
+            a str or bytearray) and is framed as it is. If the PerMessageDeflate of
+            the connection is given, messages of at least DEFLATE_MIN_SIZE bytes are
+            compressed. Returns a (header, payload) tuple so that the payload can be
+            sent without being copied into the frame."""
+            opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+            if not binary and isinstance(data, unicode):
+                data = data.encode("utf-8")
+            if deflate is not None and len(data) >= DEFLATE_MIN_SIZE:
+                data = deflate.compress(data)
+                return encodeFrameHeader(len(data), opcode, True), data
+            return encodeFrameHeader(len(data), opcode), data
+        
+        def _sendToSocket(self, sendState, sock):
+            """Sends as much of a socket's pending frames as the socket will take.
+            Returns the number of bytes sent."""
+            nSent = 0
+            while not sendState.isEmpty():
+                try:
+                    sent = sendState.send(sock)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        break #the socket buffer is full, so wait until it is writable again
+                    raise
+                self.sendCalls.inc()
+                self.sentBytes.inc(sent)
+                nSent += sent
+            return nSent
+        
+        def _takeRecvState(self, s):
+            """Returns the receive state of a socket, giving it one from the pool
+            if it has none"""
+            readProgress = s._readProgress
+            if readProgress is None:
+                streamChunkSize = STREAM_CHUNK_SIZE if s.streaming else None
+                if self._recvStates:
+                    readProgress = self._recvStates.pop()
+                    readProgress.streamChunkSize = streamChunkSize
+                    readProgress.deflate = s.deflate
+                else:
+                    readProgress = WebSocketClient.WebSocketRecvState(self.maxMessageSize, streamChunkSize, s.deflate)
+                s._readProgress = readProgress
+            return readProgress
+        
+        def _releaseRecvState(self, s):
+            """Takes the receive state of a socket back into the pool if it is idle"""
+            readProgress = s._readProgress
+            if readProgress is not None and readProgress.isIdle():
+                s._readProgress = None
+                if len(self._recvStates) < STATE_POOL_SIZE:
+                    readProgress.deflate = None
+                    self._recvStates.append(readProgress)
+        
+        def _takeSendState(self, s):
+            """Returns the send state of a socket, giving it one from the pool if
+            it has none"""
+            writeProgress = s._writeProgress
+            if writeProgress is None:
+                writeProgress = self._sendStates.pop() if self._sendStates else WebSocketClient.WebSocketSendState()
+                s._writeProgress = writeProgress
+            return writeProgress
+        
+        def _releaseSendState(self, s):
+            """Takes the send state of a socket back into the pool if everything in
+            it has been written"""
+            writeProgress = s._writeProgress
+            if writeProgress is not None and writeProgress.isEmpty():
+                s._writeProgress = None
+                if len(self._sendStates) < STATE_POOL_SIZE:
+                    self._sendStates.append(writeProgress)
+        
+        def getWriteStats(self):
+            """Returns a dictionary describing how well writes are being batched"""
+            calls = max(self.sendCalls.value, 1)
+            return { "sendCalls" : self.sendCalls.value,
+                     "sentBytes" : self.sentBytes.value,
+                     "sentFrames" : self.sentFrames.value,
+                     "bytesPerCall" : float(self.sentBytes.value) / calls,
+                     "framesPerCall" : float(self.sentFrames.value) / calls }
+        
+        def getQueueStats(self, limit=None):
+            """Returns a list describing the outgoing data waiting for each socket,
+            with the sockets holding the most bytes first. This is how slow
+            consumers are found. limit is the largest number of sockets returned."""
+            stats = [WebSocketClient.WebSocketManager._queueStats(s) for s in list(self._connections.values())]
+            stats.sort(key=lambda stat: stat["queuedBytes"], reverse=True)
+            return stats[:limit] if limit is not None else stats
+        
+        @staticmethod
+        def _queueStats(s):
+            """Returns a dictionary describing the outgoing data waiting for a socket"""
+            return { "socketId" : s.id,
+                     "queuedMessages" : s.sendQueue.qsize(),
+                     "queuedBytes" : s.getQueuedBytes(),
+                     "dropped" : s.sendQueue.dropped,
+                     "congested" : s.sendQueue.congested }
+        
+        def _processRequests(self):
+            """Registers new sockets with the poller and starts watching sockets
+            which have new data to write for writability"""
+            with self._requestLock:
+                pendingAdds = self._pendingAdds
+                self._pendingAdds = []
+                writeRequests = self._writeRequests
+                self._writeRequests = set()
+            for s in pendingAdds:
+                self._connections[s.fileno] = s
+                self.openedSockets.inc()
+                self._scheduleKeepalive(s)
+                if s.sendQueue.empty():
+                    self._poller.register(s.fileno, EventPoller.EVENT_READ)
+                else:
+                    self._poller.register(s.fileno, EventPoller.EVENT_READ | EventPoller.EVENT_WRITE)
+            for s in writeRequests:
+                if self._connections.get(s.fileno) is not s:
+                    continue
+                if s.sendQueue.disconnectRequested:
+                    #the slow consumer policy says it has to go, so don't wait for it to become writable
+                    print "Notice: Socket", s, "is too slow and will be disconnected."
+                    self.slowConsumers.inc()
+                    with s.lock:
+                        self._closeWithStatus(s, CLOSE_POLICY_VIOLATION)
+                    self._removeSocket(s)
+                else:
+                    self._poller.modify(s.fileno, EventPoller.EVENT_READ | EventPoller.EVENT_WRITE)
+        
+        def _removeSocket(self, s):
+            """Stops managing a socket, closes it, and informs the service. The
+            socket is unregistered before it is closed so that its file descriptor
+            can be safely reused."""
+            self._poller.unregister(s.fileno)
+            self._connections.pop(s.fileno, None)
+            self._timers.cancel(s)
+            self.closedSockets.inc()
+            print "Notice: Socket", s, "removed."
+            with s.lock:
+                s.open = False
+                try:
+                    s.connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass #it was already broken
+                s.connection.close()
+            self.switchboard.queueToService(s, WebSocketTransaction(WebSocketTransaction.TRANSACTION_CLOSE, s.id, None))
+        
+        def _scheduleKeepalive(self, s):
+            """Sets the timer of a socket for the next time one of its timeouts has
+            to be checked, if any of them are turned on"""
+            limits = self.keepalive
+            deadlines = []
+            if limits.pingInterval > 0:
+                #the next ping is always due, whether or not the last one was answered
+                deadlines.append(max(s.lastReceived, s.lastPing) + limits.pingInterval)
+            if s.pingSent is not None and limits.pongTimeout > 0:
+                deadlines.append(s.pingSent + limits.pongTimeout)
+            if limits.idleTimeout > 0:
+                deadlines.append(s.lastMessage + limits.idleTimeout)
+            if deadlines:
+                self._timers.schedule(s, min(deadlines))
+        
+        def _checkKeepalive(self, s, now):
+            """Handles a socket whose timer is due. Sockets which have been idle too
+            long are closed, sockets which didn't answer a ping in time are
+            removed and sockets which have been quiet are sent a ping. Activity
+            doesn't move the timer, so it is only set again here."""
+            if self._connections.get(s.fileno) is not s:
+                return
+            limits = self.keepalive
+            if limits.idleTimeout > 0 and now - s.lastMessage >= limits.idleTimeout:
+                print "Notice: Socket", s, "has been idle too long and will be closed."
+                self.idleTimeouts.inc()
+                with s.lock:
+                    self._closeWithStatus(s, CLOSE_GOING_AWAY)
+                self._removeSocket(s)
+                return
+            if s.pingSent is not None and limits.pongTimeout > 0 and now - s.pingSent >= limits.pongTimeout:
+                print "Notice: Socket", s, "did not answer a ping and will be removed."
+                self.pongTimeouts.inc()
+                with s.lock:
+                    s.open = False
+                self._removeSocket(s)
+                return
+            if limits.pingInterval > 0 and now - max(s.lastReceived, s.lastPing) >= limits.pingInterval:
+                with s.lock:
+                    self._takeSendState(s).queueFrame(encodeFrameHeader(0, OPCODE_PING), "")
+                    s.lastPing = now
+                    if s.pingSent is None:
+                        s.pingSent = now
+                self._poller.modify(s.fileno, EventPoller.EVENT_READ | EventPoller.EVENT_WRITE)
+                self.pingsSent.inc()
+            self._scheduleKeepalive(s)
+        
+        def _queueMessage(self, s, final):
+            """Passes the completed message, or the next part of a streamed message,
+            of a socket on to its service"""
+            s.lastMessage = s.lastReceived
+            readProgress = s._readProgress
+            binary = readProgress.messageOpcode == OPCODE_BINARY
+            while True:
+                data = readProgress.takeMessage(final)
+                inflating = readProgress.inflating #a compressed part came out full, so there may be more of it
+                if data or not inflating:
+                    transaction = WebSocketTransaction(WebSocketTransaction.TRANSACTION_DATA, s.id, data, final and not inflating, binary)
+                    if self.tracer.sampleRate > 0 and self.tracer.sample():
+                        transaction.trace = [(TRACE_RECEIVED, time.time())]
+                    self.switchboard.queueToService(s, transaction)
+                    self.receivedMessages.inc()
+                if not inflating:
+                    break
+        
+        def _handleControlFrame(self, s, opcode, payload):
+            """Answers a ping or close frame received from a socket. s.lock must be held."""
+            if opcode == OPCODE_PING:
+                self._takeSendState(s).queueFrame(encodeFrameHeader(len(payload), OPCODE_PONG), bytes(payload))
+                self._poller.modify(s.fileno, EventPoller.EVENT_READ | EventPoller.EVENT_WRITE)
+            elif opcode == OPCODE_CLOSE:
+                #echo their status code back to finish the closing handshake, unless it isn't one they may send
+                code = _CLOSE_CODE.unpack_from(payload)[0] if len(payload) >= 2 else CLOSE_NORMAL
+                if len(payload) == 1 or not validCloseCode(code):
+                    self.protocolErrors.inc()
+                    code = CLOSE_PROTOCOL_ERROR
+                else:
+                    try:
+                        bytes(payload[2:]).decode("utf-8") #the reason has to be valid UTF-8 like any text
+                    except UnicodeDecodeError:
+                        self.protocolErrors.inc()
+                        code = CLOSE_INVALID_DATA
+                self._closeWithStatus(s, code)
+        
+        def _closeWithStatus(self, s, code):
+            """Sends a close frame with the given status code after anything already
+            buffered, as far as the socket will take it without waiting, and marks
+            the socket as closed. s.lock must be held."""
+            writeProgress = self._takeSendState(s)
+            writeProgress.queueFrame(encodeFrameHeader(2, OPCODE_CLOSE), _CLOSE_CODE.pack(code))
+            try:
+                self._sendToSocket(writeProgress, s.connection)
+            except socket.error:
+                pass #it is being closed anyway
+            s.open = False
+        
+        def _readSocket(self, s):
+            """Reads whatever is available on a readable socket. Completed messages
+            (or parts of them for streaming services) are queued and control frames
+            are answered. Sockets which break the protocol are closed with the
+            matching status code."""
+            try:
+                with s.lock:
+                    nReceived = s.connection.recv_into(self._recvBuffer)
+                    receivedBytes = self._recvBuffer[:nReceived]
+                    self.receivedBytes.inc(nReceived)
+                    if len(receivedBytes) == 0:
+                        #the socket was gracefully closed on the other end
+                        s.open = False
+                    else:
+                        #anything at all shows the other end is still there, so a ping is answered
+                        s.lastReceived = time.time()
+                        s.pingSent = None
+                    readProgress = self._takeRecvState(s)
+                    while len(receivedBytes) > 0 and s.open:
+                        receivedBytes = readProgress.receive(receivedBytes)
+                        if readProgress.state == WebSocketClient.WebSocketRecvState.STATE_DONE:
+                            self.receivedFrames.inc()
+                            if readProgress.isControlFrame():
+                                self._handleControlFrame(s, readProgress.opcode, readProgress.controlBytes)
+                            elif readProgress.fin:
+                                #a whole message was read, so put it in the queue
+                                self._queueMessage(s, True)
+                            readProgress.nextFrame()
+                        elif readProgress.chunkReady():
+                            self._queueMessage(s, False)
+                    self._releaseRecvState(s)
+            except WebSocketMessageTooBigException:
+                self.protocolErrors.inc()
+                with s.lock:
+                    self._closeWithStatus(s, CLOSE_MESSAGE_TOO_BIG)
+            except WebSocketInvalidDataException:
+                #The socket got some bad data, so it should be closed
+                self.protocolErrors.inc()
+                with s.lock:
+                    self._closeWithStatus(s, CLOSE_PROTOCOL_ERROR)
+            except UnicodeDecodeError:
+                self.protocolErrors.inc()
+                with s.lock:
+                    self._closeWithStatus(s, CLOSE_INVALID_DATA)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    #the connection is broken
+                    with s.lock:
+                        s.open = False
+        
+        def _writeSocket(self, s):
+            """Writes to a writable socket. What is waiting in the sendQueue is
+            moved into the socket's output buffer, up to WRITE_BUFFER_LIMIT bytes
+            at a time, and written with as few send calls as possible. Anything the
+            socket won't take yet stays queued until the socket is writable again,
+            where it counts against the socket's water marks. When there is nothing
+            left to write the socket is no longer watched for writability."""
+            with s.lock:
+                closeRequested = False
+                traces = None #traces of the transactions written in this pass
+                writeProgress = self._takeSendState(s)
+                while True:
+                    if writeProgress.pendingBytes >= WRITE_BUFFER_LIMIT:
+                        #write what we have before encoding any more
                         try:
-                            transaction = process.sendQueue.get_nowait()
-                            with self.socketListLock:
-                                if transaction.socketId in self.sockets:
-                                    self.sockets[transaction.socketId].sendQueue.put(transaction)                                
-                        except Queue.Empty:
-                            break
-                #get all our sockets
-                with self.socketListLock:
-                    socketIds = self.sockets.keys()
-                for sockId in socketIds:
-                    s = self.sockets[sockId] #this is a WebSocketClient
+                            self._sendToSocket(writeProgress, s.connection)
+                        except socket.error:
+                            s.open = False
+                            return
+                        if writeProgress.pendingBytes >= WRITE_BUFFER_LIMIT:
+                            break #the client isn't keeping up, so leave the rest in the sendQueue
                     try:
-                        while s.recvQueue.empty() == False:
-                            #put their receive queue into the approproate process
-                            transaction = s.recvQueue.get_nowait()
-                            processes[s.serviceId].recvQueue.put(transaction)
-                            #if this was a close transaction, we need to remove it from our list
-                            if transaction.transactionType == WebSocketTransaction.TRANSACTION_CLOSE:
-                                with self.socketListLock:
-                                    self.sockets.pop(sockId)
+                        transaction = s.sendQueue.get_nowait()
                     except Queue.Empty:
-                        break;
-                time.sleep(0.005) #sleep for 5 ms before doing this again
-                
+                        break
+                    if (transaction.transactionType == WebSocketTransaction.TRANSACTION_CLOSE):
+                        #they want us to close the socket once the earlier frames are written
+                        closeRequested = True
+                        break
+                    if transaction.transactionType == WebSocketTransaction.TRANSACTION_BROADCAST:
+                        header, payload, compressed = transaction.data #already encoded once for every recipient
+                        if compressed:
+                            #it was compressed without our context, so ours no longer matches the client's
+                            s.deflate.forgetContext()
+                    else:
+                        header, payload = self._stringToFrame(transaction.data, transaction.binary, s.deflate)
+                    writeProgress.queueFrame(header, payload)
+                    self.sentFrames.inc()
+                    if transaction.trace is not None:
+                        if traces is None:
+                            traces = []
+                        traces.append(transaction.trace)
+                try:
+                    self._sendToSocket(writeProgress, s.connection)
+                except socket.error:
+                    #probably a broken pipe
+                    s.open = False
+                    return
+                if traces is not None:
+                    now = time.time()
+                    for trace in traces:
+                        trace.append((TRACE_WRITTEN, now))
+                        self.tracer.finish(trace)
+                if s.sendQueue.relieved():
+                    self.switchboard.queueToService(s, WebSocketTransaction(WebSocketTransaction.TRANSACTION_BACKPRESSURE, s.id, False))
+                if closeRequested:
+                    self._closeWithStatus(s, CLOSE_NORMAL)
+                elif writeProgress.isEmpty() and s.sendQueue.empty():
+                    #nothing more to write, so stop waking up for this socket until the switchboard says otherwise
+                    self._poller.modify(s.fileno, EventPoller.EVENT_READ)
+                    self._releaseSendState(s)
         
         def run(self):
-            """Main thread method which will run until all sockets are no longer active"""
-            #start the queue helper
-            queueHelper = threading.Thread(target=self.__queueHelper)
-            queueHelper.start()
+            """Main thread method which will run until the stop event is set.
+            
+            Every socket is registered with the poller once and only sockets that
+            are readable or have something waiting to be written wake this thread.
+            Otherwise it only wakes for the ticks of the timer wheel while some
+            socket has a timer."""
+            if self._ownsSwitchboard:
+                self.switchboard.start()
             while self.stopEvent.is_set() == False:
-                with self.socketListLock:
-                    #get the list of socket ids so that we can iterate through them without eating up the socket list lock
-                    #in theory, fetching an item from a dictionary in python is thread safe
-                    socketIds = self.sockets.keys()
-                for sockId in socketIds:
-                    s = self.sockets[sockId] #these are not sockets, but WebSocket objects
-                    if s.open == False:
-                        #remove this socket from our list and put this event into the receive queue
-                        print "Notice: Socket", s, "removed."
-                        s.recvQueue.put(WebSocketTransaction(WebSocketTransaction.TRANSACTION_CLOSE, sockId, None))
-                        continue #skip the rest of this
-                    with s.lock: #lock the individiual socket
-                        #sadly, we need to call select on every socket individually so that we can keep track of the WebSocketClient class
-                        sList = [ s.connection ]
-                        try:
-                            r, w, x = select.select(sList, sList, sList, 0)
-                        except socket.error:
-                            #it failed. remove this client
-                            print "Notice: Socket", s, "failed."
-                            s.open = False #this is no longer open, but we can't call close since it would break it some more
-                    if x:
+                self._processRequests()
+                timeout = POLL_TIMEOUT
+                if self._timers:
+                    timeout = min(timeout, self._timers.untilNextTick(time.time()))
+                ready = self._poller.poll(timeout)
+                started = time.time()
+                for fd, events in ready:
+                    if fd == self._waker.fileno():
+                        self._waker.drain()
+                        continue
+                    s = self._connections.get(fd)
+                    if s is None:
+                        continue #removed earlier in this pass
+                    if events & EventPoller.EVENT_READ:
+                        self._readSocket(s)
+                    elif events & EventPoller.EVENT_ERROR:
                         print "Notice: Socket", s, "has an exceptional condition"
-                        with s.lock:
-                            s.open = False
-                    if r:
-                        #the socket is ready to be read
-                        try:
-                            with s.lock:
-                                received = r[0].recv(4096) #we will receive up to 4096 bytes
-                                receivedBytes = bytearray(received)
-                                if len(receivedBytes) == 0:
-                                    #the socket was gracefully closed on the other end
-                                    s.close()
-                                while len(receivedBytes) > 0:
-                                    receivedBytes = s._readProgress.receive(receivedBytes)
-                                    if s._readProgress.state == WebSocketClient.WebSocketRecvState.STATE_DONE:
-                                        #a string was read, so put it in the queue
-                                        try:
-                                            transaction = WebSocketTransaction(WebSocketTransaction.TRANSACTION_DATA, s.id, s._readProgress.unmaskedPayloadBytes.decode(sys.getdefaultencoding()))
-                                            s.recvQueue.put_nowait(transaction)
-                                        except Queue.Full:
-                                            logging.warning("Notice: Receive queue full on WebSocketClient" + str(s) + "... did you forget to empty the queue or call task_done?")
-                                            pass #oh well...I guess their data gets to be lost since they didn't bother to empty their queue
-                                        s._readProgress = WebSocketClient.WebSocketRecvState() #reset the progress
-                        except WebSocketInvalidDataException:
-                            #The socket got some bad data, so it should be closed
-                            with s.lock:
-                                s.open = False
-                        except socket.error:
-                            pass #don't worry about it
-                    if w:
-                        #the socket is ready to be written
-                        #for writing, the exception catcher has to be inside rather than outside
-                        #everything like the received catcher was since we need to make sure to
-                        #inform the sendqueue that we are done with the passed task
-                        with s.lock:
-                            if s._writeProgress != None:
-                                #we still have something to write
-                                try:
-                                    s._writeProgress = self._sendToSocket(s._writeProgress, s.connection)
-                                except socket.error:
-                                    #probably a broken pipe. don't worry about it...it will be caught on the next loop around
-                                    pass
-                            elif not s.sendQueue.empty():
-                                #there is something new to start sending
-                                try:
-                                    transaction = s.sendQueue.get_nowait()
-                                    if (transaction.transactionType == WebSocketTransaction.TRANSACTION_CLOSE):
-                                        #they want us to close the socket...
-                                        s.close()
-                                    else:
-                                        #they want us to write something to the socket
-                                        toWrite = self._stringToFrame(transaction.data)
-                                        try:
-                                            self._sendToSocket(toWrite, s.connection)
-                                        except socket.error:
-                                            #probably a broken pipe. don't worry about it...it will be caught on the next loop around
-                                            pass
-                                except Queue.Empty:
-                                    pass #don't worry about it...we just couldn't get anything
-                time.sleep(0.025) #wait 25ms for anything else to happen on the socket so we don't use 100% cpu on this one thread
-    
-    __idLock = multiprocessing.Lock()
-    __currentSocketId = 0
-    @staticmethod
-    def __getSocketId():
-        ret = None
-        with WebSocketClient.__idLock:
-            ret = WebSocketClient.__currentSocketId
-            WebSocketClient.__currentSocketId = ret + 1
-        return ret
-    
-    def __init__(self, wsManager, conn, addr):
+                        s.open = False
+                    if s.open and events & EventPoller.EVENT_WRITE:
+                        self._writeSocket(s)
+                    if not s.open:
+                        self._removeSocket(s)
+                if self._timers:
+                    now = time.time()
+                    for s in self._timers.advance(now):
+                        self._checkKeepalive(s, now)
+                self.loopTime.observe(time.time() - started)
+    
+    class WebSocketManagerPool:
+        """Runs the sockets in several worker processes so that framing, masking
+        and compression spread over the cores of the machine. Each worker
+        accepts its own clients on a listening socket bound with SO_REUSEPORT,
+        so the kernel spreads new connections over the workers, and runs its
+        own WebSocketManager. Only the transactions between the sockets and
+        the services cross into the server process, where a
+        WebSocketHubSwitchboard passes them on. The services are run by the
+        server process and shared by every worker, so routing and groups work
+        no matter which worker a socket lands on.
+        
+        factory is called with the index of a worker, which goes in the ids of
+        its sockets, and starts the worker process. It returns a WorkerRecord
+        whose sendQueue the worker writes and whose recvQueue it reads. A
+        worker which dies is replaced by one with a new index, and its sockets
+        are closed."""
+        
+        def __init__(self, count, stopEvent, processDirectory, factory, metrics=None, tracer=None, batchSize=SERVICE_BATCH_SIZE, flushDelay=SERVICE_FLUSH_DELAY):
+            """Initializes a pool of count worker processes. metrics, tracer,
+            batchSize and flushDelay are passed to the WebSocketHubSwitchboard."""
+            self.count = count
+            self.factory = factory
+            self.switchboard = WebSocketClient.WebSocketHubSwitchboard(stopEvent, processDirectory, metrics, tracer, batchSize, flushDelay)
+            self.shards = {} #index -> WorkerRecord of the running worker processes
+            self.restarts = 0 #number of worker processes which have been replaced
+            self._nextIndex = 0
+            self.switchboard.metrics.gauge("socketWorkers", lambda: sum(1 for shard in self.shards.values() if shard.is_alive()))
+            self.switchboard.metrics.gauge("socketWorkerRestarts", lambda: self.restarts)
+        
+        def start(self):
+            """Starts the switchboard and every worker process"""
+            self.switchboard.start()
+            for i in xrange(self.count):
+                self._startShard()
+        
+        def _startShard(self):
+            """Starts a worker process with an index which isn't in use"""
+            while self._nextIndex in self.shards:
+                self._nextIndex = (self._nextIndex + 1) & _SOCKET_SHARD_MASK
+            index = self._nextIndex
+            self._nextIndex = (index + 1) & _SOCKET_SHARD_MASK #a new worker doesn't reuse the index of one which just died
+            shard = self.factory(index)
+            self.shards[index] = shard
+            self.switchboard.addShard(index, shard)
+        
+        def checkShards(self):
+            """Replaces every worker process which has died"""
+            for index, shard in self.shards.items():
+                if not shard.is_alive():
+                    print "Notice: Socket worker", index, "with process id", shard.process.pid, "died. Replacing it."
+                    del self.shards[index]
+                    self.switchboard.retireShard(index, shard)
+                    self.restarts += 1
+                    self._startShard()
+        
+        def isAlive(self):
+            """Returns whether the switchboard is running"""
+            return self.switchboard.isAlive()
+        
+        def join(self):
+            """Stops every worker process and waits for them"""
+            for shard in self.shards.values():
+                shard.process.shutdownFlag.set()
+            for shard in self.shards.values():
+                shard.process.join()
+    
+    registry = ConnectionRegistry() #every open socket of the server, which gives each its id
+    idleSendQueue = WebSocketSendQueue(None) #the sendQueue of every client until something is queued for it. nothing is ever put in it, so it needs no limits
+    
+    def __init__(self, wsManager, conn, addr, serviceId=None, streaming=False, deflate=None):
         """Initializes the web socket client
         
         wsManager: websocket manager that can be used
         conn: socket object to use as the connection which has already had it's hand shaken
-        addr: address of the client"""
-        self.id = WebSocketClient.__getSocketId()
-        self.serviceId = None #this is used externally to map this socket to a specific service
+        addr: address of the client
+        serviceId: process id of the service the client is connected to
+        streaming: whether large messages are handed to the service in parts as they arrive
+        deflate: PerMessageDeflate of the connection if compression was negotiated"""
+        WebSocketClient.registry.add(self) #sets self.id
+        self.serviceId = serviceId #this is used externally to map this socket to a specific service
         self.wsManager = wsManager
         self.connection = conn
+        self.connection.setblocking(0) #the manager only reads or writes when the socket is ready
+        self.fileno = conn.fileno() #kept so the socket can be unregistered from the manager after closing
         self.address = addr
         self.open = True #we assume it is open
-        self.sendQueue = Queue.Queue()
-        self.recvQueue = Queue.Queue()
+        self.lastReceived = time.time() #when anything last arrived from the client
+        self.lastMessage = self.lastReceived #when the client last sent a message
+        self.pingSent = None #when the first ping still waiting for an answer was sent
+        self.lastPing = 0.0 #when the last ping was sent
+        self.sendQueue = WebSocketClient.idleSendQueue #the switchboard gives it its own once something is queued
         self.lock = threading.Lock() #This lock only needs to be used when accessing anything but the queues
-        self._readProgress = WebSocketClient.WebSocketRecvState()
-        self._writeProgress = None
-        wsManager.addWebSocket(self)
+        self.deflate = deflate
+        self.streaming = streaming
+        self._readProgress = None #WebSocketRecvState while part of a frame or message has been received
+        self._writeProgress = None #WebSocketSendState while there are frames to write
+        if not wsManager.addWebSocket(self):
+            #no manager will ever read or close it, so give back its slot and drop the connection
+            WebSocketClient.registry.remove(self)
+            self.open = False
+            self.connection.close()
+    
+    def getQueuedBytes(self):
+        """Returns the number of outgoing bytes waiting to be written to the client"""
+        writeProgress = self._writeProgress
+        return self.sendQueue.queuedBytes + (writeProgress.pendingBytes if writeProgress is not None else 0)
     
     def close(self):
         """Closes the connection"""